@@ -250,12 +250,20 @@ passed("sake recon parallel full")
 ########################
 # confirm builds all and builds correctly
 out, err = run(SAKE_CMD + "  -p")
-expected = """Going to run these targets 'compile graphfuncs, compile infuncs, compile qstats driver, compile statfuncs' in parallel
-Going to run these targets 'build binary, generate html documentation' in parallel
-Going to run these targets 'ensure version match, output version text file, package it' in parallel
-Done
+# targets start as soon as their dependencies are done,
+# so the order they start in depends on their timing
+expected = """Running target build binary
+Running target compile graphfuncs
+Running target compile infuncs
+Running target compile qstats driver
+Running target compile statfuncs
+Running target ensure version match
+Running target generate html documentation
+Running target output version text file
+Running target package it
 """
-if out != expected:
+lines = out.splitlines(True)
+if sorted(lines[:-1]) != expected.splitlines(True) or lines[-1:] != ["Done\n"]:
     FAIL("sake parallel full failed!")
 if (not os.path.isfile("./graphfuncs.o") or not os.path.isfile("./infuncs.o") or
     not os.path.isfile("./qstats.o") or not os.path.isfile("./statfuncs.o") or
@@ -284,10 +292,7 @@ passed('sake "build twinary"')
 #########################
 # confirm that it doesn't build
 out, err = run(SAKE_CMD + '  "build binary"')
-expected = """The following targets share dependencies and must be run together:
-  - compile qstats driver
-  - ensure version match
-Done
+expected = """Done
 """
 if out != expected:
     FAIL('sake "build binary" failed!')
@@ -319,10 +324,7 @@ passed('sake force "build binary"')
 out, err = run(SAKE_CMD + '  clean')
 out, err = run(SAKE_CMD + ' ')
 out, err = run(SAKE_CMD + '  -r "compile objects"')
-expected = """The following targets share dependencies and must be run together:
-  - compile qstats driver
-  - ensure version match
-"""
+expected = ""
 if out != expected:
     FAIL('sake recon "compile objects" failed!')
 passed('sake recon "compile objects"')
@@ -332,14 +334,10 @@ passed('sake recon "compile objects"')
 #  sake force recon "compile objects"  #
 ########################################
 out, err = run(SAKE_CMD + '  -F -r "compile objects"')
-expected = """The following targets share dependencies and must be run together:
-  - compile qstats driver
-  - ensure version match
-Would run target: compile graphfuncs
+expected = """Would run target: compile graphfuncs
 Would run target: compile infuncs
 Would run target: compile qstats driver
 Would run target: compile statfuncs
-Would run target: ensure version match
 """
 if out != expected:
     FAIL('sake force recon "compile objects" failed!')
@@ -351,10 +349,7 @@ passed('sake force recon "compile objects"')
 ##################################
 # force compile the four c files into objects
 out, err = run(SAKE_CMD + '  -F "compile objects"')
-expected = """The following targets share dependencies and must be run together:
-  - compile qstats driver
-  - ensure version match
-Running target compile graphfuncs
+expected = """Running target compile graphfuncs
 gcc -c -o graphfuncs.o graphfuncs.c -w -O2 -I./include
 Running target compile infuncs
 gcc -c -o infuncs.o infuncs.c -w -O2 -I./include
@@ -362,8 +357,6 @@ Running target compile qstats driver
 gcc -c -o qstats.o qstats.c -w -O2 -I./include
 Running target compile statfuncs
 gcc -c -o statfuncs.o statfuncs.c -w -O2 -I./include
-Running target ensure version match
-./ensure_version_match.sh
 Done
 """
 if out != expected:
@@ -390,14 +383,10 @@ passed("sake clean full")
 #  sake force recon "compile objects"  #
 ########################################
 out, err = run(SAKE_CMD + '  -F -r "compile objects"')
-expected = """The following targets share dependencies and must be run together:
-  - compile qstats driver
-  - ensure version match
-Would run target: compile graphfuncs
+expected = """Would run target: compile graphfuncs
 Would run target: compile infuncs
 Would run target: compile qstats driver
 Would run target: compile statfuncs
-Would run target: ensure version match
 """
 if out != expected:
     FAIL('sake force recon "compile objects" failed!')
@@ -409,10 +398,7 @@ passed('sake force recon "compile objects"')
 ##################################
 # force compile the four c files into objects
 out, err = run(SAKE_CMD + '  -F "compile objects"')
-expected = """The following targets share dependencies and must be run together:
-  - compile qstats driver
-  - ensure version match
-Running target compile graphfuncs
+expected = """Running target compile graphfuncs
 gcc -c -o graphfuncs.o graphfuncs.c -w -O2 -I./include
 Running target compile infuncs
 gcc -c -o infuncs.o infuncs.c -w -O2 -I./include
@@ -420,8 +406,7 @@ Running target compile qstats driver
 gcc -c -o qstats.o qstats.c -w -O2 -I./include
 Running target compile statfuncs
 gcc -c -o statfuncs.o statfuncs.c -w -O2 -I./include
-Running target ensure version match
-./ensure_version_match.sh
+Done
 """
 experr = """cat: qstats-documentation.html: No such file or directory
 ./ensure_version_match.sh: line 6: [: 1.0: unary operator expected
@@ -840,12 +825,18 @@ shutil.move("./BACKUPqstats.md", "./qstats.md")
 ####################
 out, err = run(SAKE_CMD + "  clean")
 out, err = run(SAKE_CMD + "  -p -q")
-expected = """Going to run these targets 'compile graphfuncs, compile infuncs, compile qstats driver, compile statfuncs' in parallel
-Going to run these targets 'build binary, generate html documentation' in parallel
-Going to run these targets 'ensure version match, output version text file, package it' in parallel
-Done
+expected = """Running target build binary
+Running target compile graphfuncs
+Running target compile infuncs
+Running target compile qstats driver
+Running target compile statfuncs
+Running target ensure version match
+Running target generate html documentation
+Running target output version text file
+Running target package it
 """
-if out != expected:
+lines = out.splitlines(True)
+if sorted(lines[:-1]) != expected.splitlines(True) or lines[-1:] != ["Done\n"]:
     FAIL("quiet parallel failed")
 passed("quiet parallel")
 
@@ -905,8 +896,19 @@ Command failed to run
 ##########################
 out, err = run(SAKE_CMD + "  clean")
 out, err = run(SAKE_CMD + "  -q -p")
-expected = "Going to run these targets 'compile graphfuncs, compile infuncs, compile qstats driver, compile statfuncs' in parallel\n"
-if out != expected:
+# the documentation doesn't wait for the objects (and the targets
+# that only depend on it may start, too), but nothing that needs
+# the broken object does
+expected = """Running target compile graphfuncs
+Running target compile infuncs
+Running target compile qstats driver
+Running target compile statfuncs
+Running target generate html documentation
+"""
+started = set(out.splitlines())
+if (not set(expected.splitlines()) <= started or
+    "Running target build binary" in started or
+    "Running target package it" in started):
     FAIL("quiet error parallel failed!")
 expected = """Target 'compile statfuncs' failed!
 A command failed to run
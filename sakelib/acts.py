@@ -44,19 +44,28 @@ Various actions that the main entry delegates to
 from __future__ import unicode_literals
 from __future__ import print_function
 from subprocess import Popen
+import argparse
 import codecs
 import collections
 import fnmatch
 import glob
 import io
 import itertools
+import json
 import networkx as nx
 import os
 import re
+import shutil
 import string
 import sys
 import yaml
 
+# if PyYAML was built with libyaml, use its (much faster) C loader
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 class PatternTemplate(string.Template):
     delimiter = "%"
@@ -126,7 +135,8 @@ def find_standard_sakefile(settings):
             sys.exit(1)
         return custom
     # no custom specified, going over defaults in order
-    for name in ["Sakefile", "Sakefile.yaml", "Sakefile.yml"]:
+    for name in ["Sakefile", "Sakefile.yaml", "Sakefile.yml",
+                 "Sakefile.json"]:
         if os.path.isfile(name):
             return name
     error("Error: there is no Sakefile to read")
@@ -134,8 +144,24 @@ def find_standard_sakefile(settings):
 
 
 def parse(file, text, includes):
+    if file.endswith(".json"):
+        # JSON Sakefiles can be read by the stdlib's C parser, once
+        # the lines of the macros and includes are blanked out (they
+        # aren't comments in JSON)
+        lines = ["" if line.startswith(("#!", "#<")) else line
+                 for line in text.split("\n")]
+        try:
+            sakefile = json.loads("\n".join(lines)) or {}
+        except ValueError as exc:
+            sys.stderr.write("Error: {} failed to parse as valid JSON\n".format(file))
+            if hasattr(exc, 'lineno'):
+                sys.stderr.write("Error near line {}\n".format(exc.lineno))
+            sys.exit(1)
+        for filename, (subdata, subincludes) in includes.items():
+            sakefile.update(parse(filename, subdata, subincludes))
+        return sakefile
     try:
-        sakefile = yaml.load(text, Loader=yaml.Loader) or {}
+        sakefile = yaml.load(text, Loader=SafeLoader) or {}
     except yaml.YAMLError as exc:
         sys.stderr.write("Error: {} failed to parse as valid YAML\n".format(file))
         if hasattr(exc, 'problem_mark'):
@@ -151,7 +177,9 @@ def clean_path(a_path, force_os=None, force_start=None):
     """
     This function is used to normalize the path (of an output or
     dependency) and also provide the path in relative form. It is
-    relative to the current working directory
+    relative to the current working directory (the root of the
+    project, where the .shastore is), so that the keys of the
+    .shastore don't depend on where the project is checked out
     """
     if not force_start:
         force_start = os.curdir
@@ -163,8 +191,16 @@ def clean_path(a_path, force_os=None, force_start=None):
         import posixpath
         return posixpath.relpath(posixpath.normpath(a_path),
                                 start=force_start)
-    return os.path.relpath(os.path.normpath(a_path),
-                          start=force_start)
+    relative = os.path.relpath(os.path.normpath(a_path),
+                               start=force_start)
+    # an absolute path into the project through a symlink (like
+    # the $PWD of a shell can be) is still inside the project
+    if os.path.isabs(a_path) and relative.split(os.sep)[0] == os.pardir:
+        real = os.path.relpath(os.path.realpath(a_path),
+                               start=os.path.realpath(force_start))
+        if real.split(os.sep)[0] != os.pardir:
+            return real
+    return relative
 
 
 def escp(target_name):
@@ -227,6 +263,88 @@ def get_help(sakefile):
     return full_string
 
 
+def parse_jobs(value):
+    """
+    Parses the argument of -j: a number of jobs, or "auto"
+    """
+    if value == "auto":
+        return value
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("expected a number of jobs " +
+                                         "or 'auto', got '{}'".format(value))
+    return jobs
+
+
+# what the suffixes of the amounts of resources (memory, mostly) mean
+RESOURCE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3,
+                  "t": 1024 ** 4}
+
+
+def parse_amount(amount):
+    """
+    Parses the amount of a resource: a non-negative number, optionally
+    followed by a K, M, G or T suffix (so memory can be declared as
+    "512M" or "60G")
+
+    Raises:
+        ValueError if the amount is malformed
+    """
+    if isinstance(amount, bool):
+        raise ValueError("'{}' is not an amount".format(amount))
+    if isinstance(amount, (int, float)):
+        number = float(amount)
+    else:
+        match = re.match(r"^\s*([0-9]*\.?[0-9]+)\s*([kmgt]?)i?b?\s*$",
+                         str(amount), re.IGNORECASE)
+        if not match:
+            raise ValueError("'{}' is not an amount".format(amount))
+        number = float(match.group(1))
+        number *= RESOURCE_UNITS[match.group(2).lower()]
+    if number < 0:
+        raise ValueError("'{}' is negative".format(amount))
+    return number
+
+
+def parse_resources(resources):
+    """
+    Parses the "resources" of a target: a mapping of the names of
+    resources (like cpus, memory or gpu-license) to the amounts of
+    them that its formula needs
+
+    Returns:
+        A dictionary of the names of the resources to their amounts
+
+    Raises:
+        ValueError if the resources are malformed
+    """
+    if not resources:
+        return {}
+    if not isinstance(resources, dict):
+        raise ValueError("expected a mapping of names to amounts")
+    return {str(name): parse_amount(amount)
+            for name, amount in resources.items()}
+
+
+def parse_capacities(value):
+    """
+    Parses the argument of --resources: what the host has of each
+    resource, like "cpus=16,memory=64G,gpu-license=2"
+    """
+    try:
+        pairs = [item.split("=", 1) for item in value.split(",") if item]
+        if any(len(pair) != 2 for pair in pairs):
+            raise ValueError("expected NAME=AMOUNT")
+        return parse_resources({name.strip(): amount
+                                for name, amount in pairs})
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError("bad resources '{}': {}".format(
+                                                              value, exc))
+
+
 def parse_defines(args):
     """
     This parses a list of define argument in the form of -DNAME=VALUE or -DNAME (
@@ -295,14 +413,62 @@ def expand_macros(raw_text, macros):
     return "\n".join(result), includes
 
 
-def check_for_dep_in_outputs(dep, verbose, G):
+# the characters that make fnmatch treat a dependency as a pattern
+GLOB_CHARS = re.compile(r"[*?[]")
+
+
+def index_outputs(G):
     """
-    Function to help construct_graph() identify dependencies
+    Indexes the outputs of every target so construct_graph() can look
+    dependencies up instead of scanning every output for each one
+
+    Args:
+        A (populated) NetworkX DiGraph
+
+    Returns:
+        A dictionary with the targets' order, the outputs by (normcased)
+        name, by directory (trailing separator stripped) and by each of
+        their parent directories, and a list of (target, output) pairs
+        for dependencies that are glob patterns
+    """
+    index = {"order": {}, "exact": {}, "dirs": {}, "parents": {},
+             "outputs": []}
+    for position, node in enumerate(G.nodes(data=True)):
+        index["order"][node[0]] = position
+        for out in node[1].get("output") or []:
+            index["outputs"].append((node[0], out))
+            index["exact"].setdefault(os.path.normcase(out),
+                                      []).append(node[0])
+            index["dirs"].setdefault(out.rstrip(os.sep), []).append(node[0])
+            for parent in parent_dirs(out):
+                index["parents"].setdefault(parent, []).append(node[0])
+    return index
+
+
+def parent_dirs(a_path):
+    """
+    Yields every prefix of the path supplied that ends right before
+    a separator (the directories path_contains() would match)
+    """
+    position = a_path.find(os.sep)
+    while position != -1:
+        yield a_path[:position]
+        position = a_path.find(os.sep, position + 1)
+
+
+def check_for_dep_in_outputs(dep, verbose, G, consumer=None, index=None):
+    """
+    Function to help construct_graph() identify dependencies.
+    A dependency inside an output directory, or a dependency that
+    is a directory with an output inside it, counts as well (unless
+    it's the consumer's own output)
 
     Args:
         A dependency
         A flag indication verbosity
         A (populated) NetworkX DiGraph
+        The name of the target that has the dependency (optional)
+        The graph's outputs from index_outputs() (optional)
 
     Returns:
         A list of targets that build given dependency
@@ -310,15 +476,31 @@ def check_for_dep_in_outputs(dep, verbose, G):
     """
     if verbose:
         print("checking dep {}".format(dep))
-    ret_list = []
-    for node in G.nodes(data=True):
-        if "output" not in node[1]:
-            continue
-        for out in node[1]['output']:
+    if index is None:
+        index = index_outputs(G)
+    matches = set()
+    if GLOB_CHARS.search(dep):
+        for name, out in index["outputs"]:
             if fnmatch.fnmatch(out, dep):
-                ret_list.append(node[0])
-                break
-    return ret_list
+                matches.add(name)
+    else:
+        matches.update(index["exact"].get(os.path.normcase(dep), []))
+    contained = index["parents"].get(dep.rstrip(os.sep), [])
+    for name in itertools.chain(contained,
+                                *(index["dirs"].get(parent, [])
+                                  for parent in parent_dirs(dep))):
+        if name != consumer:
+            matches.add(name)
+    return sorted(matches, key=index["order"].get)
+
+
+def path_contains(a_dir, a_path):
+    """
+    Returns True if the (normalized) path supplied is inside
+    the directory supplied. This is how dependencies and outputs
+    that are directories are linked to the files inside them
+    """
+    return a_path.startswith(a_dir.rstrip(os.sep) + os.sep)
 
 
 def get_patterns(dep):
@@ -404,56 +586,11 @@ def expand_patterns(name, target, settings):
                          "output": new_outputs,
                          "dependencies": new_deps,
                          "formula": new_formula}
+        if "resources" in target:
+            res[new_name]["resources"] = target["resources"]
     return res
 
 
-def get_ties(G):
-    """
-    If you specify a target that shares a dependency with another target,
-    both targets need to be updated. This is because running one will resolve
-    the sha mismatch and sake will think that the other one doesn't have to
-    run. This is called a "tie". This function will find such ties.
-    """
-    # we are going to make a dictionary whose keys are every dependency
-    # and whose values are a list of all targets that use that dependency.
-    # after making the dictionary, values whose length is above one will
-    # be called "ties"
-    ties = []
-    dep_dict = {}
-    for node in G.nodes(data=True):
-        if 'dependencies' in node[1]:
-            for item in node[1]['dependencies']:
-                if item not in dep_dict:
-                    dep_dict[item] = []
-                dep_dict[item].append(node[0])
-    for item in dep_dict:
-        if len(list(set(dep_dict[item]))) > 1:
-            ties.append(list(set(dep_dict[item])))
-    return ties
-
-
-def get_tied_targets(original_targets, the_ties):
-    """
-    This function gets called when a target is specified to ensure
-    that all 'tied' targets also get included in the subgraph to
-    be built
-    """
-    my_ties = []
-    for original_target in original_targets:
-        for item in the_ties:
-            if original_target in item:
-                for thing in item:
-                    my_ties.append(thing)
-    my_ties = list(set(my_ties))
-    if my_ties:
-        ties_message = ""
-        ties_message += "The following targets share dependencies and must be run together:"
-        for item in sorted(my_ties):
-            ties_message += "\n  - {}".format(item)
-        return list(set(my_ties+original_targets)), ties_message
-    return original_targets, ""
-
-
 def construct_graph(sakefile, settings):
     """
     Takes the sakefile dictionary and builds a NetworkX graph
@@ -504,12 +641,14 @@ def construct_graph(sakefile, settings):
             dep = os.path.normpath(dep)
             shrt = "dependencies"
             node[1]['dependencies'][index] = clean_path(node[1][shrt][index])
+    index = index_outputs(G)
     for node in G.nodes(data=True):
         connects = []
         if "dependencies" not in node[1]:
             continue
         for dep in node[1]['dependencies']:
-            matches = check_for_dep_in_outputs(dep, verbose, G)
+            matches = check_for_dep_in_outputs(dep, verbose, G, node[0],
+                                               index)
             if not matches:
                 continue
             for match in matches:
@@ -531,6 +670,10 @@ def get_all_outputs(node_dict):
     """
     outlist = []
     for item in node_dict['output']:
+        if not glob.has_magic(item):
+            # (globbing a plain path would only check that it exists)
+            outlist.append(item)
+            continue
         glist = glob.glob(item)
         if glist:
             for oneglob in glist:
@@ -546,6 +689,10 @@ def get_all_dependencies(node_dict):
     """
     deplist = []
     for item in node_dict['dependencies']:
+        if not glob.has_magic(item):
+            # (globbing a plain path would only check that it exists)
+            deplist.append(item)
+            continue
         glist = glob.glob(item)
         if glist:
             for oneglob in glist:
@@ -578,9 +725,25 @@ def clean_all(G, settings):
             for item in get_all_outputs(node[1]):
                 all_outputs.append(item)
     all_outputs.append(".shastore")
+    # (journals are only left behind by interrupted builds)
+    all_outputs.extend(glob.glob(".shastore.journal*"))
+    all_outputs.append(".shastore.lock")
     retcode = 0
     for item in sorted(all_outputs):
-        if os.path.isfile(item):
+        if os.path.isdir(item):
+            if recon:
+                sprint("Would remove directory: {}".format(item))
+                continue
+            sprint("Attempting to remove directory '{}'".format(item),
+                   level="verbose")
+            try:
+                shutil.rmtree(item)
+                sprint("Removed directory", level="verbose")
+            except:
+                errmes = "Error: directory '{}' failed to be removed"
+                error(errmes.format(item))
+                retcode = 1
+        elif os.path.isfile(item):
             if recon:
                 sprint("Would remove file: {}".format(item))
                 continue
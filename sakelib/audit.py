@@ -46,6 +46,8 @@ from __future__ import unicode_literals
 from __future__ import print_function
 import sys
 
+from . import acts
+
 
 def check_integrity(sakefile, settings):
     """
@@ -138,7 +140,8 @@ def check_target_integrity(key, values, meta=False, all=False, parent=None):
         return True
 
     # logic to audit any other target
-    expected_fields = ["dependencies", "help", "output", "formula"]
+    expected_fields = ["dependencies", "help", "output", "formula",
+                       "resources"]
     expected_fields = set(expected_fields)
     try:
         our_keys_set = set(values.keys())
@@ -162,4 +165,11 @@ def check_target_integrity(key, values, meta=False, all=False, parent=None):
     if "formula" not in values:
         sys.stderr.write("Target '{}' is missing formula\n".format(key))
         return False
+    # the resources it declares have to be amounts of something
+    try:
+        acts.parse_resources(values.get("resources"))
+    except ValueError as exc:
+        errmes = "Target '{}' has malformed resources: {}\n"
+        sys.stderr.write(errmes.format(key, exc))
+        return False
     return True
@@ -43,148 +43,1152 @@ dependency resolution
 
 from __future__ import unicode_literals
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import glob
 import hashlib
+import heapq
 import io
+import json
 import locale
-from multiprocessing import Pool
+import mmap
 import networkx as nx
 import os.path
 import shlex
+import signal
 from subprocess import Popen, PIPE
 import sys
-import yaml
+import tarfile
+import tempfile
+import time
 
 from . import acts
+from . import cache
 from . import constants
+from . import store
 
 
 # regrettably, we need a global here in order to get
-# parallel get_sha to work... multiprocessing.Pool needs
+# parallel get_sha to work... a process pool needs
 # to pickle the mapped function and cannot map closures
 # or partially applied functions
 ERROR_FN = sys.stderr.write
 
+# how many uploads to the remote cache can be in flight at once. They
+# run in the background (see save_to_cache()), so that the targets
+# that depend on the one that was uploaded don't wait for them
+UPLOAD_WORKERS = 4
 
-def check_shastore_version(from_store, settings):
+# the members of the tarballs made by `sake store export`
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_STORE = "shastore.json"
+
+# the fields of a file's stat identity that are recorded next
+# to its sha in the .shastore. If none of these changed, the
+# file is assumed to be unchanged and it isn't hashed again
+STAT_FIELDS = ("size", "mtime_ns", "inode", "ctime_ns")
+
+# files modified this recently (in nanoseconds) could still be
+# written to within the same mtime tick, so their stat identity
+# isn't recorded when they're hashed (it's taken again when the build
+# commits, see add_late_stats()). File systems with whole-second
+# timestamps need the long window, the ones with nanosecond timestamps
+# (which still only advance with the kernel's clock tick) the short one
+RACY_WINDOW = 2 * 10**9
+FINE_RACY_WINDOW = 5 * 10**7
+
+# the algorithms that can be used to fingerprint files, mapped to
+# the constructors of their hash objects. Every record in the
+# .shastore says which one was used (records without one are sha1)
+HASH_ALGORITHMS = {"sha1": hashlib.sha1,
+                   "blake2b": hashlib.blake2b,
+                   "blake2s": hashlib.blake2s}
+
+# if the user installed the `xxhash` module, its (much faster)
+# non-cryptographic hashes can be used, too
+try:
+    import xxhash
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
+    if hasattr(xxhash, "xxh3_64"):
+        HASH_ALGORITHMS["xxh3_64"] = xxhash.xxh3_64
+        HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+DEFAULT_ALGORITHM = "sha1"
+
+# hashlib releases the GIL while hashing large buffers, so these
+# algorithms are hashed with threads when the strategy is "auto"
+THREAD_SAFE_ALGORITHMS = ("sha1", "blake2b", "blake2s")
+
+# files smaller than this (in bytes) are batched together into
+# chunks of about CHUNK_SIZE bytes (but at most CHUNK_FILES files)
+# before they are sent to the hashing workers
+SMALL_FILE_SIZE = 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_FILES = 256
+
+# files at least this big (in bytes) are memory-mapped and hashed
+# without copying, and are dropped from the page cache as they are
+# hashed so they don't evict the files that running targets are using
+MMAP_MIN_SIZE = 64 * 1024 * 1024
+
+# how much of a memory-mapped file is hashed before the pages that
+# were already hashed are dropped from the page cache
+DROP_BEHIND_SIZE = 64 * 1024 * 1024
+
+# in tree hashing mode, files at least this big (in bytes) are split
+# into segments of TREE_SEGMENT_SIZE bytes that are hashed in parallel.
+# The file's hash is the hash of the digests of its segments, and its
+# record is tagged with the "tree:<segment size>" scheme. All other
+# files use the "flat" scheme (the hash of the whole content)
+TREE_HASH_MIN_SIZE = 1024 * 1024 * 1024
+TREE_SEGMENT_SIZE = 64 * 1024 * 1024
+FLAT_SCHEME = "flat"
+
+# directories are fingerprinted as Merkle trees: the hash of a
+# directory is the hash of the names and fingerprints of its entries.
+# Their records are tagged with this scheme
+MERKLE_SCHEME = "merkle"
+
+# when at least this many of the paths being looked at are in the
+# same directory, the types of the paths are read from one listing
+# of the directory instead of stat-ing them one by one
+SCANDIR_MIN_PATHS = 8
+
+# the threads that hash the segments of big files. Like ERROR_FN,
+# this is a global so that the hashing workers (which can be
+# processes) can get to it. It's a tuple of the pid of the process
+# that created it and the executor, so forked workers make their own
+SEGMENT_EXECUTOR = (None, None)
+
+# with -j auto, the number of formulas that may run at once starts at
+# the number of CPUs and is adapted (by one, at most every
+# LOAD_SAMPLE_INTERVAL seconds) to how busy the machine is: it goes
+# down while the CPUs are busier than AUTO_BUSY or more processes are
+# runnable than there are CPUs, and back up (to AUTO_MAX_JOBS_PER_CPU
+# per CPU) while they're less busy than AUTO_IDLE and aren't
+AUTO_BUSY = 0.9
+AUTO_IDLE = 0.7
+AUTO_MAX_JOBS_PER_CPU = 2
+LOAD_SAMPLE_INTERVAL = 0.5
+
+
+def migrate_shastore(G, shastore, settings):
     """
-    This function gives us the option to emit errors or warnings
-    after sake upgrades
+    Upgrades a .shastore that was written by an older version of
+    sake to the current format (see store.STORE_FORMAT), one format
+    at a time, so that upgrading sake doesn't throw the records away.
+    A .shastore of a newer format than this sake knows is fatal
+
+    Args:
+        The whole graph
+        The store object
+        The settings dictionary
     """
     sprint = settings["sprint"]
     error = settings["error"]
 
     sprint("checking .shastore version for potential incompatibilities",
            level="verbose")
-    if not from_store or 'sake version' not in from_store:
-        errmes = ["Since you've used this project last, a new version of ",
-                  "sake was installed that introduced backwards incompatible",
-                  " changes. Run 'sake clean', and rebuild before continuing\n"]
-        errmes = " ".join(errmes)
-        error(errmes)
+    found = store.get_format_version(shastore)
+    if found > store.STORE_FORMAT:
+        errmes = ["The .shastore was written by a newer version of sake",
+                  "(format {}, but this one only knows up to {}).".format(
+                      found, store.STORE_FORMAT),
+                  "Upgrade sake, or run 'sake clean' and rebuild\n"]
+        error(" ".join(errmes))
         sys.exit(1)
+    if found == store.STORE_FORMAT:
+        return
+    with store.locked(shastore.path):
+        # (unless another sake process just migrated it)
+        found = store.get_format_version(shastore)
+        while found < store.STORE_FORMAT:
+            sprint("Migrating the .shastore from format {} to {}".format(
+                   found, found + 1), level="verbose")
+            MIGRATORS[found](G, shastore, settings)
+            found += 1
+            shastore.set_meta('store format', str(found))
+
+
+def get_hash_algorithm(settings):
+    """
+    Returns the name of the hashing algorithm to fingerprint
+    files with. It can be chosen on the command line or in
+    the Sakefile. Unavailable algorithms fall back to the
+    default one (with a warning)
+    """
+    if not settings or not settings.get("hash_algorithm"):
+        return DEFAULT_ALGORITHM
+    algorithm = settings["hash_algorithm"]
+    if algorithm not in HASH_ALGORITHMS:
+        warnmes = "Hash algorithm '{}' is not available; using {}"
+        settings["warn"](warnmes.format(algorithm, DEFAULT_ALGORITHM))
+        settings["hash_algorithm"] = DEFAULT_ALGORITHM
+        return DEFAULT_ALGORITHM
+    return algorithm
+
+
+def get_record_algorithm(record):
+    """
+    Returns the name of the hashing algorithm that was used
+    to take the .shastore record supplied as an argument
+    """
+    return record.get("algorithm", DEFAULT_ALGORITHM)
+
+
+def get_record_scheme(record):
+    """
+    Returns the hashing scheme ("flat" or "tree:<segment size>")
+    of the .shastore record supplied as an argument
+    """
+    return record.get("scheme", FLAT_SCHEME)
+
+
+def get_record_kind(record):
+    """
+    Returns the kind of fingerprint of a .shastore record, which
+    is a tuple of its hashing algorithm and hashing scheme
+    """
+    return (get_record_algorithm(record), get_record_scheme(record))
+
+
+def get_hash_scheme(size, tree_hash):
+    """
+    Returns the hashing scheme for a file of the size supplied
+    """
+    if tree_hash and size >= TREE_HASH_MIN_SIZE:
+        return "tree:{}".format(TREE_SEGMENT_SIZE)
+    return FLAT_SCHEME
+
+
+def get_segment_size(scheme):
+    """
+    Returns the segment size of a tree hashing scheme, or None
+    if the scheme isn't a (valid) tree hashing scheme
+    """
+    if not scheme.startswith("tree:"):
+        return None
+    try:
+        segment_size = int(scheme[len("tree:"):])
+    except ValueError:
+        return None
+    if segment_size <= 0:
+        return None
+    return segment_size
 
 
-def get_sha(a_file, settings=None):
+def kind_available(kind):
     """
-    Returns sha1 hash of the file supplied as an argument
+    Returns True if fingerprints of the kind supplied can be taken
+    """
+    algorithm, scheme = kind
+    if algorithm not in HASH_ALGORITHMS:
+        return False
+    return scheme == FLAT_SCHEME or get_segment_size(scheme) is not None
+
+
+def same_fingerprint(record1, record2):
+    """
+    Returns True if two .shastore records have the same sha
+    taken with the same hashing algorithm and scheme
+    """
+    return (record1["sha"] == record2["sha"] and
+            get_record_kind(record1) == get_record_kind(record2))
+
+
+def get_shas(a_file, algorithms, settings=None):
+    """
+    Returns a list of the hashes of the file supplied as an argument,
+    one for each algorithm in the list supplied. The file is only
+    read once, no matter how many algorithms are used
     """
     if settings:
         error = settings["error"]
     else:
         error = ERROR_FN
     try:
-        BLOCKSIZE = 65536
-        hasher = hashlib.sha1()
+        hashers = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
         with io.open(a_file, "rb") as fh:
-            buf = fh.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = fh.read(BLOCKSIZE)
-        the_hash = hasher.hexdigest()
+            size = os.fstat(fh.fileno()).st_size
+            if size >= MMAP_MIN_SIZE:
+                hash_mapped_file(fh, size, hashers)
+            else:
+                hash_read_file(fh, size, hashers)
+        the_hashes = [hasher.hexdigest() for hasher in hashers]
     except IOError:
         errmes = "File '{}' could not be read! Exiting!".format(a_file)
         error(errmes)
         sys.exit(1)
     except:
-        errmes = "Unspecified error returning sha1 hash. Exiting!"
+        errmes = "Unspecified error returning hash. Exiting!"
+        error(errmes)
+        sys.exit(1)
+    return the_hashes
+
+
+def pick_blocksize(size):
+    """
+    Returns the size of the blocks (in bytes) to feed the hashers
+    with, for a file of the size supplied. Bigger files get bigger
+    blocks so there are fewer (slow) python-level iterations
+    """
+    if size < 1024 * 1024:
+        return 64 * 1024
+    if size < 64 * 1024 * 1024:
+        return 256 * 1024
+    if size < 1024 * 1024 * 1024:
+        return 1024 * 1024
+    return 4 * 1024 * 1024
+
+
+def advise(fh, offset, length, advice):
+    """
+    Gives the kernel advice about how (part of) a file will be read,
+    if the platform supports it. The advice is the name of one of
+    the POSIX_FADV_* constants of the os module
+    """
+    if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fh.fileno(), offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def hash_read_file(fh, size, hashers):
+    """
+    Feeds the content of an open file to a list of hashers by reading
+    it into a single reused buffer
+    """
+    buf = bytearray(pick_blocksize(size))
+    view = memoryview(buf)
+    nread = fh.readinto(buf)
+    while nread:
+        for hasher in hashers:
+            hasher.update(view[:nread])
+        nread = fh.readinto(buf)
+    view.release()
+
+
+def hash_mapped_file(fh, size, hashers):
+    """
+    Feeds the content of an open (big) file to a list of hashers by
+    memory-mapping it and hashing slices of the map without copying
+    them. The pages that were hashed are dropped from the page cache
+    as we go. Falls back to hash_read_file() if the file can't be
+    memory-mapped
+    """
+    try:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        hash_read_file(fh, size, hashers)
+        return
+    advise(fh, 0, 0, "POSIX_FADV_SEQUENTIAL")
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    blocksize = pick_blocksize(size)
+    dropped = 0
+    view = memoryview(mapped)
+    try:
+        for offset in range(0, size, blocksize):
+            end = min(offset + blocksize, size)
+            block = view[offset:end]
+            for hasher in hashers:
+                hasher.update(block)
+            block.release()
+            if end - dropped >= DROP_BEHIND_SIZE or end == size:
+                drop_pages(fh, mapped, dropped, end - dropped)
+                dropped = end
+    finally:
+        view.release()
+        mapped.close()
+
+
+def drop_pages(fh, mapped, offset, length):
+    """
+    Drops part of a memory-mapped file from both our mapping
+    and the page cache (where the platform supports it)
+    """
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+        try:
+            mapped.madvise(mmap.MADV_DONTNEED, offset, length)
+        except OSError:
+            pass
+    advise(fh, offset, length, "POSIX_FADV_DONTNEED")
+
+
+def get_sha(a_file, settings=None, algorithm=DEFAULT_ALGORITHM):
+    """
+    Returns hash (sha1, by default) of the file supplied as an argument
+    """
+    return get_shas(a_file, [algorithm], settings)[0]
+
+
+def get_segment_executor():
+    """
+    Returns the executor (of this process) that hashes the
+    segments of big files in tree hashing mode
+    """
+    global SEGMENT_EXECUTOR
+    pid, executor = SEGMENT_EXECUTOR
+    if pid != os.getpid():
+        executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        SEGMENT_EXECUTOR = (os.getpid(), executor)
+    return executor
+
+
+def hash_segment(a_file, offset, length, algorithm):
+    """
+    Returns the (binary) digest of a segment of a file
+    """
+    hasher = HASH_ALGORITHMS[algorithm]()
+    buf = bytearray(pick_blocksize(length))
+    view = memoryview(buf)
+    with io.open(a_file, "rb") as fh:
+        fh.seek(offset)
+        advise(fh, offset, length, "POSIX_FADV_SEQUENTIAL")
+        left = length
+        while left > 0:
+            nread = fh.readinto(view[:min(left, len(buf))])
+            if not nread:
+                break
+            hasher.update(view[:nread])
+            left -= nread
+        advise(fh, offset, length, "POSIX_FADV_DONTNEED")
+    view.release()
+    return hasher.digest()
+
+
+def get_tree_sha(a_file, algorithm, segment_size, settings=None):
+    """
+    Returns the tree hash of the file supplied as an argument. The file
+    is split into segments that are hashed in parallel and the hash
+    of the file is the hash of the digests of all of its segments
+    """
+    if settings:
+        error = settings["error"]
+    else:
+        error = ERROR_FN
+    try:
+        size = os.path.getsize(a_file)
+        executor = get_segment_executor()
+        futures = [executor.submit(hash_segment, a_file, offset,
+                                   segment_size, algorithm)
+                   for offset in range(0, size, segment_size)]
+        hasher = HASH_ALGORITHMS[algorithm]()
+        for future in futures:
+            hasher.update(future.result())
+        the_hash = hasher.hexdigest()
+    except (IOError, OSError):
+        errmes = "File '{}' could not be read! Exiting!".format(a_file)
         error(errmes)
         sys.exit(1)
     return the_hash
 
 
-def write_shas_to_shastore(sha_dict):
+def get_fingerprints(a_file, kinds, settings=None):
+    """
+    Returns a list of the hashes of the file supplied as an argument,
+    one for each kind of fingerprint (algorithm and scheme) in the
+    list supplied. All flat hashes are taken in a single read
+    """
+    flat = [algorithm for algorithm, scheme in kinds
+            if scheme == FLAT_SCHEME]
+    flat_shas = {}
+    if flat:
+        flat_shas = dict(zip(flat, get_shas(a_file, flat, settings)))
+    the_hashes = []
+    for algorithm, scheme in kinds:
+        if scheme == FLAT_SCHEME:
+            the_hashes.append(flat_shas[algorithm])
+        else:
+            the_hashes.append(get_tree_sha(a_file, algorithm,
+                                           get_segment_size(scheme),
+                                           settings))
+    return the_hashes
+
+
+def get_file_stats(a_file):
+    """
+    Returns the stat identity of the file supplied as an argument
+    as a dictionary, or None if it is too fresh to be trusted
+    """
+    st = os.stat(a_file)
+    if time.time_ns() - st.st_mtime_ns < get_racy_window(st.st_mtime_ns):
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "inode": st.st_ino, "ctime_ns": st.st_ctime_ns}
+
+
+def get_racy_window(mtime_ns):
+    """
+    Returns how long after it was modified the stat identity of a
+    file can be trusted, going by the precision of its mtime
+    """
+    if mtime_ns % 10**9:
+        return FINE_RACY_WINDOW
+    return RACY_WINDOW
+
+
+def add_late_stats(records, settings):
+    """
+    Adds the stat identity to the records of the files that were
+    hashed too soon after they were written (usually the outputs of
+    the targets that just ran), now that the build is over. That
+    only happens if they're the same files (according to the hash
+    memo) as when they were hashed, and after waiting out whatever
+    is left of the short racy window; files that are still too fresh
+    for the long one are hashed again next time
+
+    Args:
+        The dictionary of the records that the build is committing
+        The settings dictionary
+    """
+    memo = settings.get("hash_memo") or {}
+    fresh = {}
+    for path, record in records.items():
+        if "mtime_ns" in record or path not in memo:
+            continue
+        identity = get_memo_identity(path)
+        if identity and identity == memo[path][0]:
+            fresh[path] = identity
+    fine = [identity[1] for identity in fresh.values()
+            if get_racy_window(identity[1]) == FINE_RACY_WINDOW]
+    if fine:
+        wait = max(fine) + FINE_RACY_WINDOW - time.time_ns()
+        if wait > 0:
+            time.sleep(wait / 10**9)
+    for path, identity in fresh.items():
+        try:
+            stats = get_file_stats(path)
+        except OSError:
+            continue
+        if stats and (stats["size"], stats["mtime_ns"],
+                      stats["inode"]) == identity:
+            records[path].update(stats)
+
+
+def stats_match(record, stats):
     """
-    Writes a sha1 dictionary stored in memory to
-    the .shastore file
+    Returns True if the stat identity of a .shastore record
+    is the same as the one supplied as an argument
     """
-    if sys.version_info[0] < 3:
-        fn_open = open
+    if not record or not stats:
+        return False
+    for field in STAT_FIELDS:
+        if record.get(field) != stats[field]:
+            return False
+    return True
+
+
+def get_file_record(a_file, old_record=None, verify=False, settings=None,
+                    algorithm=None, tree_hash=None):
+    """
+    Returns the .shastore record of the file supplied as an argument.
+    This is a dictionary with the hash of the file, the algorithm and
+    scheme used, and the file's stat identity. If an old record is
+    supplied and the stat identity didn't change, the old sha is reused
+    and the file isn't read (unless verify is True).
+
+    If the old record was taken with another algorithm or scheme, the
+    file is hashed both ways. If its content didn't change, the old
+    record is migrated (in place) to the new kind of fingerprint so
+    the two still match
+    """
+    if not algorithm:
+        algorithm = get_hash_algorithm(settings)
+    if tree_hash is None:
+        tree_hash = settings and settings.get("tree_hash")
+    try:
+        stats = get_file_stats(a_file)
+    except OSError:
+        stats = None
+    if not verify and stats_match(old_record, stats):
+        record = {"sha": old_record["sha"],
+                  "algorithm": get_record_algorithm(old_record),
+                  "scheme": get_record_scheme(old_record)}
     else:
-        fn_open = io.open
-    with fn_open(".shastore", "w") as fh:
-        fh.write("---\n")
-        fh.write('sake version: {}\n'.format(constants.VERSION))
-        if sha_dict:
-            fh.write(yaml.dump(sha_dict))
-        fh.write("...")
+        try:
+            size = os.path.getsize(a_file)
+        except OSError:
+            size = 0
+        kind = (algorithm, get_hash_scheme(size, tree_hash))
+        old_kind = None
+        if old_record:
+            old_kind = get_record_kind(old_record)
+        if old_kind and old_kind != kind and kind_available(old_kind):
+            the_sha, old_sha = get_fingerprints(a_file, [kind, old_kind],
+                                                settings)
+            if old_sha == old_record["sha"]:
+                old_record["sha"] = the_sha
+                old_record["algorithm"], old_record["scheme"] = kind
+        else:
+            the_sha = get_fingerprints(a_file, [kind], settings)[0]
+        record = {"sha": the_sha, "algorithm": kind[0], "scheme": kind[1]}
+    if stats:
+        record.update(stats)
+    return record
 
 
-def take_shas_of_all_files(G, settings):
+def _take_records(jobs):
+    """
+    Wrapper around get_file_record() that takes a list (a chunk)
+    of tuples so that it can be sent to the hashing workers.
+    Since the old records may be migrated in a worker process,
+    they are returned, too
     """
-    Takes sha1 hash of all dependencies and outputs of all targets
+    results = []
+    for a_file, old_record, verify, algorithm, tree_hash in jobs:
+        record = get_file_record(a_file, old_record, verify,
+                                 algorithm=algorithm, tree_hash=tree_hash)
+        results.append((record, old_record))
+    return results
+
+
+def get_hash_executor(settings):
+    """
+    Returns the executor that hashes files for this build. It is
+    created the first time it's needed and then reused until
+    shutdown_hash_executor() is called. It uses threads or processes
+    (settings["hash_strategy"]) and settings["hash_workers"] workers
+    (default is one per core)
+    """
+    global ERROR_FN
+    if settings.get("hash_executor"):
+        return settings["hash_executor"]
+    sprint = settings["sprint"]
+    # forked worker processes need to report errors the same way
+    ERROR_FN = settings["error"]
+    workers = settings.get("hash_workers") or os.cpu_count() or 1
+    strategy = settings.get("hash_strategy") or "auto"
+    if strategy == "auto":
+        if get_hash_algorithm(settings) in THREAD_SAFE_ALGORITHMS:
+            strategy = "threads"
+        else:
+            strategy = "processes"
+    if strategy == "processes":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    out = "Hashing files with {} worker {}"
+    sprint(out.format(workers, strategy), level="verbose")
+    settings["hash_executor"] = executor
+    return executor
+
+
+def shutdown_hash_executor(settings):
+    """
+    Shuts down the executor that hashes files (if there is one)
+    """
+    if settings.get("hash_executor"):
+        settings["hash_executor"].shutdown()
+        settings["hash_executor"] = None
+
+
+def walk_directory(a_dir):
+    """
+    Returns a list of all of the files inside a directory (and
+    inside all of its subdirectories). Symbolic links to directories
+    are not followed
+    """
+    files = []
+    with os.scandir(a_dir) as it:
+        for entry in it:
+            path = os.path.join(a_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                files.extend(walk_directory(path))
+            elif entry.is_file():
+                files.append(path)
+    return files
+
+
+def classify_paths(paths):
+    """
+    Sorts a list of paths into the files and the directories that
+    exist (without duplicates and keeping their order). Paths that
+    share a parent directory are looked up in a single os.scandir
+    listing of it, so their types (usually) come straight from the
+    directory entries
 
     Args:
-        The graph we are going to build
+        The list of paths
+
+    Returns:
+        A tuple of the list of files and the list of directories
+    """
+    paths = list(dict.fromkeys(paths))
+    by_parent = {}
+    for path in paths:
+        parent, name = os.path.split(path)
+        by_parent.setdefault(parent, {})[name] = path
+    kinds = {}
+    for parent, names in by_parent.items():
+        listed = False
+        if len(names) >= SCANDIR_MIN_PATHS:
+            try:
+                with os.scandir(parent or ".") as it:
+                    for entry in it:
+                        if entry.name not in names:
+                            continue
+                        path = names[entry.name]
+                        if entry.is_dir():
+                            kinds[path] = "dir"
+                        elif entry.is_file():
+                            kinds[path] = "file"
+                        else:
+                            kinds[path] = None
+                listed = True
+            except OSError:
+                pass
+        for name, path in names.items():
+            # too few paths to list the directory (or names like
+            # "." that aren't in the listing)
+            if path in kinds or (listed and name not in ("", ".", "..")):
+                continue
+            if os.path.isdir(path):
+                kinds[path] = "dir"
+            elif os.path.isfile(path):
+                kinds[path] = "file"
+    files = [path for path in paths if kinds.get(path) == "file"]
+    dirs = [path for path in paths if kinds.get(path) == "dir"]
+    return files, dirs
+
+
+def get_directory_record(a_dir, records, old_records, settings):
+    """
+    Returns the .shastore record of a directory, which is fingerprinted
+    as a Merkle tree. The records of the subdirectories are put in the
+    records dictionary supplied (which must already have the records of
+    all of the files inside the directory).
+
+    The hash of a directory is only recomputed if the directory itself
+    changed (its stat identity) or if the fingerprint of one of its
+    entries did, so a change to a file only rehashes the directories on
+    the path from that file to the root
+    """
+    algorithm = get_hash_algorithm(settings)
+    lines = []
+    unchanged = True
+    with os.scandir(a_dir) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        path = os.path.join(a_dir, entry.name)
+        if entry.is_symlink() and entry.is_dir():
+            lines.append("l {} {}".format(os.readlink(path), entry.name))
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            records[path] = get_directory_record(path, records, old_records,
+                                                 settings)
+            kind = "d"
+        elif entry.is_file() and path in records:
+            kind = "f"
+        else:
+            continue
+        child = records[path]
+        old_child = old_records.get(path)
+        if not old_child or not same_fingerprint(child, old_child):
+            unchanged = False
+        lines.append("{} {}/{} {} {}".format(kind,
+                                             get_record_algorithm(child),
+                                             get_record_scheme(child),
+                                             child["sha"], entry.name))
+    try:
+        stats = get_file_stats(a_dir)
+    except OSError:
+        stats = None
+    old_record = old_records.get(a_dir)
+    unchanged = (unchanged and not settings.get("verify") and
+                 stats_match(old_record, stats))
+    kind = (algorithm, MERKLE_SCHEME)
+    if unchanged and get_record_kind(old_record) == kind:
+        the_sha = old_record["sha"]
+    else:
+        hasher = HASH_ALGORITHMS[algorithm]()
+        for line in lines:
+            hasher.update((line + "\n").encode("utf-8", "surrogateescape"))
+        the_sha = hasher.hexdigest()
+        if unchanged:
+            # same content, other algorithm
+            old_record["sha"] = the_sha
+            old_record["algorithm"], old_record["scheme"] = kind
+    record = {"sha": the_sha, "algorithm": algorithm,
+              "scheme": MERKLE_SCHEME}
+    if stats:
+        record.update(stats)
+    return record
+
+
+def take_records_of_paths(paths, settings, old_records, skip_missing=True):
+    """
+    Takes the .shastore records of a list of files and directories.
+    Everything inside the directories gets a record, too. Files that
+    were already fingerprinted in this build (and didn't change since)
+    come from the per-build hash memo, all others are hashed by the
+    hashing executor
+
+    Args:
+        The list of paths
         The settings dictionary
+        A dictionary of the old records of the files (they are
+          migrated in place if they were taken another way)
+        Whether paths that are neither files nor directories are
+          skipped (or treated as files that can't be read)
+
+    Returns:
+        A dictionary where the keys are the paths and the
+        values are the records
+    """
+    verify = settings.get("verify")
+    algorithm = get_hash_algorithm(settings)
+    tree_hash = settings.get("tree_hash")
+    memo = settings.get("hash_memo")
+    if memo is None:
+        memo = {}
+    files, dirs = classify_paths(paths)
+    if not skip_missing:
+        dir_set = set(dirs)
+        files = [path for path in dict.fromkeys(paths)
+                 if path not in dir_set]
+    for a_dir in dirs:
+        files.extend(walk_directory(a_dir))
+    records = {}
+    identities = {}
+    jobs = []
+    for fn in files:
+        if fn in identities:
+            continue
+        identities[fn] = get_memo_identity(fn)
+        if fn in memo and memo[fn][0] == identities[fn]:
+            records[fn] = dict(memo[fn][1])
+        else:
+            jobs.append((fn, old_records.get(fn), verify, algorithm,
+                         tree_hash))
+    results = take_records_of_these(jobs, settings)
+    for fn in results:
+        record, old_record = results[fn]
+        records[fn] = record
+        remember_record(fn, identities[fn], record, settings)
+        if old_record:
+            old_records[fn] = old_record
+    for a_dir in dirs:
+        if a_dir not in records:
+            records[a_dir] = get_directory_record(a_dir, records,
+                                                  old_records, settings)
+    return records
+
+
+def chunk_hashing_jobs(jobs):
+    """
+    Splits a list of hashing jobs into chunks to send to the
+    hashing workers. The biggest files come first (and each one
+    of them is a chunk of its own) so that long hashes start
+    early and don't straggle at the end. Small files are batched
+    so they don't pay the dispatching overhead one by one
+    """
+    sized = []
+    for job in jobs:
+        try:
+            size = os.path.getsize(job[0])
+        except OSError:
+            size = 0
+        sized.append((size, job))
+    sized.sort(key=lambda item: item[0], reverse=True)
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for size, job in sized:
+        if size >= SMALL_FILE_SIZE:
+            chunks.append([job])
+            continue
+        chunk.append(job)
+        chunk_size += size
+        if chunk_size >= CHUNK_SIZE or len(chunk) >= CHUNK_FILES:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def take_records_of_these(jobs, settings):
+    """
+    Takes the .shastore records of the files in the list of hashing
+    jobs supplied, using the hashing executor of the build
 
     Returns:
         A dictionary where the keys are the filenames and the
-        value is the sha1 hash
+        values are tuples of the new record and the (maybe migrated)
+        old record
+    """
+    executor = get_hash_executor(settings)
+    chunks = chunk_hashing_jobs(jobs)
+    futures = [executor.submit(_take_records, chunk) for chunk in chunks]
+    results = {}
+    for future, chunk in zip(futures, chunks):
+        for job, result in zip(chunk, future.result()):
+            results[job[0]] = result
+    return results
+
+
+def get_memoized_record(a_file, settings, old_record=None, verify=False):
+    """
+    Returns the .shastore record of the file supplied as an argument,
+    but only takes it (with get_file_record()) if the file wasn't
+    already fingerprinted in this build with the same stat identity.
+    The memo lives in settings["hash_memo"]
+    """
+    memo = settings.get("hash_memo")
+    identity = get_memo_identity(a_file)
+    if memo is not None and identity and a_file in memo:
+        memo_identity, record = memo[a_file]
+        if memo_identity == identity:
+            return dict(record)
+    record = get_file_record(a_file, old_record, verify, settings)
+    remember_record(a_file, identity, record, settings)
+    return record
+
+
+def get_memo_identity(a_file):
+    """
+    Returns the (size, mtime_ns, inode) identity of a file that
+    keys the per-build hash memo, or None if it can't be stat-ed
+    """
+    try:
+        st = os.stat(a_file)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def remember_record(a_file, identity, record, settings):
+    """
+    Puts the record of a file in the per-build hash memo
+    """
+    memo = settings.get("hash_memo")
+    if memo is not None and identity:
+        memo[a_file] = (identity, dict(record))
+
+
+def forget_records(files, settings):
+    """
+    Removes files from the per-build hash memo. This needs to
+    happen when the target that outputs them finishes because the
+    target could have rewritten them without changing their identity
+    """
+    memo = settings.get("hash_memo")
+    if memo is None:
+        return
+    for a_file in files:
+        memo.pop(a_file, None)
+
+
+def update_shas_of_target(target, node_dict, in_mem_shas, settings):
+    """
+    Updates the in-memory shas (and the .shastore journal) of the outputs
+    and dependencies of a target that just finished running, and
+    records the fingerprints of the inputs it was built against
+
+    Args:
+        The name of the target
+        The node dictionary of the target
+        The dictionary containing the in-memory sha store
+        The settings dictionary
+    """
+    paths = []
+    if "output" in node_dict:
+        outputs = acts.get_all_outputs(node_dict)
+        forget_records(outputs, settings)
+        for output in outputs:
+            if os.path.isdir(output):
+                forget_records(walk_directory(output), settings)
+        paths.extend(outputs)
+    deps = []
+    if "dependencies" in node_dict:
+        deps = acts.get_all_dependencies(node_dict)
+        paths.extend(deps)
+    if not paths:
+        return
+    records = take_records_of_paths(paths, settings, in_mem_shas['files'],
+                                    skip_missing=False)
+    in_mem_shas['files'].update(records)
+    inputs = {dep: get_input_fingerprint(records[dep]) for dep in deps
+              if dep in records}
+    in_mem_shas.setdefault('targets', {})[target] = inputs
+    # they go to the journal, and into the store at the end of the build
+    settings["journal"].append(records, {target: inputs})
+
+
+def get_input_fingerprint(record):
+    """
+    Returns the part of a .shastore record that a target keeps
+    for each of its inputs (the sha and how it was taken)
+    """
+    return {"sha": record["sha"], "algorithm": get_record_algorithm(record),
+            "scheme": get_record_scheme(record)}
+
+
+def same_input(expected, record, original, migrated):
+    """
+    Returns True if a file still has the fingerprint a target
+    recorded for it. If the fingerprint was taken another way (with
+    another hashing algorithm or scheme), it's compared to the record
+    the .shastore had before the file was hashed. That record is
+    migrated in place only if the file didn't change
+
+    Args:
+        The fingerprint the target recorded
+        The current record of the file
+        The record the .shastore had before the file was hashed
+        That record after the file was hashed
+    """
+    if get_record_kind(expected) == get_record_kind(record):
+        return same_fingerprint(expected, record)
+    if not original or not migrated:
+        return False
+    return (same_fingerprint(expected, original) and
+            same_fingerprint(record, migrated))
+
+
+def drop_unversioned_records(G, shastore, settings):
+    """
+    Migrates a .shastore of format 0 to format 1. Of the stores from
+    before sake stamped its version in them, only the records that
+    are plain SHA1s of files are kept; the rest are dropped (so the
+    targets that depended on them just run again)
+
+    Args:
+        The whole graph
+        The store object
+        The settings dictionary
+    """
+    def is_sha_record(record):
+        return (isinstance(record, dict) and
+                isinstance(record.get("sha"), str) and
+                len(record["sha"]) == 40)
+
+    bad_paths = [path for path, record in shastore.get_all().items()
+                 if not is_sha_record(record)]
+    if bad_paths:
+        shastore.remove(bad_paths)
+
+
+def record_legacy_inputs(G, shastore, settings):
+    """
+    Migrates a .shastore of format 1 to format 2. Those stores only
+    hold one record per file, so each target of the (whole) graph
+    takes those records as the fingerprints of the inputs it was last
+    built against. (The records themselves gain a stat identity the
+    next time their files are looked at)
+
+    Args:
+        The whole graph
+        The store object
+        The settings dictionary
     """
-    global ERROR_FN
     sprint = settings["sprint"]
-    error = settings["error"]
-    ERROR_FN = error
-    sha_dict = {}
-    all_files = []
+    sprint("Recording the inputs of the targets in the .shastore",
+           level="verbose")
+    targets = {}
+    for name, node_dict in G.nodes(data=True):
+        if 'dependencies' not in node_dict:
+            continue
+        records = {dep: shastore.get(dep)
+                   for dep in node_dict['dependencies']}
+        if all(records.values()):
+            targets[name] = {dep: get_input_fingerprint(record)
+                             for dep, record in records.items()}
+    shastore.update({}, targets)
+
+
+# MIGRATORS[n] upgrades a .shastore of format n to format n + 1
+MIGRATORS = {0: drop_unversioned_records,
+             1: record_legacy_inputs}
+
+
+def collect_all_files(G, settings):
+    """
+    Gathers the dependencies (with their globs expanded) and the
+    outputs of all of the targets of a graph
+
+    Args:
+        The graph we are going to build
+        The settings dictionary
+
+    Returns:
+        A list of the paths, without duplicates
+    """
+    sprint = settings["sprint"]
+    # a dict (instead of a list) keeps the order and de-dupes in O(1)
+    all_files = {}
     for target in G.nodes(data=True):
         sprint("About to take shas of files in target '{}'".format(target[0]),
                level="verbose")
         if 'dependencies' in target[1]:
             sprint("It has dependencies", level="verbose")
-            deplist = []
-            for dep in target[1]['dependencies']:
-                glist = glob.glob(dep)
-                if glist:
-                    for oneglob in glist:
-                        deplist.append(oneglob)
-                else:
-                    deplist.append(dep)
-            target[1]['dependencies'] = list(deplist)
+            target[1]['dependencies'] = acts.get_all_dependencies(target[1])
             for dep in target[1]['dependencies']:
                 sprint("  - {}".format(dep), level="verbose")
-                all_files.append(dep)
+                all_files[dep] = None
         if 'output' in target[1]:
             sprint("It has outputs", level="verbose")
             for out in acts.get_all_outputs(target[1]):
                 sprint("  - {}".format(out), level="verbose")
-                all_files.append(out)
-    if len(all_files):
-        sha_dict['files'] = {}
-        # check if files exist and de-dupe
-        extant_files = []
-        for item in all_files:
-            if item not in extant_files and os.path.isfile(item):
-                extant_files.append(item)
-        pool = Pool()
-        results = pool.map(get_sha, extant_files)
-        pool.close()
-        pool.join()
-        for fn, sha in zip(extant_files, results):
-            sha_dict['files'][fn] = {'sha': sha}
-        return sha_dict
-    sprint("No dependencies", level="verbose")
+                all_files[out] = None
+    return list(all_files)
+
+
+def get_paths_of_graph(G):
+    """
+    Returns the dependencies and the outputs of all of the targets
+    of a graph whose dependency globs were already expanded (like
+    collect_all_files(), but without saying so)
+    """
+    paths = set()
+    for target in G.nodes(data=True):
+        paths.update(target[1].get('dependencies') or [])
+        if 'output' in target[1]:
+            paths.update(acts.get_all_outputs(target[1]))
+    return paths
+
+
+def stamp_last_seen(G, shastore):
+    """
+    Records that this build saw all of the paths and targets of the
+    graph, but only rewrites the times that are missing or older
+    than store.SEEN_REFRESH seconds
+
+    Args:
+        A graph whose dependency globs were already expanded
+        The store object
+
+    Returns:
+        A tuple of the number of paths and the number of targets
+        whose times were written
+    """
+    now = time.time()
+    seen_files, seen_targets = shastore.get_last_seen()
+
+    def is_stale(seen, name):
+        return now - seen.get(name, 0) > store.SEEN_REFRESH
+
+    paths = {path: now for path in get_paths_of_graph(G)
+             if is_stale(seen_files, path)}
+    targets = {name: now for name in G.nodes()
+               if is_stale(seen_targets, name)}
+    if paths or targets:
+        shastore.set_last_seen(paths, targets)
+    return len(paths), len(targets)
+
+
+def expand_dependency_globs(G):
+    """
+    Replaces the globs in the dependencies of all of the targets
+    of the graph with the files that they match
+    """
+    for target in G.nodes(data=True):
+        if 'dependencies' in target[1]:
+            target[1]['dependencies'] = acts.get_all_dependencies(target[1])
 
 
 def needs_to_run(G, target, in_mem_shas, from_store, settings):
@@ -193,6 +1197,11 @@ def needs_to_run(G, target, in_mem_shas, from_store, settings):
     (a) If a dependency of the target has changed
     (b) If an output of the target is missing
 
+    Files are fingerprinted lazily, only when they are needed to make
+    the decision: everything that can be decided without hashing is
+    checked first, and the remaining dependencies are fingerprinted
+    in small batches (in parallel) until the first mismatch
+
     Args:
         The graph we are going to build
         The name of the target
@@ -214,7 +1223,7 @@ def needs_to_run(G, target, in_mem_shas, from_store, settings):
     node_dict = get_the_node_dict(G, target)
     if 'output' in node_dict:
         for output in acts.get_all_outputs(node_dict):
-            if not os.path.isfile(output):
+            if not os.path.exists(output):
                 outstr = "Output file '{}' is missing so it needs to run"
                 sprint(outstr.format(output), level="verbose")
                 return True
@@ -223,51 +1232,109 @@ def needs_to_run(G, target, in_mem_shas, from_store, settings):
         sprint("Target {} has no dependencies and needs to run".format(target),
                level="verbose")
         return True
-    for dep in node_dict['dependencies']:
-        # because the shas are updated after all targets build,
-        # its possible that the dependency's sha doesn't exist
-        # in the current "in_mem" dictionary. If this is the case,
-        # then the target needs to run
-        if ('files' in in_mem_shas and dep not in in_mem_shas['files'] or
-            'files' not in in_mem_shas):
-            outstr = "Dep '{}' doesn't exist in memory so it needs to run"
-            sprint(outstr.format(dep), level="verbose")
-            return True
-        now_sha = in_mem_shas['files'][dep]['sha']
-        if ('files' in from_store and dep not in from_store['files'] or
-            'files' not in from_store):
+    deps = node_dict['dependencies']
+    mem_files = in_mem_shas.setdefault('files', {})
+    originals = in_mem_shas.setdefault('originals', {})
+    store_files = from_store.get('files') or {}
+    # the fingerprints of the inputs the target was last built against.
+    # Targets that were never built by this version of sake fall back
+    # to the records of the files
+    inputs = (from_store.get('targets') or {}).get(target)
+    expected = store_files if inputs is None else inputs
+    for dep in deps:
+        if dep not in expected:
             outst = "Dep '{}' doesn't exist in shastore so it needs to run"
             sprint(outst.format(dep), level="verbose")
             return True
-        old_sha = from_store['files'][dep]['sha']
-        if now_sha != old_sha:
-            outstr = "There's a mismatch for dep {} so it needs to run"
+        if dep not in mem_files and not os.path.exists(dep):
+            outstr = "Dep '{}' doesn't exist so it needs to run"
             sprint(outstr.format(dep), level="verbose")
             return True
+
+    def changed(dep):
+        if same_input(expected[dep], mem_files[dep], originals.get(dep),
+                      store_files.get(dep)):
+            return False
+        outstr = "There's a mismatch for dep {} so it needs to run"
+        sprint(outstr.format(dep), level="verbose")
+        return True
+
+    # the deps that were already fingerprinted in this build
+    pending = []
+    for dep in deps:
+        if dep not in mem_files:
+            pending.append(dep)
+        elif changed(dep):
+            return True
+    # and the rest, a batch (one file per hashing worker) at a time
+    batch_size = settings.get("hash_workers") or os.cpu_count() or 1
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start+batch_size]
+        for dep in batch:
+            if dep not in originals and store_files.get(dep):
+                originals[dep] = dict(store_files[dep])
+        records = take_records_of_paths(batch, settings, store_files)
+        mem_files.update(records)
+        for dep in batch:
+            if dep not in records or changed(dep):
+                return True
+    if inputs is None:
+        # from now on, the target has its own fingerprints
+        in_mem_shas.setdefault('targets', {})[target] = {
+            dep: get_input_fingerprint(mem_files[dep]) for dep in deps}
     sprint("Target '{}' doesn't need to run".format(target), level="verbose")
     return False
 
 
+def get_shell_command(commands, settings):
+    """
+    Returns the arguments and the executable to run the commands of
+    a formula with (with Popen(..., shell=True)): the custom shell of
+    the Sakefile, if there is one, with "-e" for enhanced errors
+
+    Args:
+        the commands to run
+        The settings dictionary
+    """
+    enhanced_errors = True
+    the_shell = None
+    if settings["no_enhanced_errors"]:
+        enhanced_errors = False
+    if "shell" in settings:
+        the_shell = settings["shell"]
+    windows_p = sys.platform == "win32"
+
+    if the_shell:
+        tmp = shlex.split(the_shell)
+        the_shell = tmp[0]
+        tmp = tmp[1:]
+        if enhanced_errors and not windows_p:
+            tmp.append("-e")
+        tmp.append(commands)
+        commands = tmp
+    else:
+        if enhanced_errors and not windows_p:
+            commands = ["-e", commands]
+    return commands, the_shell
+
+
 def run_commands(commands, settings):
     """
     Runs the commands supplied as an argument
     It will exit the program if the commands return a
-    non-zero code
+    non-zero code (unless sake is told to keep going)
 
     Args:
         the commands to run
         The settings dictionary
+
+    Returns:
+        True if the commands succeeded
+        False if not (only with --keep-going)
     """
     sprint = settings["sprint"]
     quiet = settings["quiet"]
     error = settings["error"]
-    enhanced_errors = True
-    the_shell = None
-    if settings["no_enhanced_errors"]:
-        enhanced_errors = False
-    if "shell" in settings:
-        the_shell = settings["shell"]
-    windows_p = sys.platform == "win32"
 
     STDOUT = None
     STDERR = None
@@ -280,18 +1347,7 @@ def run_commands(commands, settings):
     if not quiet:
         sprint(commands)
 
-    if the_shell:
-        tmp = shlex.split(the_shell)
-        the_shell = tmp[0]
-        tmp = tmp[1:]
-        if enhanced_errors and not windows_p:
-            tmp.append("-e")
-        tmp.append(commands)
-        commands = tmp
-    else:
-        if enhanced_errors and not windows_p:
-            commands = ["-e", commands]
-
+    commands, the_shell = get_shell_command(commands, settings)
     p = Popen(commands, shell=True, stdout=STDOUT, stderr=STDERR,
               executable=the_shell)
     out, err = p.communicate()
@@ -299,7 +1355,11 @@ def run_commands(commands, settings):
         if quiet:
             error(err.decode(locale.getpreferredencoding()))
         error("Command failed to run")
+        if settings.get("keep_going"):
+            return False
+        finish_uploads(settings)
         sys.exit(1)
+    return True
 
 
 def run_the_target(G, target, settings):
@@ -311,11 +1371,153 @@ def run_the_target(G, target, settings):
         The graph we are going to build
         The target to run
         The settings dictionary
+
+    Returns:
+        True if the formula succeeded
+        False if not (only with --keep-going)
     """
     sprint = settings["sprint"]
     sprint("Running target {}".format(target))
     the_formula = get_the_node_dict(G, target)["formula"]
-    run_commands(the_formula, settings)
+    return run_commands(the_formula, settings)
+
+
+def get_action_key(G, target, in_mem_shas, from_store, settings):
+    """
+    Returns the key of the action of a target in the action cache
+    (see cache.get_action_key()), or None if it can't be cached:
+    if there's no cache directory, if the target doesn't have both
+    dependencies and outputs, or if one of its dependencies is missing
+
+    Args:
+        The graph we are going to build
+        The name of the target
+        The dictionary of the current shas held in memory
+        The dictionary of the shas from the shastore
+        The settings dictionary
+    """
+    if not settings.get("cache_dir"):
+        return None
+    node_dict = get_the_node_dict(G, target)
+    if 'dependencies' not in node_dict or 'output' not in node_dict:
+        return None
+    deps = node_dict['dependencies']
+    mem_files = in_mem_shas['files']
+    missing = [dep for dep in deps if dep not in mem_files]
+    if missing:
+        mem_files.update(take_records_of_paths(missing, settings,
+                                               from_store.get('files') or {}))
+    if any(dep not in mem_files for dep in deps):
+        return None
+    inputs = {dep: get_input_fingerprint(mem_files[dep]) for dep in deps}
+    return cache.get_action_key(node_dict, inputs, settings)
+
+
+def restore_from_cache(G, target, key, in_mem_shas, settings):
+    """
+    Restores the outputs of a target from the action cache (and
+    updates their shas) if its action was run before. Rebuilds that
+    are forced never restore anything (but they're still saved)
+
+    Returns:
+        True if the target was restored
+    """
+    sprint = settings["sprint"]
+    if not key or settings["force"]:
+        return False
+    node_dict = get_the_node_dict(G, target)
+    outputs = acts.get_all_outputs(node_dict)
+    if not cache.restore_outputs(settings["cache_dir"], key, outputs,
+                                 settings.get("remote_cache")):
+        return False
+    sprint("Restoring target {} from the cache".format(target))
+    update_shas_of_target(target, node_dict, in_mem_shas, settings)
+    return True
+
+
+def prepare_outputs(G, target, settings):
+    """
+    Outputs that were restored from the cache may be hardlinks to
+    its blobs, which have to be broken before the formula runs
+    """
+    node_dict = get_the_node_dict(G, target)
+    if settings.get("cache_dir") and 'output' in node_dict:
+        cache.break_hardlinks(acts.get_all_outputs(node_dict))
+
+
+def save_to_cache(G, target, key, settings):
+    """
+    Stores the outputs of a target that just ran in the action cache
+    (and starts uploading them to the remote cache in the background,
+    if there is one; see finish_uploads())
+    """
+    if not key:
+        return
+    node_dict = get_the_node_dict(G, target)
+    if not cache.save_outputs(settings["cache_dir"], key,
+                              acts.get_all_outputs(node_dict)):
+        return
+    remote = settings.get("remote_cache")
+    if remote:
+        if not settings.get("upload_executor"):
+            settings["upload_executor"] = ThreadPoolExecutor(
+                max_workers=UPLOAD_WORKERS)
+            settings["uploads"] = []
+        upload = settings["upload_executor"].submit(
+            cache.upload_outputs, settings["cache_dir"], key, remote)
+        settings["uploads"].append((target, upload))
+
+
+def finish_uploads(settings):
+    """
+    Waits for the uploads to the remote cache that save_to_cache()
+    started (warning about the ones that failed), and shuts down
+    the executor that runs them
+    """
+    warn = settings["warn"]
+    if not settings.get("upload_executor"):
+        return
+    for target, upload in settings["uploads"]:
+        try:
+            uploaded = upload.result()
+        except Exception:
+            uploaded = False
+        if not uploaded:
+            warn("Couldn't upload target '{}' to the remote cache".format(
+                 target))
+    settings["upload_executor"].shutdown()
+    settings["upload_executor"] = None
+    settings["uploads"] = []
+
+
+def run_or_restore_target(G, target, in_mem_shas, from_store, settings):
+    """
+    Runs a target (and updates the shas of its files), unless
+    its outputs can be restored from the action cache
+
+    Args:
+        The graph we are going to build
+        The name of the target
+        The dictionary of the current shas held in memory
+        The dictionary of the shas from the shastore
+        The settings dictionary
+
+    Returns:
+        True if the target was built (or restored)
+        False if its formula failed (only with --keep-going)
+    """
+    key = get_action_key(G, target, in_mem_shas, from_store, settings)
+    if restore_from_cache(G, target, key, in_mem_shas, settings):
+        return True
+    prepare_outputs(G, target, settings)
+    start = time.time()
+    if not run_the_target(G, target, settings):
+        return False
+    in_mem_shas.setdefault('durations', {})[target] = time.time() - start
+    node_dict = get_the_node_dict(G, target)
+    update_shas_of_target(target, node_dict, in_mem_shas, settings)
+    save_to_cache(G, target, key, settings)
+    return True
 
 
 def get_the_node_dict(G, name):
@@ -402,112 +1604,696 @@ def parallel_sort(G):
     return remove_redundancies(levels)
 
 
-def parallel_run_these(G, list_of_targets, in_mem_shas, from_store,
-                       settings, dont_update_shas_of):
+def get_exit_code(status):
+    """
+    Returns the exit code (or the negated signal) of a
+    wait status, like Popen.returncode
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_for_any(running, timeout=None):
+    """
+    Waits for whichever of the running formulas finishes first
+
+    Args:
+        A dictionary of the running processes (keyed by their pids)
+        An optional number of seconds to wait at most
+
+    Returns:
+        The pid of the process that finished and its exit code
+        (or None and None if none did in time)
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    while True:
+        if sys.platform != "win32":
+            flags = 0 if deadline is None else os.WNOHANG
+            pid, status = os.waitpid(-1, flags)
+            # (children that aren't formulas, like the hashing
+            # workers, only exit if they died anyway)
+            if pid in running:
+                running[pid].returncode = get_exit_code(status)
+                return pid, running[pid].returncode
+            if pid and deadline is None:
+                continue
+        else:
+            # Windows can't wait for any child, so they are polled
+            for pid, process in running.items():
+                if process.poll() is not None:
+                    return pid, process.returncode
+        if deadline is not None and time.time() >= deadline:
+            return None, None
+        time.sleep(0.01)
+
+
+def get_load_average():
+    """
+    Returns the 1-minute load average of the machine (or None
+    where it isn't available)
+    """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def get_cpu_times():
+    """
+    Returns the busy and total times of all of the CPUs since boot
+    (from /proc/stat), or None where they aren't available
+    """
+    try:
+        with io.open("/proc/stat", "r") as fh:
+            fields = [int(field) for field in fh.readline().split()[1:]]
+    except (IOError, OSError, ValueError):
+        return None
+    # (idle and iowait are the only times the CPUs weren't busy)
+    idle = sum(fields[3:5])
+    return sum(fields) - idle, sum(fields)
+
+
+def get_run_queue_length():
+    """
+    Returns the number of runnable processes (from /proc/loadavg),
+    or the load average where that isn't available
+    """
+    try:
+        with io.open("/proc/loadavg", "r") as fh:
+            running = fh.read().split()[3].split("/")[0]
+        # (not counting the one that's reading it)
+        return int(running) - 1
+    except (IOError, OSError, ValueError, IndexError):
+        return get_load_average()
+
+
+def adapt_auto_jobs(settings):
+    """
+    Adapts the number of formulas that -j auto lets run at once
+    (settings["auto_jobs"]) to the measured CPU utilization and
+    run-queue length, once every LOAD_SAMPLE_INTERVAL seconds
+
+    Returns:
+        The number of formulas that may run at once
+    """
+    cpus = os.cpu_count() or 1
+    now = time.time()
+    last_time, last_times = settings.get("cpu_sample") or (None, None)
+    if "auto_jobs" not in settings:
+        settings["auto_jobs"] = cpus
+    if last_time is not None and now - last_time < LOAD_SAMPLE_INTERVAL:
+        return settings["auto_jobs"]
+    times = get_cpu_times()
+    settings["cpu_sample"] = (now, times)
+    utilization = None
+    if times and last_times and times[1] > last_times[1]:
+        utilization = ((times[0] - last_times[0]) /
+                       float(times[1] - last_times[1]))
+    run_queue = get_run_queue_length()
+    if run_queue is None and utilization is None:
+        return settings["auto_jobs"]
+    busy = ((utilization is not None and utilization > AUTO_BUSY) or
+            (run_queue is not None and run_queue > cpus))
+    idle = ((utilization is None or utilization < AUTO_IDLE) and
+            (run_queue is None or run_queue < cpus))
+    if busy:
+        settings["auto_jobs"] = max(1, settings["auto_jobs"] - 1)
+    elif idle:
+        settings["auto_jobs"] = min(AUTO_MAX_JOBS_PER_CPU * cpus,
+                                    settings["auto_jobs"] + 1)
+    return settings["auto_jobs"]
+
+
+def can_start_another(running, settings):
+    """
+    Returns True if the parallel executor can start another formula:
+    fewer than -j are running (with -j auto, as many as the load of
+    the machine allows), and the load average is below --load-average.
+    With nothing running, there's always room for one
+
+    Args:
+        The number of formulas that are running
+        The settings dictionary
+    """
+    if not running:
+        return True
+    jobs = settings.get("jobs")
+    if jobs == "auto":
+        jobs = adapt_auto_jobs(settings)
+    if jobs and running >= jobs:
+        return False
+    max_load = settings.get("load_average")
+    if max_load:
+        load = get_load_average()
+        if load is not None and load >= max_load:
+            return False
+    return True
+
+
+def get_host_capacities(settings):
+    """
+    Returns what the host has of each resource that targets can
+    declare: its CPUs and its physical memory (where that can be
+    found out), and whatever --resources says, which takes
+    precedence and is the only way to declare named pools (like
+    licenses or GPUs)
+
+    Args:
+        The settings dictionary
+    """
+    capacities = {"cpus": float(os.cpu_count() or 1)}
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        capacities["memory"] = float(memory)
+    except (AttributeError, ValueError, OSError):
+        pass
+    capacities.update(settings.get("resources") or {})
+    return capacities
+
+
+def get_resource_needs(G, capacities, settings):
+    """
+    Returns the resources that the formula of each target needs,
+    going by the "resources" it declares in the Sakefile. A target
+    that declares none needs none (and is only held back by -j and
+    -l). A target can't need a named pool that the host doesn't
+    have, and a target that needs more of something than the host
+    has is only run when nothing else is
+
+    Args:
+        The graph we are going to build
+        The capacities of the host (from get_host_capacities())
+        The settings dictionary
+    """
+    warn = settings["warn"]
+    error = settings["error"]
+    needs = {}
+    for target, node_dict in G.nodes(data=True):
+        try:
+            wanted = acts.parse_resources(node_dict.get("resources"))
+        except ValueError as exc:
+            error("Target '{}' has malformed resources: {}".format(target,
+                                                                    exc))
+            sys.exit(1)
+        for name, amount in sorted(wanted.items()):
+            if name not in capacities:
+                if name in ("cpus", "memory"):
+                    continue
+                errmes = "Target '{}' needs '{}', which --resources "
+                errmes += "doesn't declare"
+                error(errmes.format(target, name))
+                sys.exit(1)
+            if amount > capacities[name]:
+                outstr = "Target '{}' needs more '{}' than the host has, "
+                outstr += "so it will run alone"
+                warn(outstr.format(target, name))
+        needs[target] = {name: amount for name, amount in wanted.items()
+                         if name in capacities}
+    return needs
+
+
+def resources_fit(needs, in_use, capacities):
+    """
+    Returns True if there's enough left of every resource that a
+    formula needs, given what the running formulas are using
+    """
+    return all(in_use.get(name, 0) + amount <= capacities[name]
+               for name, amount in needs.items())
+
+
+def start_the_target(G, target, settings):
+    """
+    Starts the formula of a target without waiting for it (the
+    parallel equivalent of run_the_target()). In quiet mode, its
+    output goes to temporary files instead of pipes, which nobody
+    reads while it runs. With --fail-fast, every formula gets a
+    process group of its own (on POSIX), so that it can be stopped
+    along with whatever it started (see stop_the_targets())
+
+    Returns:
+        The process and the file its stderr goes to (or None)
+    """
+    sprint = settings["sprint"]
+    sprint("Running target {}".format(target))
+    commands = get_the_node_dict(G, target)["formula"].rstrip()
+    sprint("About to run commands '{}'".format(commands), level="verbose")
+    commands, the_shell = get_shell_command(commands, settings)
+    own_group = bool(settings.get("fail_fast")) and sys.platform != "win32"
+    if not settings["quiet"]:
+        # (so that what sake printed comes before what the formula prints)
+        sys.stdout.flush()
+        return Popen(commands, shell=True, executable=the_shell,
+                     start_new_session=own_group), None
+    err = tempfile.TemporaryFile()
+    with open(os.devnull, "w") as devnull:
+        process = Popen(commands, shell=True, stdout=devnull, stderr=err,
+                        executable=the_shell, start_new_session=own_group)
+    return process, err
+
+
+def stop_the_targets(running, settings):
+    """
+    Sends SIGTERM to the formulas that are running (to their whole
+    process groups, if they have their own), so that they free the
+    machine right away
+
+    Args:
+        The running processes, keyed by their pids
+        The settings dictionary
+    """
+    for pid, process in running.items():
+        try:
+            if settings.get("fail_fast") and sys.platform != "win32":
+                os.killpg(pid, signal.SIGTERM)
+            else:
+                process.terminate()
+        except OSError:
+            # (it had already exited)
+            pass
+
+
+def report_unbuilt(failed, skipped, settings):
+    """
+    Prints a summary of the targets that failed and of the ones that
+    were skipped (because they depend on a target that failed, or
+    because the build was stopped)
+
+    Args:
+        The names of the targets that failed
+        The names of the targets that were skipped
+        The settings dictionary
+    """
+    error = settings["error"]
+    error("Failed targets:")
+    for target in sorted(failed):
+        error("  - {}".format(target))
+    if skipped:
+        error("Skipped targets:")
+        for target in sorted(skipped):
+            error("  - {}".format(target))
+
+
+def get_critical_paths(G, durations):
+    """
+    Returns how long (in seconds) the longest path from every target
+    to the end of the build (through the targets that depend on it)
+    took the last time, counting the target itself. Targets that
+    never ran count as long as the average target that did (or as
+    one second, if none did)
+
+    Args:
+        The graph we are going to build
+        A dictionary of how long the formulas of the targets took
+    """
+    known = [durations[target] for target in G.nodes()
+             if target in durations]
+    default = sum(known) / len(known) if known else 1.0
+    paths = {}
+    for target in reversed(list(nx.topological_sort(G))):
+        tail = max([paths[succ] for succ in G.successors(target)] or [0])
+        paths[target] = durations.get(target, default) + tail
+    return paths
+
+
+def parallel_run_graph(G, in_mem_shas, from_store, settings):
     """
-    The parallel equivalent of "run_this_target()"
-    It receives a list of targets to execute in parallel.
-    Unlike "run_this_target()" it has to update the shas
-    (in memory and in the store) within the function.
-    This is because one of the targets may fail but many can
-    succeed, and those outputs need to be updated
+    The parallel equivalent of running the targets one by one. As
+    soon as all of its predecessors are done, a target is checked
+    (does it need to run at all? can it be restored from the cache?),
+    and if its formula has to run, it's started as soon as there's
+    room for it: see can_start_another(), and it has to fit in the
+    resources that the running formulas leave free (see
+    get_resource_needs()). The formulas are reaped in the order
+    they finish, so a slow target only holds up the targets that
+    depend on it. Of the targets that are ready, the ones on the
+    longest path to the end of the build (going by how long they
+    took last time) are started first, and the ones that don't fit
+    yet are passed over for the ones that do. The shas of the
+    outputs of every target that succeeds are updated right away.
+    If a target fails, no more are started, and sake exits once the
+    running ones have finished (with --fail-fast, they're stopped
+    first). With --keep-going, every target that doesn't depend on
+    the one that failed is still built
 
     Args:
-        G
-        A graph
-        A list of targets that we need to build in parallel
+        The graph we are going to build
         The dictionary containing the in-memory sha store
         The dictionary containing the contents of the .shastore file
         The settings dictionary
-        A list of outputs to not update shas of
+
+    Returns:
+        The targets that failed and the ones that were skipped
+        because of them (which are only ever non-empty with
+        --keep-going)
     """
-    verbose = settings["verbose"]
-    quiet = settings["quiet"]
-    error = settings["error"]
     sprint = settings["sprint"]
+    error = settings["error"]
+    keep_going = settings.get("keep_going")
+    fail_fast = settings.get("fail_fast")
 
-    if len(list_of_targets) == 1:
-        target = list_of_targets[0]
-        sprint("Going to run target '{}' serially".format(target),
-               level="verbose")
-        run_the_target(G, target, settings)
-        node_dict = get_the_node_dict(G, target)
-        if "output" in node_dict:
-            for output in acts.get_all_outputs(node_dict):
-                if output not in dont_update_shas_of:
-                    in_mem_shas['files'][output] = {"sha": get_sha(output,
-                                                                   settings)}
-                    in_mem_shas[output] = get_sha(output, settings)
-                    write_shas_to_shastore(in_mem_shas)
-        if "dependencies" in node_dict:
-            for dep in acts.get_all_dependencies(node_dict):
-                if dep not in dont_update_shas_of:
-                    in_mem_shas['files'][dep] = {"sha": get_sha(dep, settings)}
-                    write_shas_to_shastore(in_mem_shas)
-        return True
-    a_failure_occurred = False
-    out = "Going to run these targets '{}' in parallel"
-    sprint(out.format(", ".join(list_of_targets)))
-    info = [(target, get_the_node_dict(G, target))
-              for target in list_of_targets]
-    commands = [item[1]['formula'].rstrip() for item in info]
-    if not quiet:
-        procs = [Popen(command, shell=True) for command in commands]
-    else:
-        procs = [Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-                   for command in commands]
-    for index, process in enumerate(procs):
-        if process.wait():
-            error("Target '{}' failed!".format(info[index][0]))
-            a_failure_occurred = True
+    capacities = get_host_capacities(settings)
+    needs = get_resource_needs(G, capacities, settings)
+    # what the running formulas are using of each resource
+    in_use = {name: 0 for name in capacities}
+    # the number of predecessors that each target still waits for
+    waiting = {target: G.in_degree(target) for target in G.nodes()}
+    paths = get_critical_paths(G, from_store.get('durations') or {})
+    # the targets whose formulas have to run, as a heap (longest
+    # path first), and their action keys
+    ready = []
+    keys = {}
+    durations = in_mem_shas.setdefault('durations', {})
+    # the running processes and the (target, action key, stderr
+    # file, start time) of each, keyed by their pids
+    running = {}
+    info = {}
+    failed = []
+    # the targets that are done (were built, restored from the cache,
+    # or didn't need to run)
+    done = set()
+    # the targets that --fail-fast sent SIGTERM to
+    signalled = set()
+    # whether no more targets are to be started
+    stopping = False
+
+    def release(target):
+        # the successors of a target that are no longer waiting for
+        # anything once it's done
+        for successor in sorted(G.successors(target), reverse=True):
+            waiting[successor] -= 1
+            if not waiting[successor]:
+                yield successor
+
+    def finish(targets):
+        # checks the targets that are ready, queueing the ones that
+        # have to run, and releasing the successors of the others
+        pending = list(targets)
+        while pending and not stopping:
+            target = pending.pop()
+            outstr = "Checking if target '{}' needs to be run"
+            sprint(outstr.format(target), level="verbose")
+            if needs_to_run(G, target, in_mem_shas, from_store, settings):
+                key = get_action_key(G, target, in_mem_shas, from_store,
+                                     settings)
+                if not restore_from_cache(G, target, key, in_mem_shas,
+                                          settings):
+                    keys[target] = key
+                    heapq.heappush(ready, (-paths[target], target))
+                    continue
+            done.add(target)
+            pending.extend(release(target))
+
+    def next_to_start():
+        # pops the targets in order until one fits, and puts the ones
+        # that were passed over back
+        passed_over = []
+        target = None
+        while ready:
+            item = heapq.heappop(ready)
+            if not running or resources_fit(needs[item[1]], in_use,
+                                            capacities):
+                target = item[1]
+                break
+            passed_over.append(item)
+        for item in passed_over:
+            heapq.heappush(ready, item)
+        return target
+
+    finish(sorted((target for target, count in waiting.items()
+                   if not count), reverse=True))
+
+    # whether the room for more formulas changes with the load (and
+    # not just when one finishes), so it has to be checked regularly
+    load_aware = settings.get("jobs") == "auto" or settings.get("load_average")
+
+    while ready or running:
+        while (ready and not stopping and
+               can_start_another(len(running), settings)):
+            target = next_to_start()
+            if target is None:
+                break
+            for name, amount in needs[target].items():
+                in_use[name] += amount
+            prepare_outputs(G, target, settings)
+            process, err = start_the_target(G, target, settings)
+            running[process.pid] = process
+            info[process.pid] = (target, keys.pop(target), err, time.time())
+        if not running:
+            break
+        timeout = None
+        if ready and load_aware and not stopping:
+            timeout = LOAD_SAMPLE_INTERVAL
+        try:
+            pid, returncode = wait_for_any(running, timeout)
+        except KeyboardInterrupt:
+            # (the formulas in process groups of their own don't get
+            # the Ctrl-C)
+            if fail_fast:
+                stop_the_targets(running, settings)
+            raise
+        if pid is None:
+            continue
+        running.pop(pid)
+        target, key, err, start = info.pop(pid)
+        for name, amount in needs[target].items():
+            in_use[name] -= amount
+        if returncode and target in signalled:
+            # (it was stopped rather than finishing first, so it's
+            # skipped, not failed)
+            pass
+        elif returncode:
+            if err:
+                err.seek(0)
+                error(err.read().decode(locale.getpreferredencoding()))
+            error("Target '{}' failed!".format(target))
+            failed.append(target)
+            stopping = not keep_going
+            if fail_fast and running:
+                sprint("Stopping the targets that are still running")
+                signalled.update(info[other][0] for other in running)
+                stop_the_targets(running, settings)
         else:
-            if "output" in info[index][1]:
-                for output in acts.get_all_outputs(info[index][1]):
-                    if output not in dont_update_shas_of:
-                        in_mem_shas['files'][output] = {"sha": get_sha(output,
-                                                                       settings)}
-                        write_shas_to_shastore(in_mem_shas)
-            if "dependencies" in info[index][1]:
-                for dep in acts.get_all_dependencies(info[index][1]):
-                    if dep not in dont_update_shas_of:
-                        in_mem_shas['files'][dep] = {"sha": get_sha(dep, settings)}
-                        write_shas_to_shastore(in_mem_shas)
-    if a_failure_occurred:
+            durations[target] = time.time() - start
+            node_dict = get_the_node_dict(G, target)
+            update_shas_of_target(target, node_dict, in_mem_shas, settings)
+            save_to_cache(G, target, key, settings)
+            done.add(target)
+            finish(release(target))
+        if err:
+            err.close()
+    # what never ran: the targets downstream of the failures (and,
+    # if the build stopped, every other target that wasn't done, be it
+    # ready, stopped, or not checked yet)
+    skipped = [target for target in G.nodes()
+               if target not in done and target not in failed]
+    if failed and not keep_going:
+        finish_uploads(settings)
+        if fail_fast:
+            report_unbuilt(failed, skipped, settings)
         error("A command failed to run")
         sys.exit(1)
-    return True
+    return failed, skipped
+
+
+def compact_store(G, shastore, settings, max_age=None):
+    """
+    Drops the records of the files and targets that aren't in the
+    (whole) graph anymore from the .shastore (with a maximum age,
+    only the ones that no build has seen for that long)
+
+    Args:
+        The whole graph
+        The store object
+        The settings dictionary
+        An optional maximum age of the records (in seconds)
+
+    Returns:
+        A tuple of the number of file records and the number
+        of target records that were removed
+    """
+    sprint = settings["sprint"]
+    sprint("Removing dead records from the .shastore", level="verbose")
+    expand_dependency_globs(G)
+    removed = store.collect_garbage(shastore, collect_all_files(G, settings),
+                                    G.nodes(), max_age)
+    outstr = "Removed {} file records and {} target records"
+    sprint(outstr.format(*removed), level="verbose")
+    return removed
+
+
+def gc_store(G, settings):
+    """
+    Compacts the .shastore right away (see compact_store()) and
+    reports how much space and time that saves. Used by
+    `sake gc-store`
+
+    Args:
+        The whole graph
+        The settings dictionary
+
+    Returns:
+        0 if successful
+    """
+    sprint = settings["sprint"]
+    error = settings["error"]
+    if (not store.get_store_format(store.SHASTORE) and
+            not glob.glob(store.JOURNAL + "*")):
+        error("There is no {} to compact".format(store.SHASTORE))
+        return 1
+    shastore = store.open_store(settings)
+    # (the same way a build opens it, so that the records of builds that
+    # were interrupted are kept, and old formats are read correctly)
+    store.replay_journal(shastore, settings)
+    migrate_shastore(G, shastore, settings)
+
+    def time_full_read():
+        start = time.time()
+        shastore.get_all()
+        shastore.get_all_targets()
+        return time.time() - start
 
+    size_before = os.path.getsize(shastore.path)
+    time_before = time_full_read()
+    removed = compact_store(G, shastore, settings)
+    size_after = os.path.getsize(shastore.path)
+    time_after = time_full_read()
+    shastore.close()
+    sprint("Removed {} file records and {} target records".format(*removed))
+    outstr = "The .shastore went from {} to {} bytes ({} bytes saved)"
+    sprint(outstr.format(size_before, size_after, size_before - size_after))
+    outstr = "Reading it went from {:.1f} to {:.1f} ms ({:.1f} ms saved)"
+    sprint(outstr.format(time_before * 1000, time_after * 1000,
+                         (time_before - time_after) * 1000))
+    return 0
+
+
+def add_to_tarball(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def export_store(settings, filename):
+    """
+    Bundles the .shastore (as JSON, with a manifest) into a tarball
+    that `sake store import` can restore in another checkout of the
+    project, wherever it is. The stat identities of the files are
+    left out, since they only mean something in this checkout; the
+    files of the other one are hashed once and trusted from then on.
+    Used by `sake store export`
+
+    Args:
+        The settings dictionary
+        The filename of the bundle
+
+    Returns:
+        0 if successful
+    """
+    sprint = settings["sprint"]
+    error = settings["error"]
+    if not store.get_store_format(store.SHASTORE):
+        error("There is no {} to export".format(store.SHASTORE))
+        return 1
+    shastore = store.open_store(settings)
+    # (including the records of builds that were interrupted)
+    store.replay_journal(shastore, settings)
+    files = {}
+    for path, record in shastore.get_all().items():
+        files[path] = {key: value for key, value in record.items()
+                       if key not in STAT_FIELDS}
+    targets = shastore.get_all_targets()
+    durations = shastore.get_durations()
+    format_version = store.get_format_version(shastore)
+    shastore.close()
+    payload = json.dumps({"files": files, "targets": targets,
+                          "durations": durations},
+                         sort_keys=True).encode("utf-8")
+    manifest = {"sake version": constants.VERSION,
+                "store format": format_version,
+                "files": len(files),
+                "targets": len(targets),
+                "sha256": hashlib.sha256(payload).hexdigest()}
+    with tarfile.open(filename, "w:gz") as tar:
+        add_to_tarball(tar, BUNDLE_MANIFEST,
+                       json.dumps(manifest, indent=2,
+                                  sort_keys=True).encode("utf-8"))
+        add_to_tarball(tar, BUNDLE_STORE, payload)
+    outstr = "Exported {} file records and {} target records to {}"
+    sprint(outstr.format(len(files), len(targets), filename))
+    return 0
 
-def merge_from_store_and_in_mems(from_store, in_mem_shas, dont_update_shas_of):
+
+def import_store(settings, filename):
     """
-    If we don't merge the shas from the sha store and if we build a
-    subgraph, the .shastore will only contain the shas of the files
-    from the subgraph and the rest of the graph will have to be
-    rebuilt
+    Replaces the records of the .shastore with the ones bundled by
+    `sake store export` (in another checkout of the project). Bundles
+    of older store formats are migrated by the next build. Used by
+    `sake store import`
+
+    Args:
+        The settings dictionary
+        The filename of the bundle
+
+    Returns:
+        0 if successful
     """
-    if not from_store:
-        for item in dont_update_shas_of:
-            if item in in_mem_shas['files']:
-                del in_mem_shas['files'][item]
-        return in_mem_shas
-    for key in from_store['files']:
-        if key not in in_mem_shas['files'] and key not in dont_update_shas_of:
-            in_mem_shas['files'][key] = from_store['files'][key]
-    for item in dont_update_shas_of:
-        if item in in_mem_shas['files']:
-            del in_mem_shas['files'][item]
-    return in_mem_shas
+    sprint = settings["sprint"]
+    error = settings["error"]
+    try:
+        with tarfile.open(filename, "r:gz") as tar:
+            manifest = json.loads(tar.extractfile(BUNDLE_MANIFEST).read()
+                                  .decode("utf-8"))
+            payload = tar.extractfile(BUNDLE_STORE).read()
+    except (IOError, OSError, KeyError, ValueError, tarfile.TarError):
+        error("'{}' isn't a bundle made by 'sake store export'".format(
+              filename))
+        return 1
+    if not isinstance(manifest, dict):
+        error("The manifest of '{}' is not valid".format(filename))
+        return 1
+    if hashlib.sha256(payload).hexdigest() != manifest.get("sha256"):
+        error("The store in '{}' is corrupted".format(filename))
+        return 1
+    format_version = manifest.get("store format")
+    sake_version = manifest.get("sake version", "unknown")
+    if (not isinstance(format_version, int) or
+            isinstance(format_version, bool) or format_version < 0):
+        errmes = "The manifest of '{}' doesn't say which store format "
+        errmes += "it's in, so it can't be imported"
+        error(errmes.format(filename))
+        return 1
+    if format_version > store.STORE_FORMAT:
+        errmes = "'{}' was exported by a newer version of sake ({}). "
+        errmes += "Upgrade sake to import it"
+        error(errmes.format(filename, sake_version))
+        return 1
+    contents = json.loads(payload.decode("utf-8"))
+    shastore = store.open_store(settings)
+    with store.locked(shastore.path):
+        shastore.set_meta('sake version', str(sake_version))
+        shastore.set_meta('store format', str(format_version))
+        shastore.replace_all(contents["files"], contents["targets"])
+        shastore.update_durations(contents.get("durations") or {})
+    shastore.close()
+    outstr = "Imported {} file records and {} target records from {}"
+    sprint(outstr.format(len(contents["files"]), len(contents["targets"]),
+                         filename))
+    return 0
 
 
-def build_this_graph(G, settings, dont_update_shas_of=None):
+def build_this_graph(G, settings, full_graph=None):
     """
     This is the master function that performs the building.
 
     Args:
         A graph (often a subgraph)
         The settings dictionary
-        An optional list of files to not update the shas of
-          (needed when building specific targets)
+        The whole graph, if the first one is a subgraph (only
+          needed to upgrade .shastores of older versions of sake)
 
     Returns:
         0 if successful
@@ -521,8 +2307,10 @@ def build_this_graph(G, settings, dont_update_shas_of=None):
     error = settings["error"]
     sprint = settings["sprint"]
 
-    if not dont_update_shas_of:
-        dont_update_shas_of = []
+    if full_graph is None:
+        full_graph = G
+    # every file is only hashed once per build (unless it changes)
+    settings["hash_memo"] = {}
     sprint("Checking that graph is directed acyclic", level="verbose")
     if not nx.is_directed_acyclic_graph(G):
         errmes = "Dependency resolution is impossible; "
@@ -531,25 +2319,34 @@ def build_this_graph(G, settings, dont_update_shas_of=None):
         error(errmes)
         sys.exit(1)
     sprint("Dependency resolution is possible", level="verbose")
-    in_mem_shas = take_shas_of_all_files(G, settings)
-    from_store = {}
-    if not os.path.isfile(".shastore"):
-        write_shas_to_shastore(in_mem_shas)
-        in_mem_shas = {}
-        in_mem_shas['files'] = {}
-    with io.open(".shastore", "r") as fh:
-        shas_on_disk = fh.read()
-    from_store = yaml.load(shas_on_disk, Loader=yaml.Loader)
-    check_shastore_version(from_store, settings)
-    if not from_store:
-        write_shas_to_shastore(in_mem_shas)
-        in_mem_shas = {}
-        in_mem_shas['files'] = {}
-        with io.open(".shastore", "r") as fh:
-            shas_on_disk = fh.read()
-        from_store = yaml.load(shas_on_disk, Loader=yaml.Loader)
+    expand_dependency_globs(full_graph)
+    from_store = {'files': {}, 'targets': {}}
+    store_existed = (store.get_store_format(store.SHASTORE) is not None or
+                     bool(glob.glob(store.JOURNAL + "*")))
+    shastore = store.open_store(settings)
+    settings["shastore"] = shastore
+    # finish the commit of a build that was interrupted
+    store.replay_journal(shastore, settings)
+    settings["journal"] = store.Journal()
+    if store_existed:
+        # the records are only read when they're needed
+        migrate_shastore(full_graph, shastore, settings)
+        from_store = {'files': store.LazyRecords(shastore.get),
+                      'targets': store.LazyRecords(shastore.get_target),
+                      'durations': shastore.get_durations()}
+    # files are fingerprinted lazily (by needs_to_run()), so
+    # this starts out empty
+    in_mem_shas = {'files': {}, 'targets': {}, 'durations': {}}
+    # the targets that failed and the ones that were skipped because
+    # of them (with --keep-going)
+    failed = []
+    skipped = []
     # parallel
-    if parallel:
+    if parallel and not recon:
+        failed, skipped = parallel_run_graph(G, in_mem_shas, from_store,
+                                             settings)
+    elif parallel:
+        # (nothing runs, so the levels show what could run together)
         for line in parallel_sort(G):
             line = sorted(line)
             out = "Checking if targets '{}' need to be run"
@@ -559,16 +2356,12 @@ def build_this_graph(G, settings, dont_update_shas_of=None):
                 if needs_to_run(G, item, in_mem_shas, from_store, settings):
                     to_build.append(item)
             if to_build:
-                if recon:
-                    if len(to_build) == 1:
-                        out = "Would run target '{}'"
-                        sprint(out.format(to_build[0]))
-                    else:
-                        out = "Would run targets '{}' in parallel"
-                        sprint(out.format(", ".join(to_build)))
-                    continue
-                parallel_run_these(G, to_build, in_mem_shas, from_store,
-                                   settings, dont_update_shas_of)
+                if len(to_build) == 1:
+                    out = "Would run target '{}'"
+                    sprint(out.format(to_build[0]))
+                else:
+                    out = "Would run targets '{}' in parallel"
+                    sprint(out.format(", ".join(to_build)))
     # not parallel
     else:
         # still have to use parallel_sort to make
@@ -578,34 +2371,50 @@ def build_this_graph(G, settings, dont_update_shas_of=None):
             for item in sorted(line):
                 targets.append(item)
         for target in targets:
+            if any(pred in failed or pred in skipped
+                   for pred in G.predecessors(target)):
+                skipped.append(target)
+                continue
             outstr = "Checking if target '{}' needs to be run"
             sprint(outstr.format(target), level="verbose")
             if needs_to_run(G, target, in_mem_shas, from_store, settings):
                 if recon:
                     sprint("Would run target: {}".format(target))
                     continue
-                run_the_target(G, target, settings)
-                node_dict = get_the_node_dict(G, target)
-                if "output" in node_dict:
-                    for output in acts.get_all_outputs(node_dict):
-                        if output not in dont_update_shas_of:
-                            in_mem_shas['files'][output] = {"sha": get_sha(output,
-                                                                           settings)}
-                            write_shas_to_shastore(in_mem_shas)
-                if "dependencies" in node_dict:
-                    for dep in acts.get_all_dependencies(node_dict):
-                        if dep not in dont_update_shas_of:
-                            in_mem_shas['files'][dep] = {"sha": get_sha(dep,
-                                                                        settings)}
-                            write_shas_to_shastore(in_mem_shas)
+                if not run_or_restore_target(G, target, in_mem_shas,
+                                             from_store, settings):
+                    failed.append(target)
 
     if recon:
+        shutdown_hash_executor(settings)
+        shastore.close()
         return 0
-    in_mem_shas = take_shas_of_all_files(G, settings)
-    if in_mem_shas:
-        in_mem_shas = merge_from_store_and_in_mems(from_store, in_mem_shas,
-                                                   dont_update_shas_of)
-        write_shas_to_shastore(in_mem_shas)
+    # only the records that this build took (to check the targets, and
+    # of the files of the targets that ran) are committed; the records
+    # of the files that weren't touched stay in the store as they are
+    records = in_mem_shas['files']
+    add_late_stats(records, settings)
+    targets = in_mem_shas['targets']
+    durations = in_mem_shas['durations']
+    # (no inputs at all, so that they run next time, whatever the
+    # records of their files say)
+    targets.update((target, {}) for target in failed + skipped)
+    shastore.set_meta('sake version', constants.VERSION)
+    shastore.update(records, targets)
+    if durations:
+        shastore.update_durations(durations)
+    # everything in the Sakefile (as these macros expand it) is in use
+    stamp_last_seen(full_graph, shastore)
+    settings["journal"].discard()
+    if store.needs_compaction(shastore):
+        compact_store(full_graph, shastore, settings, store.GC_MAX_AGE)
+    finish_uploads(settings)
+    shutdown_hash_executor(settings)
+    shastore.close()
+    if failed:
+        report_unbuilt(failed, skipped, settings)
+        error("A command failed to run")
+        sys.exit(1)
     sprint("Done", color=True)
     return 0
 
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+###########################################################
+##                                                       ##
+##   cache.py                                            ##
+##                                                       ##
+##                Author: Tony Fischetti                 ##
+##                        tony.fischetti@gmail.com       ##
+##                                                       ##
+###########################################################
+#
+##############################################################################
+#                                                                            #
+# Copyright (c) 2013, 2014, 2015, 2016, 2017, 2018,                          #
+#               2019, 2020,                         Tony Fischetti           #
+#                                                                            #
+# MIT License, http://www.opensource.org/licenses/mit-license.php            #
+#                                                                            #
+# Permission is hereby granted, free of charge, to any person obtaining a    #
+# copy of this software and associated documentation files (the "Software"), #
+# to deal in the Software without restriction, including without limitation  #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,   #
+# and/or sell copies of the Software, and to permit persons to whom the      #
+# Software is furnished to do so, subject to the following conditions:       #
+#                                                                            #
+# The above copyright notice and this permission notice shall be included in #
+# all copies or substantial portions of the Software.                        #
+#                                                                            #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,   #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL    #
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING    #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER        #
+# DEALINGS IN THE SOFTWARE.                                                  #
+#                                                                            #
+##############################################################################
+
+
+"""
+The action cache: the outputs that the formulas of targets produced,
+keyed by everything that went into them, so that they can be restored
+instead of running the formulas again
+
+The cache can be shared through a remote cache server (see
+cache_server.py for the protocol): action results and blobs that
+aren't in the local cache are fetched from it, and the outputs of
+targets that ran are uploaded to it
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import hashlib
+import http.client
+import io
+import json
+import os
+import shutil
+import stat
+from urllib.request import Request, urlopen
+
+from . import acts
+
+# reflinks (copy-on-write clones) are only available on some
+# file systems on Linux; everywhere else outputs are hardlinked
+# (or copied, if that fails too)
+try:
+    import fcntl
+    FICLONE = 0x40049409
+except ImportError:
+    fcntl = None
+
+# the algorithm of the digests of the blobs in the cache (this doesn't
+# depend on --hash-algorithm so that caches can be shared)
+DIGEST_ALGORITHM = "sha256"
+
+BLOCKSIZE = 1024 * 1024
+
+# the local cache that a remote cache is used through, when
+# there's no --cache-dir
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sake")
+
+# seconds to wait for the remote cache server to respond
+REMOTE_TIMEOUT = 60
+
+
+def get_action_key(node_dict, input_records, settings):
+    """
+    Returns the key of an action in the cache: the digest of the
+    formula of the target, the -D macros, the shell, the names of
+    its outputs and the fingerprints of its inputs
+
+    Args:
+        The node dictionary of the target
+        A dictionary of the fingerprints of its dependencies
+        The settings dictionary
+    """
+    action = {"formula": node_dict["formula"].rstrip(),
+              "macros": acts.parse_defines(settings.get("defines") or []),
+              "shell": settings.get("shell"),
+              "outputs": sorted(node_dict.get("output", [])),
+              "inputs": input_records}
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    hasher.update(json.dumps(action, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_action_path(cache_dir, key):
+    return os.path.join(cache_dir, "ac", key[:2], key)
+
+
+def get_blob_path(cache_dir, digest):
+    return os.path.join(cache_dir, "cas", digest[:2], digest)
+
+
+def write_atomically(path, data):
+    """
+    Writes bytes to a file that is only put in place when it's
+    complete, so readers never see half of it
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with io.open(tmp_path, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+
+def store_blob(cache_dir, a_file):
+    """
+    Copies a file into the content addressed storage of the cache
+
+    Returns:
+        The digest of the file
+    """
+    blobs = os.path.join(cache_dir, "cas")
+    if not os.path.isdir(blobs):
+        os.makedirs(blobs, exist_ok=True)
+    tmp_path = os.path.join(blobs, "tmp{}".format(os.getpid()))
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    with io.open(a_file, "rb") as src, io.open(tmp_path, "wb") as dst:
+        buf = src.read(BLOCKSIZE)
+        while buf:
+            hasher.update(buf)
+            dst.write(buf)
+            buf = src.read(BLOCKSIZE)
+    digest = hasher.hexdigest()
+    blob_path = get_blob_path(cache_dir, digest)
+    if os.path.isfile(blob_path):
+        os.remove(tmp_path)
+    else:
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(tmp_path, blob_path)
+    return digest
+
+
+def place_blob(blob_path, dest, mode):
+    """
+    Puts a blob of the cache at a path, as a reflink if the file
+    system can do that, otherwise as a hardlink (or as a copy)
+    """
+    # (it's already there, as a hardlink)
+    try:
+        if os.path.samestat(os.stat(blob_path), os.stat(dest)):
+            return
+    except OSError:
+        pass
+    parent = os.path.dirname(dest)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = "{}.sake-tmp{}".format(dest, os.getpid())
+    placed = False
+    if fcntl:
+        try:
+            with io.open(blob_path, "rb") as src, \
+                    io.open(tmp_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.chmod(tmp_path, mode)
+            placed = True
+        except (IOError, OSError):
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+    # a hardlink shares the mode of the blob
+    if not placed and stat.S_IMODE(os.stat(blob_path).st_mode) == mode:
+        try:
+            os.link(blob_path, tmp_path)
+            placed = True
+        except OSError:
+            pass
+    if not placed:
+        shutil.copyfile(blob_path, tmp_path)
+        os.chmod(tmp_path, mode)
+    os.replace(tmp_path, dest)
+    # renaming a hardlink over another link to the same file does
+    # nothing, so the temporary link can still be there
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+
+def break_hardlinks(paths):
+    """
+    Replaces the files (at the paths, or inside the directories at
+    the paths) that have other hardlinks with copies of themselves.
+    Outputs restored from the cache can be hardlinks to its blobs,
+    and a formula that writes to them in place would corrupt it
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                break_hardlinks([os.path.join(root, fn) for fn in files])
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            tmp_path = "{}.sake-tmp{}".format(path, os.getpid())
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, path)
+
+
+def save_outputs(cache_dir, key, outputs):
+    """
+    Stores the outputs of a target that just ran in the cache,
+    under the key of its action. Nothing is stored if one of the
+    outputs is missing
+
+    Args:
+        The cache directory
+        The key of the action
+        The list of the target's outputs (files or directories)
+
+    Returns:
+        True if the outputs were stored
+    """
+    result = []
+    for output in outputs:
+        if os.path.isdir(output):
+            files = []
+            for root, dirs, fns in os.walk(output):
+                for fn in sorted(fns):
+                    path = os.path.join(root, fn)
+                    files.append({"path": os.path.relpath(path, output),
+                                  "digest": store_blob(cache_dir, path),
+                                  "mode": stat.S_IMODE(os.stat(path).st_mode)})
+            result.append({"path": output, "files": files})
+        elif os.path.isfile(output):
+            result.append({"path": output,
+                           "digest": store_blob(cache_dir, output),
+                           "mode": stat.S_IMODE(os.stat(output).st_mode)})
+        else:
+            return False
+    write_atomically(get_action_path(cache_dir, key),
+                     json.dumps({"outputs": result}).encode("utf-8"))
+    return True
+
+
+def get_blobs_of_result(result):
+    """
+    Returns the digests of all of the blobs an action result needs
+    """
+    digests = []
+    for output in result["outputs"]:
+        if "files" in output:
+            digests.extend(item["digest"] for item in output["files"])
+        else:
+            digests.append(output["digest"])
+    return digests
+
+
+def is_digest(digest):
+    """
+    Returns True if a string looks like a digest of the cache
+    """
+    size = hashlib.new(DIGEST_ALGORITHM).digest_size * 2
+    return (isinstance(digest, str) and len(digest) == size and
+            all(char in "0123456789abcdef" for char in digest))
+
+
+def is_relative_path(a_path):
+    """
+    Returns True if a path stays inside of the directory it's
+    relative to (it isn't absolute and it has no "..")
+    """
+    if not isinstance(a_path, str) or not a_path:
+        return False
+    if os.path.isabs(a_path) or os.path.splitdrive(a_path)[0]:
+        return False
+    return ".." not in a_path.replace("\\", "/").split("/")
+
+
+def result_matches(result, outputs):
+    """
+    Returns True if an action result (which may have come from a
+    remote cache, so it can't be trusted) restores exactly the
+    outputs of the target, and only puts blobs with well-formed
+    digests inside of them
+
+    Args:
+        The action result
+        The list of the target's outputs (files or directories)
+    """
+    try:
+        if sorted(output["path"] for output in result["outputs"]) != \
+                sorted(outputs):
+            return False
+        for output in result["outputs"]:
+            if "files" in output:
+                entries = output["files"]
+                if not all(is_relative_path(item["path"])
+                           for item in entries):
+                    return False
+            else:
+                entries = [output]
+            for item in entries:
+                if (not is_digest(item["digest"]) or
+                        not isinstance(item["mode"], int)):
+                    return False
+    except (KeyError, TypeError, AttributeError):
+        return False
+    return True
+
+
+def restore_result(cache_dir, result):
+    """
+    Puts the outputs of an action result in place
+
+    Returns:
+        True if it was restored (False if a blob is missing)
+    """
+    for digest in get_blobs_of_result(result):
+        if not os.path.isfile(get_blob_path(cache_dir, digest)):
+            return False
+    for output in result["outputs"]:
+        if "files" in output:
+            if os.path.isdir(output["path"]):
+                shutil.rmtree(output["path"])
+            os.makedirs(output["path"], exist_ok=True)
+            for item in output["files"]:
+                place_blob(get_blob_path(cache_dir, item["digest"]),
+                           os.path.join(output["path"], item["path"]),
+                           item["mode"])
+        else:
+            place_blob(get_blob_path(cache_dir, output["digest"]),
+                       output["path"], output["mode"])
+    return True
+
+
+def get_remote_url(remote, kind, name):
+    return "{}/{}/{}".format(remote.rstrip("/"), kind, name)
+
+
+def remote_has(remote, kind, name):
+    """
+    Returns True if the remote cache has an action result ("ac")
+    or a blob ("cas")
+    """
+    request = Request(get_remote_url(remote, kind, name), method="HEAD")
+    try:
+        urlopen(request, timeout=REMOTE_TIMEOUT).close()
+    except (IOError, OSError, http.client.HTTPException):
+        return False
+    return True
+
+
+def fetch_remote(remote, kind, name, dest):
+    """
+    Downloads an action result ("ac") or a blob ("cas") from the
+    remote cache to a path. Blobs that don't match their digest
+    are thrown away
+
+    Returns:
+        True if it was downloaded
+    """
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = "{}.tmp{}".format(dest, os.getpid())
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    try:
+        response = urlopen(get_remote_url(remote, kind, name),
+                           timeout=REMOTE_TIMEOUT)
+        with response, io.open(tmp_path, "wb") as fh:
+            buf = response.read(BLOCKSIZE)
+            while buf:
+                hasher.update(buf)
+                fh.write(buf)
+                buf = response.read(BLOCKSIZE)
+    except (IOError, OSError, http.client.HTTPException):
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return False
+    if kind == "cas" and hasher.hexdigest() != name:
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, dest)
+    return True
+
+
+def push_remote(remote, kind, name, path):
+    """
+    Uploads an action result ("ac") or a blob ("cas") from a path
+    to the remote cache (streaming it, since blobs can be big)
+
+    Returns:
+        True if it was uploaded
+    """
+    headers = {"Content-Type": "application/octet-stream",
+               "Content-Length": str(os.path.getsize(path))}
+    try:
+        with io.open(path, "rb") as fh:
+            request = Request(get_remote_url(remote, kind, name), data=fh,
+                              headers=headers, method="PUT")
+            urlopen(request, timeout=REMOTE_TIMEOUT).close()
+    except (IOError, OSError, http.client.HTTPException):
+        return False
+    return True
+
+
+def upload_outputs(cache_dir, key, remote):
+    """
+    Uploads an action result in the local cache (and the blobs it
+    needs, if the remote cache doesn't have them yet) to the remote
+    cache. The action result goes last, so that nobody can fetch it
+    before its blobs are there
+
+    Returns:
+        True if everything was uploaded
+    """
+    action_path = get_action_path(cache_dir, key)
+    try:
+        with io.open(action_path, "rb") as fh:
+            result = json.loads(fh.read().decode("utf-8"))
+    except (IOError, OSError, ValueError):
+        return False
+    for digest in sorted(set(get_blobs_of_result(result))):
+        if remote_has(remote, "cas", digest):
+            continue
+        if not push_remote(remote, "cas", digest,
+                           get_blob_path(cache_dir, digest)):
+            return False
+    return push_remote(remote, "ac", key, action_path)
+
+
+def restore_outputs(cache_dir, key, outputs, remote=None):
+    """
+    Restores the outputs of a target from the cache, if the
+    action with this key was run before. Whatever is missing
+    from the local cache is fetched from the remote one (if any).
+    An action result that doesn't match the outputs of the target
+    (see result_matches()) counts as a miss
+
+    Args:
+        The cache directory
+        The key of the action
+        The list of the target's outputs (files or directories)
+        The URL of the remote cache (or None)
+
+    Returns:
+        True if the outputs were restored
+    """
+    action_path = get_action_path(cache_dir, key)
+    if remote and not os.path.isfile(action_path):
+        if not fetch_remote(remote, "ac", key, action_path):
+            return False
+    try:
+        with io.open(action_path, "rb") as fh:
+            result = json.loads(fh.read().decode("utf-8"))
+    except (IOError, OSError, ValueError):
+        return False
+    if not result_matches(result, outputs):
+        return False
+    if remote:
+        for digest in sorted(set(get_blobs_of_result(result))):
+            blob_path = get_blob_path(cache_dir, digest)
+            if os.path.isfile(blob_path):
+                continue
+            if not fetch_remote(remote, "cas", digest, blob_path):
+                return False
+    return restore_result(cache_dir, result)
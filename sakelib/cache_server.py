@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+###########################################################
+##                                                       ##
+##   cache_server.py                                     ##
+##                                                       ##
+##                Author: Tony Fischetti                 ##
+##                        tony.fischetti@gmail.com       ##
+##                                                       ##
+###########################################################
+#
+##############################################################################
+#                                                                            #
+# Copyright (c) 2013, 2014, 2015, 2016, 2017, 2018,                          #
+#               2019, 2020,                         Tony Fischetti           #
+#                                                                            #
+# MIT License, http://www.opensource.org/licenses/mit-license.php            #
+#                                                                            #
+# Permission is hereby granted, free of charge, to any person obtaining a    #
+# copy of this software and associated documentation files (the "Software"), #
+# to deal in the Software without restriction, including without limitation  #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,   #
+# and/or sell copies of the Software, and to permit persons to whom the      #
+# Software is furnished to do so, subject to the following conditions:       #
+#                                                                            #
+# The above copyright notice and this permission notice shall be included in #
+# all copies or substantial portions of the Software.                        #
+#                                                                            #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,   #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL    #
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING    #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER        #
+# DEALINGS IN THE SOFTWARE.                                                  #
+#                                                                            #
+##############################################################################
+
+
+"""
+A small reference server for the remote cache, for trying it out
+locally (or sharing a cache on a trusted network). It speaks the
+whole protocol that sake's client uses:
+
+    GET  /ac/<key>        the action result stored under a key
+    PUT  /ac/<key>        stores an action result
+    GET  /cas/<digest>    the blob with this SHA-256 digest
+    PUT  /cas/<digest>    stores a blob (refused if it doesn't match)
+    HEAD /ac/<key>, /cas/<digest>
+                          whether the server has it
+
+Keys and digests are 64 lowercase hex characters. Uploads need a
+Content-Length. Missing entries are 404s and stored ones are 201s.
+The entries are kept in a directory laid out like a local cache
+(see --cache-dir), so a server can be pointed at one.
+
+Usage:
+    python -m sakelib.cache_server [--host HOST] [--port PORT] DIRECTORY
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import argparse
+import hashlib
+import io
+import os
+import re
+import shutil
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import cache
+
+NAME_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the entries of the cache directory of the server
+    """
+
+    def get_entry(self):
+        """
+        Returns the kind ("ac" or "cas"), the name and the path of
+        the entry that was requested, or None (after responding with
+        an error) if the request is malformed
+        """
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] not in ("ac", "cas") or \
+                not NAME_PATTERN.match(parts[1]):
+            self.send_error(400, "Expected /ac/<key> or /cas/<digest>")
+            return None
+        kind, name = parts
+        if kind == "ac":
+            path = cache.get_action_path(self.server.cache_dir, name)
+        else:
+            path = cache.get_blob_path(self.server.cache_dir, name)
+        return kind, name, path
+
+    def send_entry(self, with_body):
+        entry = self.get_entry()
+        if entry is None:
+            return
+        kind, name, path = entry
+        try:
+            fh = io.open(path, "rb")
+        except (IOError, OSError):
+            self.send_error(404)
+            return
+        with fh:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length",
+                             str(os.fstat(fh.fileno()).st_size))
+            self.end_headers()
+            if with_body:
+                shutil.copyfileobj(fh, self.wfile, cache.BLOCKSIZE)
+
+    def do_HEAD(self):
+        self.send_entry(with_body=False)
+
+    def do_GET(self):
+        self.send_entry(with_body=True)
+
+    def do_PUT(self):
+        entry = self.get_entry()
+        if entry is None:
+            return
+        kind, name, path = entry
+        length = self.headers.get("Content-Length")
+        if length is None or not length.isdigit():
+            self.send_error(411)
+            return
+        remaining = int(length)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+        tmp_path = "{}.tmp{}".format(path, id(self))
+        hasher = hashlib.new(cache.DIGEST_ALGORITHM)
+        with io.open(tmp_path, "wb") as fh:
+            while remaining:
+                buf = self.rfile.read(min(remaining, cache.BLOCKSIZE))
+                if not buf:
+                    break
+                hasher.update(buf)
+                fh.write(buf)
+                remaining -= len(buf)
+        if remaining:
+            os.remove(tmp_path)
+            self.send_error(400, "The upload was cut short")
+            return
+        if kind == "cas" and hasher.hexdigest() != name:
+            os.remove(tmp_path)
+            self.send_error(400, "The blob doesn't match its digest")
+            return
+        os.replace(tmp_path, path)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(cache_dir, host="localhost", port=0, quiet=False):
+    """
+    Returns a cache server (that isn't serving yet) for a
+    directory. With port 0, the OS picks a free port
+
+    Args:
+        The directory to keep the entries in
+        The host name or address to listen on
+        The port to listen on
+        Whether to log requests
+    """
+    server = ThreadingHTTPServer((host, port), CacheRequestHandler)
+    server.cache_dir = cache_dir
+    server.quiet = quiet
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A reference remote " +
+                                     "cache server for sake")
+    parser.add_argument('directory', help="where to keep the cache")
+    parser.add_argument('--host', action="store", default="localhost",
+                        help="address to listen on (default=localhost)")
+    parser.add_argument('--port', action="store", type=int, default=8734,
+                        help="port to listen on (default=8734)")
+    parser.add_argument('-q', '--quiet', action="store_true",
+                        help="don't log requests")
+    args = parser.parse_args()
+    server = make_server(os.path.abspath(args.directory), args.host,
+                         args.port, args.quiet)
+    print("Serving the cache in {} at http://{}:{}".format(
+          args.directory, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -48,7 +48,9 @@ import yaml
 from sakelib import acts
 from sakelib import audit
 from sakelib import build
+from sakelib import cache
 from sakelib import constants
+from sakelib import store
 
 
 def main():
@@ -71,6 +73,10 @@ def main():
                         help="targets to build (default=all)",
                         metavar='target', type=str, nargs='?',
                         default="all")
+    parser.add_argument("args",
+                        help="arguments of the target " +
+                             "(`sake store export|import FILE' only)",
+                        metavar='args', type=str, nargs='*')
 
     # optional arguments
     parser.add_argument('-v', '--verbose', action='store_true',
@@ -88,22 +94,75 @@ def main():
                              "executed, but do not execute them")
     parser.add_argument('-p', '--parallel', action="store_true",
                         help="builds targets in parallel if possible")
+    parser.add_argument('-j', '--jobs', action="store", type=acts.parse_jobs,
+                        metavar="N",
+                        help="run at most N formulas at once, or as many " +
+                             "as the load of the machine allows with " +
+                             "'auto' (implies -p)")
+    parser.add_argument('-l', '--load-average', action="store", type=float,
+                        metavar="L",
+                        help="don't start formulas while the load " +
+                             "average is at least L (parallel mode only)")
+    parser.add_argument('--resources', action="store",
+                        type=acts.parse_capacities, metavar="R",
+                        help="what the host has of the resources that " +
+                             "targets declare, like 'cpus=16,memory=64G," +
+                             "gpu-license=2' (parallel mode only)")
+    parser.add_argument('-k', '--keep-going', action="store_true",
+                        help="keep building the targets that don't " +
+                             "depend on a target that failed")
+    parser.add_argument('--fail-fast', action="store_true",
+                        help="stop the formulas that are still running " +
+                             "as soon as one fails (parallel mode only)")
     parser.add_argument('-n', '--no-graphviz', action="store_true",
                         help="Suppress command to graphviz and just" +
                              " produce graphviz dot file (`sake visual' only)")
     parser.add_argument('-E', '--no-enhanced-errors', action="store_true",
                         help="Turn off enhanced errors (POSIX only)")
     parser.add_argument('-f', '--file', action="store", dest="outfile",
-                        help="filename to place visualization or " +
-                             "graphviz dotfile")
+                        help="filename to place visualization, " +
+                             "graphviz dotfile or store dump")
     parser.add_argument('-s', '--sakefile', action="store",
                         dest="customsake",
                         help="Path to specific sakefile")
     parser.add_argument('-D', '--define', action='append', default=[],
                         dest='defines',
                         help='Define the given macro in the Sakefile')
+    parser.add_argument('--verify', action="store_true",
+                        help="rehash every file instead of trusting " +
+                             "unchanged file sizes and timestamps")
+    parser.add_argument('--hash-algorithm', action="store",
+                        choices=sorted(build.HASH_ALGORITHMS),
+                        help="algorithm used to fingerprint files " +
+                             "(default={})".format(build.DEFAULT_ALGORITHM))
+    parser.add_argument('--hash-workers', action="store", type=int,
+                        metavar="N",
+                        help="number of workers that hash files " +
+                             "(default=number of cores)")
+    parser.add_argument('--hash-strategy', action="store", default="auto",
+                        choices=["auto", "threads", "processes"],
+                        help="whether files are hashed by threads or " +
+                             "processes (default=auto)")
+    parser.add_argument('--tree-hash', action="store_true",
+                        help="hash segments of very big files in " +
+                             "parallel")
+    parser.add_argument('--store-backend', action="store",
+                        choices=sorted(store.BACKENDS),
+                        help="format of the .shastore " +
+                             "(default={})".format(store.DEFAULT_BACKEND))
+    parser.add_argument('--cache-dir', action="store", default=None,
+                        help="directory of a local action cache " +
+                             "to restore outputs from (default=none)")
+    parser.add_argument('--remote-cache', action="store", default=None,
+                        metavar="URL",
+                        help="URL of a remote cache server " +
+                             "to share the action cache through")
 
     args = parser.parse_args()
+    if args.args and args.target != "store":
+        parser.error("unrecognized arguments: {}".format(" ".join(args.args)))
+    if args.keep_going and args.fail_fast:
+        parser.error("--keep-going and --fail-fast can't be used together")
 
 
 
@@ -123,6 +182,14 @@ def main():
     # converts cli args into a dictionary
     settings = vars(args)
 
+    # a number of jobs only makes sense in parallel
+    if settings["jobs"]:
+        settings["parallel"] = True
+
+    # the remote cache is used through a local one
+    if settings["remote_cache"] and not settings["cache_dir"]:
+        settings["cache_dir"] = cache.DEFAULT_CACHE_DIR
+
     # In order to be as referentially transparent, we will keep various
     # settings and key functions in a dictionary called `settings` that
     # we will send to delegate functions.
@@ -136,6 +203,24 @@ def main():
     settings["error"] = error
 
 
+    # if target is "dump-store" (this doesn't need a Sakefile)
+    if args.target == "dump-store":
+        retcode = store.dump_store(settings, filename=args.outfile)
+        sys.exit(retcode)
+
+
+    # if target is "store" (export or import the .shastore)
+    if args.target == "store":
+        if len(args.args) != 2 or args.args[0] not in ("export", "import"):
+            error("Usage: sake store export|import FILE")
+            sys.exit(1)
+        if args.args[0] == "export":
+            retcode = build.export_store(settings, args.args[1])
+        else:
+            retcode = build.import_store(settings, args.args[1])
+        sys.exit(retcode)
+
+
     # find sakefile to read
     fname = acts.find_standard_sakefile(settings)
     defines = acts.parse_defines(args.defines)
@@ -151,6 +236,11 @@ def main():
     if "shell" in sakefile:
         settings["shell"] = sakefile["shell"]
         sakefile.pop("shell")
+    if "hash algorithm" in sakefile:
+        # the command line takes precedence
+        if not settings["hash_algorithm"]:
+            settings["hash_algorithm"] = sakefile["hash algorithm"]
+        sakefile.pop("hash algorithm")
     if not audit.check_integrity(sakefile, settings):
         error("Error: Sakefile isn't written to specification")
         sys.exit(1)
@@ -185,6 +275,12 @@ def main():
         sys.exit(retcode)
 
 
+    # if target is "gc-store"
+    if args.target == "gc-store":
+        retcode = build.gc_store(G, settings)
+        sys.exit(retcode)
+
+
     # if target is "visual"
     if args.target == 'visual':
         if args.recon:
@@ -245,40 +341,25 @@ def main():
                 nodes_in_subgraph = nodes_in_subgraph + all_preds([node[0]])
         nodes_in_subgraph = list(set(nodes_in_subgraph))
         subgraph = G.subgraph(nodes_in_subgraph)
-        retval = build.build_this_graph(subgraph, settings)
+        retval = build.build_this_graph(subgraph, settings, full_graph=G)
         sys.exit(retval)
 
 
-    # If you specify a target that shares a dependency with another target,
-    # both targets need to be updated. This is because running one will resolve
-    # the sha mismatch and sake will think that the other one doesn't have to
-    # run. This is called a "tie". We need to find such "ties" at this point.
-    ties = acts.get_ties(G)
+    # Each target records the fingerprints of the inputs it was built
+    # against, so a target can be built on its own even if it shares
+    # dependencies with other targets (they'll still notice the change)
 
     # for other target specified
     # it's easier to ask for forgiveness that permission
     try:
         if args.target not in G.nodes():
             raise AssertionError
-        predecessors = G.predecessors(args.target)
-        # if a specific target is given, it's outputs need to be protected
-        # from sha updates
-        no_sha_update = []
-        for node in G.nodes(data=True):
-            if node[0] == args.target:
-                if 'output' in node[1]:
-                    for item in node[1]['output']:
-                        no_sha_update.append(item)
     except:
         # maybe its a meta-target?
         if args.target in sakefile:
             nodes_in_subgraph = []
-            no_sha_update = []
             for node in G.nodes(data=True):
                 if "parent" in node[1] and node[1]["parent"] == args.target:
-                    if 'output' in node[1]:
-                        for item in node[1]['output']:
-                            no_sha_update.append(item)
                     if args.force:
                         # force will not build any predecessors
                         nodes_in_subgraph.append(node[0])
@@ -287,23 +368,9 @@ def main():
                         nodes_in_subgraph = nodes_in_subgraph+all_preds([node[0]])
                         nodes_in_subgraph = list(set(nodes_in_subgraph))
                         subgraph = G.subgraph(nodes_in_subgraph)
-            my_ties, ties_message = acts.get_tied_targets(nodes_in_subgraph, ties)
-            lenofties = len(my_ties)
-            # for ind, tie in enumerate(my_ties):
-            for ind in range(0, lenofties):
-                tie = my_ties[ind]
-                if not args.force:
-                    preds = list(set(all_preds([tie])))
-                    for pred in preds:
-                        nodes_in_subgraph.append(pred)
-                else:
-                    nodes_in_subgraph.append(tie)
             nodes_in_subgraph = list(set(nodes_in_subgraph))
             subgraph = G.subgraph(nodes_in_subgraph)
-            if ties_message:
-                warn(ties_message)
-            retval = build.build_this_graph(subgraph, settings,
-                                           dont_update_shas_of=no_sha_update)
+            retval = build.build_this_graph(subgraph, settings, full_graph=G)
             sys.exit(retval)
         # I guess its not :(
         err_mes = "Error: Couldn't find target '{}' in Sakefile"
@@ -311,21 +378,12 @@ def main():
         sys.exit(1)
     # force will not build any predecessors
     if args.force:
-        # check for need to run ties
-        my_ties, ties_message = acts.get_tied_targets([args.target], ties)
-        if ties_message:
-            warn(ties_message)
-        subgraph = G.subgraph(my_ties)
+        subgraph = G.subgraph([args.target])
     else:
         nodes_in_subgraph = list(set(all_preds([args.target])))
-        my_ties, ties_message = acts.get_tied_targets(nodes_in_subgraph, ties)
-        if ties_message:
-            warn(ties_message)
-        nodes_in_subgraph = list(set(all_preds(my_ties)))
         subgraph = G.subgraph(nodes_in_subgraph)
 
-    retval = build.build_this_graph(subgraph, settings,
-                                    dont_update_shas_of=no_sha_update)
+    retval = build.build_this_graph(subgraph, settings, full_graph=G)
     sys.exit(retval)
 
 
@@ -0,0 +1,819 @@
+#!/usr/bin/env python
+
+###########################################################
+##                                                       ##
+##   store.py                                            ##
+##                                                       ##
+##                Author: Tony Fischetti                 ##
+##                        tony.fischetti@gmail.com       ##
+##                                                       ##
+###########################################################
+#
+##############################################################################
+#                                                                            #
+# Copyright (c) 2013, 2014, 2015, 2016, 2017, 2018,                          #
+#               2019, 2020,                         Tony Fischetti           #
+#                                                                            #
+# MIT License, http://www.opensource.org/licenses/mit-license.php            #
+#                                                                            #
+# Permission is hereby granted, free of charge, to any person obtaining a    #
+# copy of this software and associated documentation files (the "Software"), #
+# to deal in the Software without restriction, including without limitation  #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,   #
+# and/or sell copies of the Software, and to permit persons to whom the      #
+# Software is furnished to do so, subject to the following conditions:       #
+#                                                                            #
+# The above copyright notice and this permission notice shall be included in #
+# all copies or substantial portions of the Software.                        #
+#                                                                            #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,   #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL    #
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING    #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER        #
+# DEALINGS IN THE SOFTWARE.                                                  #
+#                                                                            #
+##############################################################################
+
+
+"""
+The backends of the .shastore, where the fingerprints of the
+dependencies and outputs are kept between builds
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from contextlib import contextmanager
+import glob
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+import yaml
+
+from . import constants
+
+# file locks are only available on POSIX systems. Without them,
+# concurrent invocations of sake in one directory aren't safe
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# if PyYAML was built with libyaml, use its (much faster) C loader
+# and dumper for the YAML stores
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+# the name of the store in the project directory
+SHASTORE = ".shastore"
+
+# every SQLite database starts with this header, which is how
+# a store in the SQLite format is told apart from an old YAML one
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+DEFAULT_BACKEND = "sqlite"
+
+# how much of a SQLite store is memory-mapped (instead of read
+# through the page cache with a system call for every page)
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+# the records of the targets that finish are appended to a journal
+# (one JSON line per target) and folded into the store at the end of
+# the build, or at the start of the next one if the build was killed.
+# Every sake process has its own journal (named with this prefix and
+# its pid), which it keeps locked for as long as it's running
+JOURNAL = ".shastore.journal"
+
+# the lock that serializes the read-merge-writes of the YAML
+# store (and migrations) between concurrent invocations of sake
+LOCK = ".shastore.lock"
+
+# how long (in seconds) to wait for another sake process that's
+# writing to a SQLite store before giving up
+SQLITE_TIMEOUT = 60
+
+# the store is garbage collected at the end of a build if the last
+# time that happened was more than GC_MAX_AGE seconds ago, or if the
+# store has grown to more than GC_GROWTH times its size back then (and
+# is bigger than GC_MIN_SIZE bytes). That drops the records of the
+# files and targets that aren't in the Sakefile, and that no build has
+# seen for GC_MAX_AGE seconds either (so the records of other macros,
+# or of other Sakefiles in the same directory, survive while in use)
+GC_MAX_AGE = 7 * 24 * 60 * 60
+GC_GROWTH = 2
+GC_MIN_SIZE = 1024 * 1024
+
+# a build only rewrites when it saw a path or target if the time the
+# store has is older than this, so that a no-op build doesn't rewrite
+# all of them (a record that falls out of use is then kept for between
+# GC_MAX_AGE - SEEN_REFRESH and GC_MAX_AGE seconds after it last was)
+SEEN_REFRESH = GC_MAX_AGE / 2
+
+# the journal is fsync-ed after this many entries or this many
+# seconds, whichever comes first. An entry that was written but not
+# yet fsync-ed survives the death of sake, just not of the machine
+JOURNAL_SYNC_ENTRIES = 32
+JOURNAL_SYNC_SECONDS = 1.0
+
+# a journal only has its ".new" name while it's being opened (see
+# Journal.open()), so an unlocked one that is older than this (in
+# seconds) belongs to a build that was killed right then
+JOURNAL_STALE_NEW = 60
+
+# the version of the layout of the records in the store. It's kept
+# apart from the version of sake (and only changes when the records
+# do), and the stores of older formats are upgraded in place by the
+# migrators in build.MIGRATORS:
+#   0: the stores from before sake stamped its version in them
+#   1: a record of the SHA1 of every file (up to sake 1.3)
+#   2: records with the stat identity of the files, and the
+#      fingerprints of the inputs of every target
+STORE_FORMAT = 2
+
+
+class SQLiteStore(object):
+    """
+    A store kept in a SQLite database: the records of the files (and
+    the inputs of the targets) are JSON blobs keyed by their path (or
+    name). The primary keys are indices, so looking up or updating a
+    record doesn't require reading or rewriting the rest of them
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # SQLite locks the database itself while it's written, so
+        # concurrent invocations of sake just merge their records
+        self.db = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self.db.execute("PRAGMA mmap_size = {}".format(SQLITE_MMAP_SIZE))
+        fresh = not self.db.execute("SELECT name FROM sqlite_master WHERE "
+                                    "name = 'files'").fetchone()
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta "
+                            "(key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                            "(path TEXT PRIMARY KEY, record TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS targets "
+                            "(name TEXT PRIMARY KEY, inputs TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS durations "
+                            "(name TEXT PRIMARY KEY, seconds REAL)")
+            # when a build last had each path and target in its graph
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen_files "
+                            "(path TEXT PRIMARY KEY, time REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen_targets "
+                            "(name TEXT PRIMARY KEY, time REAL)")
+            self.db.execute("INSERT OR IGNORE INTO meta VALUES (?, ?)",
+                            ("sake version", constants.VERSION))
+            if fresh:
+                self.db.execute("INSERT OR IGNORE INTO meta VALUES (?, ?)",
+                                ("store format", str(STORE_FORMAT)))
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                            (key, value))
+
+    def get(self, path):
+        row = self.db.execute("SELECT record FROM files WHERE path = ?",
+                              (path,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_all(self):
+        return {path: json.loads(record) for path, record in
+                self.db.execute("SELECT path, record FROM files")}
+
+    def get_target(self, name):
+        row = self.db.execute("SELECT inputs FROM targets WHERE name = ?",
+                              (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_all_targets(self):
+        return {name: json.loads(inputs) for name, inputs in
+                self.db.execute("SELECT name, inputs FROM targets")}
+
+    def get_durations(self):
+        return dict(self.db.execute("SELECT name, seconds FROM durations"))
+
+    def get_last_seen(self):
+        return (dict(self.db.execute("SELECT path, time FROM seen_files")),
+                dict(self.db.execute("SELECT name, time FROM seen_targets")))
+
+    def update(self, records, targets=None):
+        """
+        Inserts (or replaces) the records of some paths (and the
+        inputs of some targets) in a single transaction
+        """
+        with self.db:
+            self._insert(records, targets)
+
+    def update_durations(self, durations):
+        """
+        Inserts (or replaces) how long the formulas of some
+        targets took to run (in seconds)
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO durations "
+                                "VALUES (?, ?)", list(durations.items()))
+
+    def set_last_seen(self, paths, targets):
+        """
+        Records when a build last saw some paths and targets (both
+        dictionaries of their names to times), which keeps their
+        records from being garbage collected for a while
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO seen_files "
+                                "VALUES (?, ?)", list(paths.items()))
+            self.db.executemany("INSERT OR REPLACE INTO seen_targets "
+                                "VALUES (?, ?)", list(targets.items()))
+
+    def _insert(self, records, targets):
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                            [(path, json.dumps(record, sort_keys=True))
+                             for path, record in records.items()])
+        if targets:
+            self.db.executemany("INSERT OR REPLACE INTO targets VALUES (?, ?)",
+                                [(name, json.dumps(inputs, sort_keys=True))
+                                 for name, inputs in targets.items()])
+
+    def get_paths(self):
+        return [row[0] for row in self.db.execute("SELECT path FROM files")]
+
+    def get_target_names(self):
+        return [row[0] for row in self.db.execute("SELECT name FROM targets "
+                                                  "UNION SELECT name FROM "
+                                                  "durations")]
+
+    def remove(self, paths, targets=None):
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE path = ?",
+                                [(path,) for path in paths])
+            self.db.executemany("DELETE FROM seen_files WHERE path = ?",
+                                [(path,) for path in paths])
+            if targets:
+                self.db.executemany("DELETE FROM targets WHERE name = ?",
+                                    [(name,) for name in targets])
+                self.db.executemany("DELETE FROM durations WHERE name = ?",
+                                    [(name,) for name in targets])
+                self.db.executemany("DELETE FROM seen_targets WHERE "
+                                    "name = ?", [(name,) for name in targets])
+
+    def compact(self):
+        """
+        Gives the space of the deleted records back to the file system
+        """
+        self.db.execute("VACUUM")
+
+    def replace_all(self, records, targets=None):
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM targets")
+            self.db.execute("DELETE FROM durations")
+            self.db.execute("DELETE FROM seen_files")
+            self.db.execute("DELETE FROM seen_targets")
+            self._insert(records, targets)
+
+    def close(self):
+        self.db.close()
+
+
+class YAMLStore(object):
+    """
+    The original store: a YAML document that is read completely
+    at the start of a build and rewritten on every update. So that
+    concurrent invocations of sake don't lose each other's records,
+    every update re-reads the store (under a lock) and merges into it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = {}
+        self.read()
+
+    def read(self):
+        self.contents = {'store format': STORE_FORMAT}
+        if os.path.isfile(self.path):
+            with io.open(self.path, "r") as fh:
+                self.contents = yaml.load(fh.read(), Loader=SafeLoader) or {}
+        if not self.contents.get('files'):
+            self.contents['files'] = {}
+        if not self.contents.get('targets'):
+            self.contents['targets'] = {}
+        if not self.contents.get('durations'):
+            self.contents['durations'] = {}
+        if not self.contents.get('last seen'):
+            self.contents['last seen'] = {}
+        for kind in ('files', 'targets'):
+            if not self.contents['last seen'].get(kind):
+                self.contents['last seen'][kind] = {}
+        self.contents.update(self.meta)
+
+    def get_meta(self, key):
+        return self.contents.get(key)
+
+    def set_meta(self, key, value):
+        self.meta[key] = value
+        self.contents[key] = value
+
+    def get(self, path):
+        return self.contents['files'].get(path)
+
+    def get_all(self):
+        return dict(self.contents['files'])
+
+    def get_target(self, name):
+        return self.contents['targets'].get(name)
+
+    def get_all_targets(self):
+        return dict(self.contents['targets'])
+
+    def get_durations(self):
+        return dict(self.contents['durations'])
+
+    def get_last_seen(self):
+        return (dict(self.contents['last seen']['files']),
+                dict(self.contents['last seen']['targets']))
+
+    def update(self, records, targets=None):
+        with locked(self.path):
+            self.read()
+            self.contents['files'].update(records)
+            if targets:
+                self.contents['targets'].update(targets)
+            self.write()
+
+    def update_durations(self, durations):
+        with locked(self.path):
+            self.read()
+            self.contents['durations'].update(durations)
+            self.write()
+
+    def set_last_seen(self, paths, targets):
+        with locked(self.path):
+            self.read()
+            self.contents['last seen']['files'].update(paths)
+            self.contents['last seen']['targets'].update(targets)
+            self.write()
+
+    def get_paths(self):
+        return list(self.contents['files'])
+
+    def get_target_names(self):
+        return list(set(self.contents['targets']) |
+                    set(self.contents['durations']))
+
+    def remove(self, paths, targets=None):
+        with locked(self.path):
+            self.read()
+            seen = self.contents['last seen']
+            for path in paths:
+                self.contents['files'].pop(path, None)
+                seen['files'].pop(path, None)
+            for name in targets or []:
+                self.contents['targets'].pop(name, None)
+                self.contents['durations'].pop(name, None)
+                seen['targets'].pop(name, None)
+            self.write()
+
+    def compact(self):
+        # (it's rewritten in full on every update anyway)
+        pass
+
+    def replace_all(self, records, targets=None):
+        with locked(self.path):
+            self.read()
+            self.contents['files'] = dict(records)
+            self.contents['targets'] = dict(targets or {})
+            self.contents['durations'] = {}
+            self.contents['last seen'] = {'files': {}, 'targets': {}}
+            self.write()
+
+    def write(self):
+        # the old store is only replaced once the new one is on disk
+        tmp_path = "{}.tmp{}".format(self.path, os.getpid())
+        with io.open(tmp_path, "w") as fh:
+            dump_yaml(self.contents, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+
+BACKENDS = {"sqlite": SQLiteStore, "yaml": YAMLStore}
+
+
+# the locks this process holds (and how many times), since a
+# second flock() of the same file by the same process would block
+HELD_LOCKS = {}
+
+
+@contextmanager
+def locked(store_path):
+    """
+    Holds the (exclusive) lock of the store at a path while the
+    body of the with statement runs (where file locks are available)
+    """
+    lock_path = os.path.abspath(os.path.join(os.path.dirname(store_path),
+                                             LOCK))
+    if lock_path in HELD_LOCKS:
+        HELD_LOCKS[lock_path] += 1
+        try:
+            yield
+        finally:
+            HELD_LOCKS[lock_path] -= 1
+        return
+    with io.open(lock_path, "a") as fh:
+        if fcntl:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        HELD_LOCKS[lock_path] = 1
+        try:
+            yield
+        finally:
+            del HELD_LOCKS[lock_path]
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+class LazyRecords(object):
+    """
+    A read-only, dict-like view of the records in a store. A record
+    is only read from the store (with the getter supplied, like the
+    store's get() or get_target()) the first time it's asked for, so
+    the cost of a build doesn't depend on the size of the store but
+    on the number of files it looks at. Records that are assigned
+    to it only change the view (they are cached), not the store
+    """
+
+    _MISSING = object()
+
+    def __init__(self, getter, records=None):
+        self.getter = getter
+        self.cache = dict(records) if records else {}
+
+    def get(self, path, default=None):
+        if path not in self.cache:
+            record = self.getter(path)
+            self.cache[path] = self._MISSING if record is None else record
+        record = self.cache[path]
+        return default if record is self._MISSING else record
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __getitem__(self, path):
+        record = self.get(path)
+        if record is None:
+            raise KeyError(path)
+        return record
+
+    def __setitem__(self, path, record):
+        self.cache[path] = record
+
+
+def get_store_format(path):
+    """
+    Returns the name of the backend that wrote the store
+    at a path (or None if there is no store there)
+    """
+    if not os.path.isfile(path):
+        return None
+    with io.open(path, "rb") as fh:
+        header = fh.read(len(SQLITE_MAGIC))
+    if header == SQLITE_MAGIC:
+        return "sqlite"
+    # an empty file was just created by SQLite
+    if not header:
+        return "sqlite"
+    return "yaml"
+
+
+def open_store(settings, path=SHASTORE):
+    """
+    Opens the store with the backend chosen in the settings
+    (settings["store_backend"], SQLite by default). A store that
+    was written by another backend is migrated to it first
+
+    Args:
+        The settings dictionary
+        An optional path to the store
+
+    Returns:
+        The store object, whose methods are get_meta(), set_meta(),
+        get(), get_all(), get_paths(), get_target(), get_all_targets(),
+        get_target_names(), get_durations(), get_last_seen(), update(),
+        update_durations(), set_last_seen(), remove(), replace_all(),
+        compact() and close()
+    """
+    backend = settings.get("store_backend") or DEFAULT_BACKEND
+    found = get_store_format(path)
+    if found and found != backend:
+        with locked(path):
+            # (unless another sake process just migrated it)
+            if get_store_format(path) != backend:
+                migrate_store(path, found, backend, settings)
+    return BACKENDS[backend](path)
+
+
+def get_format_version(shastore):
+    """
+    Returns the format version of the records in a store (see
+    STORE_FORMAT). Stores from before it was recorded are told
+    apart by whether sake stamped its version in them
+    """
+    found = shastore.get_meta('store format')
+    if found:
+        return int(found)
+    if shastore.get_meta('sake version'):
+        return 1
+    return 0
+
+
+def migrate_store(path, found, backend, settings):
+    """
+    Rewrites the store at a path (written by the 'found'
+    backend) with another backend
+    """
+    sprint = settings["sprint"]
+    sprint("Migrating {} from {} to {}".format(path, found, backend),
+           level="verbose")
+    old_store = BACKENDS[found](path)
+    meta = {key: old_store.get_meta(key) for key in
+            ("sake version", "store format")}
+    records = old_store.get_all()
+    targets = old_store.get_all_targets()
+    durations = old_store.get_durations()
+    seen_files, seen_targets = old_store.get_last_seen()
+    old_store.close()
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    new_store = BACKENDS[backend](tmp_path)
+    for key, value in meta.items():
+        new_store.set_meta(key, value)
+    new_store.replace_all(records, targets)
+    new_store.update_durations(durations)
+    new_store.set_last_seen(seen_files, seen_targets)
+    new_store.close()
+    os.replace(tmp_path, path)
+
+
+class Journal(object):
+    """
+    An append-only log of the records of the targets that finished
+    (of their files and of their inputs). Entries are flushed to the
+    OS right away and fsync-ed in batches. The journal is locked for
+    as long as it's open, which tells other sake processes that it
+    isn't the journal of an interrupted build
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = "{}.{}".format(JOURNAL, os.getpid())
+        self.path = path
+        self.fh = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def open(self):
+        # it's locked before it gets its name, so that no other sake
+        # process can catch it unlocked
+        new_path = self.path + ".new"
+        self.fh = io.open(new_path, "a")
+        if fcntl:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+        os.replace(new_path, self.path)
+
+    def append(self, records, targets=None):
+        if self.fh is None:
+            self.open()
+        entry = {"files": records, "targets": targets or {}}
+        self.fh.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.fh.flush()
+        self.unsynced += 1
+        if (self.unsynced >= JOURNAL_SYNC_ENTRIES or
+                time.time() - self.last_sync >= JOURNAL_SYNC_SECONDS):
+            self.sync()
+
+    def sync(self):
+        if self.fh is not None and self.unsynced:
+            os.fsync(self.fh.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.fh is not None:
+            self.sync()
+            self.fh.close()
+            self.fh = None
+
+    def discard(self):
+        """
+        Removes the journal once its entries are in the store
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.close()
+
+
+def read_journal(path=JOURNAL):
+    """
+    Returns the records of the files and the inputs of the targets
+    in a journal (the later entries win). A torn last line, from a
+    build that was killed mid-write, is ignored
+    """
+    records = {}
+    targets = {}
+    try:
+        fh = io.open(path, "r")
+    except FileNotFoundError:
+        return records, targets
+    with fh:
+        for line in fh:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            records.update(entry["files"])
+            targets.update(entry["targets"])
+    return records, targets
+
+
+def replay_journal(shastore, settings, path=JOURNAL):
+    """
+    Folds the journals left behind by interrupted builds into the
+    store (each in a single update) and removes them, so the targets
+    that finished before the interruptions don't run again. Journals
+    that are still locked belong to sake processes that are running,
+    and journals that vanish (or are replaced) along the way were
+    discarded or replayed by another sake process. Journals that
+    never got past being opened are replayed (and removed) as well,
+    once they're older than JOURNAL_STALE_NEW
+
+    Args:
+        The store object
+        The settings dictionary
+        An optional prefix of the paths of the journals
+    """
+    sprint = settings["sprint"]
+    for journal in sorted(glob.glob(glob.escape(path) + "*")):
+        try:
+            if (journal.endswith(".new") and
+                    time.time() - os.stat(journal).st_mtime <
+                    JOURNAL_STALE_NEW):
+                continue
+            fh = io.open(journal, "r")
+        except FileNotFoundError:
+            continue
+        with fh:
+            if fcntl:
+                try:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            # (it may have been replayed while we waited for the lock)
+            try:
+                if not os.path.samestat(os.fstat(fh.fileno()),
+                                        os.stat(journal)):
+                    continue
+            except FileNotFoundError:
+                continue
+            records, targets = read_journal(journal)
+            if records or targets:
+                outstr = "Recovering {} records from {}"
+                sprint(outstr.format(len(records), journal),
+                       level="verbose")
+                shastore.update(records, targets)
+            try:
+                os.remove(journal)
+            except FileNotFoundError:
+                pass
+
+
+def needs_compaction(shastore):
+    """
+    Returns True if the garbage collection policy (GC_MAX_AGE and
+    GC_GROWTH) says that the store should be compacted now
+    """
+    size = os.path.getsize(shastore.path)
+    last_gc = shastore.get_meta('last gc')
+    if not last_gc:
+        # (the clock starts with the first build that uses it)
+        shastore.set_meta('last gc', str(time.time()))
+        shastore.set_meta('gc size', str(size))
+        return False
+    if time.time() - float(last_gc) > GC_MAX_AGE:
+        return True
+    gc_size = max(int(shastore.get_meta('gc size') or 0), GC_MIN_SIZE)
+    return size > GC_GROWTH * gc_size
+
+
+def collect_garbage(shastore, live_paths, live_targets, max_age=None):
+    """
+    Removes the records of the files that aren't (inside) one of
+    the live paths, and the inputs of the targets that aren't live,
+    and then compacts the store. With a maximum age, only the ones
+    that no build has seen (see set_last_seen()) for that long are
+    removed. Records from before sake kept track of that start their
+    clock now
+
+    Args:
+        The store object
+        The paths of all of the dependencies and outputs of the graph
+        The names of all of the targets of the graph
+        An optional maximum age of the records (in seconds)
+
+    Returns:
+        A tuple of the number of file records and the number
+        of target records that were removed
+    """
+    live_paths = set(live_paths)
+    live_dirs = set(path for path in live_paths if os.path.isdir(path))
+
+    def is_live(path):
+        if path in live_paths:
+            return True
+        parent = os.path.dirname(path)
+        while parent and parent not in live_dirs:
+            if os.path.dirname(parent) == parent:
+                return False
+            parent = os.path.dirname(parent)
+        return bool(parent)
+
+    dead_paths = [path for path in shastore.get_paths() if not is_live(path)]
+    live_targets = set(live_targets)
+    dead_targets = [name for name in shastore.get_target_names()
+                    if name not in live_targets]
+    if max_age is not None:
+        now = time.time()
+        seen_files, seen_targets = shastore.get_last_seen()
+        shastore.set_last_seen(
+            {path: now for path in dead_paths if path not in seen_files},
+            {name: now for name in dead_targets if name not in seen_targets})
+        dead_paths = [path for path in dead_paths
+                      if now - seen_files.get(path, now) > max_age]
+        dead_targets = [name for name in dead_targets
+                        if now - seen_targets.get(name, now) > max_age]
+    shastore.remove(dead_paths, dead_targets)
+    shastore.compact()
+    shastore.set_meta('last gc', str(time.time()))
+    shastore.set_meta('gc size', str(os.path.getsize(shastore.path)))
+    return len(dead_paths), len(dead_targets)
+
+
+def dump_yaml(contents, fh):
+    """
+    Writes the contents of a store (the 'files' records, the
+    'targets' inputs and the meta keys) in the original YAML
+    format of the .shastore
+    """
+    contents = {key: value for key, value in contents.items()
+                if value and key != "sake version"}
+    fh.write("---\n")
+    fh.write('sake version: {}\n'.format(constants.VERSION))
+    if contents:
+        fh.write(yaml.dump(contents, Dumper=SafeDumper))
+    fh.write("...")
+
+
+def dump_store(settings, filename=None):
+    """
+    Exports the .shastore to YAML (the original format of the store)
+    for debugging or for older tools. Used by `sake dump-store`
+
+    Args:
+        The settings dictionary
+        An optional file to write the YAML to (stdout if None)
+
+    Returns:
+        0 if successful
+    """
+    error = settings["error"]
+    if not get_store_format(SHASTORE):
+        error("There is no {} to dump".format(SHASTORE))
+        return 1
+    shastore = BACKENDS[get_store_format(SHASTORE)](SHASTORE)
+    contents = {'files': shastore.get_all(),
+                'targets': shastore.get_all_targets(),
+                'durations': shastore.get_durations(),
+                'store format': shastore.get_meta('store format')}
+    shastore.close()
+    if filename:
+        with io.open(filename, "w") as fh:
+            dump_yaml(contents, fh)
+    else:
+        dump_yaml(contents, sys.stdout)
+        sys.stdout.write("\n")
+    return 0
@@ -4,12 +4,26 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import hashlib
 import io
+import json
+import networkx as nx
 import ntpath
 import os
 import posixpath
 from sakelib import acts
+from sakelib import audit
+from sakelib import build
+from sakelib import cache
+from sakelib import cache_server
+from sakelib import constants
+from sakelib import store
 import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import time
 from testlib import utobjs
 import unittest
 import yaml
@@ -109,6 +123,974 @@ class TestActsFunction(unittest.TestCase):
         self.assertEqual(acts.get_all_outputs({'output': ['./tmp/sile1.*']}),
                          ['./tmp/sile1.*'])
 
+    def test_construct_graph_links(self):
+        join = os.path.join
+        sakefile = {
+            "objects": {"formula": "make", "output": [join("build", "a.o")],
+                        "dependencies": []},
+            "docs": {"formula": "make", "output": [join("build", "docs")],
+                     "dependencies": [join("build", "docs", "conf.py")]},
+            "link": {"formula": "make", "output": ["prog"],
+                     "dependencies": [join("build", "*.o")]},
+            "manual": {"formula": "make", "output": ["manual.pdf"],
+                       "dependencies": [join("build", "docs", "index.html")]},
+            "package": {"formula": "make", "output": ["dist.tar"],
+                        "dependencies": ["build", "prog"]}}
+        settings = {"verbose": False, "color": False}
+        settings["sprint"] = acts.get_print_functions(settings)[0]
+        G = acts.construct_graph(sakefile, settings)
+        self.assertEqual(sorted(G.predecessors("link")), ["objects"])
+        self.assertEqual(sorted(G.predecessors("manual")), ["docs"])
+        self.assertEqual(sorted(G.predecessors("package")),
+                         ["docs", "link", "objects"])
+        self.assertEqual(sorted(G.predecessors("docs")), [])
+
+
+
+class TestBuildFunction(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./tmp")
+        with io.open("./tmp/file1.txt", "w") as fh:
+            fh.write("1")
+        # backdate the file so its stat identity can be trusted
+        os.utime("./tmp/file1.txt", (1000000000, 1000000000))
+        self.settings = {"verbose": False, "color": False}
+        sprint, warn, error = acts.get_print_functions(self.settings)
+        self.settings.update({"sprint": sprint, "warn": warn,
+                              "error": error})
+
+    def tearDown(self):
+        build.shutdown_hash_executor(self.settings)
+        shutil.rmtree('./tmp/')
+
+    def test_get_file_record(self):
+        record = build.get_file_record("./tmp/file1.txt")
+        self.assertEqual(record["sha"],
+                         "356a192b7913b04c54574d18c28d46e6395428ab")
+        self.assertEqual(record["size"], 1)
+        self.assertEqual(record["mtime_ns"], 1000000000 * 10**9)
+        # unchanged stat identity means the old sha is trusted
+        stale = dict(record, sha="not-really-a-sha")
+        self.assertEqual(build.get_file_record("./tmp/file1.txt",
+                                               stale)["sha"],
+                         "not-really-a-sha")
+        # ...unless we ask to verify
+        self.assertEqual(build.get_file_record("./tmp/file1.txt", stale,
+                                               verify=True)["sha"],
+                         record["sha"])
+        # and any change of the stat identity forces a rehash
+        with io.open("./tmp/file1.txt", "w") as fh:
+            fh.write("2")
+        os.utime("./tmp/file1.txt", (1000000001, 1000000001))
+        self.assertEqual(build.get_file_record("./tmp/file1.txt",
+                                               stale)["sha"],
+                         "da4b9237bacccdf19c0760cab7aec4a8359010b0")
+
+    def test_hash_algorithm_migration(self):
+        old_record = build.get_file_record("./tmp/file1.txt")
+        self.assertEqual(build.get_record_algorithm(old_record), "sha1")
+        # touching the file changes its stat identity but not its content
+        os.utime("./tmp/file1.txt", (1000000001, 1000000001))
+        record = build.get_file_record("./tmp/file1.txt", old_record,
+                                       algorithm="blake2b")
+        self.assertEqual(record["algorithm"], "blake2b")
+        self.assertEqual(record["sha"],
+                         build.get_sha("./tmp/file1.txt",
+                                       algorithm="blake2b"))
+        # the old record was migrated, so it still matches
+        self.assertTrue(build.same_fingerprint(record, old_record))
+        # a real change is still a mismatch
+        old_record = dict(old_record, algorithm="sha1",
+                          sha="356a192b7913b04c54574d18c28d46e6395428ab")
+        with io.open("./tmp/file1.txt", "w") as fh:
+            fh.write("2")
+        record = build.get_file_record("./tmp/file1.txt", old_record,
+                                       algorithm="blake2s")
+        self.assertFalse(build.same_fingerprint(record, old_record))
+
+    def test_hash_memo(self):
+        self.settings["hash_memo"] = {}
+        record = build.get_memoized_record("./tmp/file1.txt", self.settings)
+        identity, memoized = self.settings["hash_memo"]["./tmp/file1.txt"]
+        self.assertEqual(memoized, record)
+        # as long as the identity doesn't change, the memo is used
+        memoized["sha"] = "from-the-memo"
+        self.assertEqual(build.get_memoized_record("./tmp/file1.txt",
+                                                   self.settings)["sha"],
+                         "from-the-memo")
+        # until the file is forgotten (because its target finished)
+        build.forget_records(["./tmp/file1.txt"], self.settings)
+        self.assertEqual(build.get_memoized_record("./tmp/file1.txt",
+                                                   self.settings)["sha"],
+                         record["sha"])
+
+    def test_directory_records(self):
+        os.makedirs("./tmp/data/sub")
+        os.makedirs("./tmp/data/other")
+        for name in ["a.txt", "sub/b.txt", "other/c.txt"]:
+            with io.open(os.path.join("./tmp/data", name), "w") as fh:
+                fh.write(name)
+        for path in ["./tmp/data/a.txt", "./tmp/data/sub/b.txt",
+                     "./tmp/data/other/c.txt", "./tmp/data/sub",
+                     "./tmp/data/other", "./tmp/data"]:
+            os.utime(path, (1000000000, 1000000000))
+        first = build.take_records_of_paths(["./tmp/data"], self.settings, {})
+        self.assertEqual(first["./tmp/data"]["scheme"], "merkle")
+        self.assertIn("./tmp/data/sub/b.txt", first)
+        self.assertIn("./tmp/data/sub", first)
+        # unchanged subtrees reuse their stored hash
+        old = dict((k, dict(v)) for k, v in first.items())
+        old["./tmp/data/other"]["sha"] = "cached"
+        again = build.take_records_of_paths(["./tmp/data"], self.settings,
+                                            old)
+        self.assertEqual(again["./tmp/data/other"]["sha"], "cached")
+        # a change to a file rehashes the path from it to the root
+        with io.open("./tmp/data/sub/b.txt", "w") as fh:
+            fh.write("changed")
+        os.utime("./tmp/data/sub/b.txt", (1000000001, 1000000001))
+        changed = build.take_records_of_paths(["./tmp/data"], self.settings,
+                                              old)
+        self.assertEqual(changed["./tmp/data/other"]["sha"], "cached")
+        self.assertNotEqual(changed["./tmp/data/sub"]["sha"],
+                            first["./tmp/data/sub"]["sha"])
+        self.assertNotEqual(changed["./tmp/data"]["sha"],
+                            first["./tmp/data"]["sha"])
+
+    def test_chunk_hashing_jobs(self):
+        with io.open("./tmp/big.dat", "wb") as fh:
+            fh.write(b"x" * build.SMALL_FILE_SIZE)
+        jobs = [("./tmp/file1.txt", None, False, "sha1", False),
+                ("./tmp/nothere.txt", None, False, "sha1", False),
+                ("./tmp/big.dat", None, False, "sha1", False)]
+        chunks = build.chunk_hashing_jobs(jobs)
+        # the big file goes first, in a chunk of its own
+        self.assertEqual(chunks[0], [jobs[2]])
+        self.assertEqual(chunks[1], [jobs[0], jobs[1]])
+
+    def test_mapped_hashing(self):
+        content = b"sake" * 100000
+        with io.open("./tmp/big.dat", "wb") as fh:
+            fh.write(content)
+        expected = build.get_sha("./tmp/big.dat", algorithm="blake2b")
+        old_sizes = build.MMAP_MIN_SIZE, build.DROP_BEHIND_SIZE
+        try:
+            build.MMAP_MIN_SIZE = 1
+            build.DROP_BEHIND_SIZE = 65536
+            self.assertEqual(build.get_sha("./tmp/big.dat",
+                                           algorithm="blake2b"), expected)
+        finally:
+            build.MMAP_MIN_SIZE, build.DROP_BEHIND_SIZE = old_sizes
+        self.assertEqual(build.pick_blocksize(len(content)), 65536)
+        self.assertEqual(build.pick_blocksize(2**31), 4 * 1024 * 1024)
+
+    def test_tree_hashing(self):
+        content = b"0123456789" * 1000
+        with io.open("./tmp/big.dat", "wb") as fh:
+            fh.write(content)
+        os.utime("./tmp/big.dat", (1000000000, 1000000000))
+        old_sizes = build.TREE_HASH_MIN_SIZE, build.TREE_SEGMENT_SIZE
+        try:
+            build.TREE_HASH_MIN_SIZE = 5000
+            build.TREE_SEGMENT_SIZE = 4096
+            flat_record = build.get_file_record("./tmp/big.dat")
+            self.assertEqual(flat_record["scheme"], "flat")
+            # the flat record of the same content is migrated
+            record = build.get_file_record("./tmp/big.dat", flat_record,
+                                           verify=True, tree_hash=True)
+        finally:
+            build.TREE_HASH_MIN_SIZE, build.TREE_SEGMENT_SIZE = old_sizes
+        self.assertEqual(record["scheme"], "tree:4096")
+        self.assertTrue(build.same_fingerprint(record, flat_record))
+        combined = hashlib.sha1()
+        for offset in range(0, len(content), 4096):
+            combined.update(hashlib.sha1(content[offset:offset+4096]).digest())
+        self.assertEqual(record["sha"], combined.hexdigest())
+        self.assertEqual(build.get_fingerprints("./tmp/big.dat",
+                                                [("sha1", "tree:4096")])[0],
+                         record["sha"])
+
+    def test_take_records_of_these(self):
+        with io.open("./tmp/file2.txt", "w") as fh:
+            fh.write("2")
+        jobs = [("./tmp/file1.txt", None, False, "sha1", False),
+                ("./tmp/file2.txt", None, False, "sha1", False)]
+        for strategy in ["threads", "processes"]:
+            self.settings["hash_strategy"] = strategy
+            self.settings["hash_workers"] = 2
+            results = build.take_records_of_these(jobs, self.settings)
+            self.assertEqual(results["./tmp/file2.txt"][0]["sha"],
+                             "da4b9237bacccdf19c0760cab7aec4a8359010b0")
+            self.assertEqual(results["./tmp/file1.txt"][0]["sha"],
+                             "356a192b7913b04c54574d18c28d46e6395428ab")
+            build.shutdown_hash_executor(self.settings)
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_commit_takes_no_new_records(self):
+        os.makedirs("./tmp/project")
+        G = nx.DiGraph()
+        for i in range(3):
+            with io.open("./tmp/project/in{}.txt".format(i), "w") as fh:
+                fh.write(str(i))
+            os.utime("./tmp/project/in{}.txt".format(i),
+                     (1000000000, 1000000000))
+            G.add_node("t{}".format(i), dependencies=["in{}.txt".format(i)],
+                       formula="cp in{0}.txt out{0}.txt".format(i),
+                       output=["out{}.txt".format(i)])
+        self.build_project("./tmp/project", G)
+        with io.open("./tmp/project/in0.txt", "w") as fh:
+            fh.write("changed")
+        # only the changed dependency, and the output of the target
+        # that reran, are hashed (and nothing else when committing)
+        hashed = self.build_project("./tmp/project", G)
+        self.assertNotIn("in1.txt", hashed)
+        self.assertNotIn("out1.txt", hashed)
+        self.assertIn("out0.txt", hashed)
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_no_op_build_hashes_nothing(self):
+        os.makedirs("./tmp/project")
+        with io.open("./tmp/project/in.txt", "w") as fh:
+            fh.write("in")
+        os.utime("./tmp/project/in.txt", (1000000000, 1000000000))
+        G = nx.DiGraph()
+        G.add_node("first", dependencies=["in.txt"], output=["mid.txt"],
+                   formula="cp in.txt mid.txt")
+        G.add_node("second", dependencies=["mid.txt"], output=["out.txt"],
+                   formula="cp mid.txt out.txt")
+        G.add_edge("first", "second")
+        self.build_project("./tmp/project", G)
+        # the outputs were just written, but their stats were still
+        # recorded when the build committed
+        self.assertEqual(self.build_project("./tmp/project", G), [])
+
+    def test_needs_to_run_is_lazy(self):
+        with io.open("./tmp/file2.txt", "w") as fh:
+            fh.write("2")
+        G = nx.DiGraph()
+        G.add_node("one", dependencies=["./tmp/file1.txt", "./tmp/file2.txt"])
+        self.settings.update({"force": False, "hash_workers": 1})
+        from_store = {"files": {
+            "./tmp/file1.txt": {"sha": "not-the-sha-of-file1"},
+            "./tmp/file2.txt": {"sha": "da4b9237bacccdf19c0760cab7aec4a8359010b0"}}}
+        in_mem = {"files": {}}
+        self.assertTrue(build.needs_to_run(G, "one", in_mem, from_store,
+                                           self.settings))
+        # the first mismatch means the second dep was never hashed
+        self.assertIn("./tmp/file1.txt", in_mem["files"])
+        self.assertNotIn("./tmp/file2.txt", in_mem["files"])
+        # a dep that's missing from the store needs no hashing at all
+        del from_store["files"]["./tmp/file2.txt"]
+        in_mem = {"files": {}}
+        self.assertTrue(build.needs_to_run(G, "one", in_mem, from_store,
+                                           self.settings))
+        self.assertEqual(in_mem["files"], {})
+
+    def build_project(self, project, G, **settings):
+        """
+        Builds a graph (with build_this_graph()) from a project
+        directory and returns the paths that were hashed
+        """
+        self.settings.update({"force": False, "quiet": True, "recon": False,
+                              "parallel": False, "no_enhanced_errors": False,
+                              "hash_workers": 1, "hash_strategy": "threads"})
+        self.settings.update(settings)
+        hashed = []
+        get_fingerprints = build.get_fingerprints
+
+        def counting(a_file, kinds, settings=None):
+            hashed.append(a_file)
+            return get_fingerprints(a_file, kinds, settings)
+
+        build.get_fingerprints = counting
+        cwd = os.getcwd()
+        os.chdir(project)
+        try:
+            build.build_this_graph(G, self.settings)
+        finally:
+            os.chdir(cwd)
+            build.get_fingerprints = get_fingerprints
+        return hashed
+
+    def run_in_parallel(self, G, in_mem=None, from_store=None, **settings):
+        """
+        Builds a graph with the parallel executor (quietly, and with a
+        journal of its own) and returns what parallel_run_graph() does
+        """
+        self.settings.update({"force": False, "quiet": True, "jobs": None,
+                              "no_enhanced_errors": False,
+                              "journal": store.Journal("./tmp/journal")})
+        self.settings.update(settings)
+        if in_mem is None:
+            in_mem = {"files": {}, "targets": {}}
+        if from_store is None:
+            from_store = {"files": {}, "targets": {}}
+        try:
+            return build.parallel_run_graph(G, in_mem, from_store,
+                                            self.settings)
+        finally:
+            self.settings["journal"].discard()
+
+    def make_logged_graph(self, **attributes):
+        """
+        Returns a graph of three independent targets whose formulas
+        log when they start and when they end
+        """
+        G = nx.DiGraph()
+        for name in ["one", "two", "three"]:
+            G.add_node(name, output=["./tmp/{}.txt".format(name)],
+                       formula="echo start >> ./tmp/log; sleep 0.2; "
+                               "echo end >> ./tmp/log; "
+                               "touch ./tmp/{}.txt".format(name),
+                       **attributes)
+        return G
+
+    def assertRanOneAtATime(self):
+        with io.open("./tmp/log") as fh:
+            self.assertEqual(fh.read().split(), ["start", "end"] * 3)
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_ready_queue(self):
+        G = nx.DiGraph()
+        G.add_node("slow", output=["./tmp/slow.txt"],
+                   formula="sleep 1; echo slow | tee -a ./tmp/order "
+                           "> ./tmp/slow.txt")
+        G.add_node("first", formula="echo first > ./tmp/first.txt",
+                   output=["./tmp/first.txt"])
+        G.add_node("second", formula="echo second >> ./tmp/order",
+                   dependencies=["./tmp/first.txt"])
+        G.add_edge("first", "second")
+        in_mem = {"files": {}, "targets": {}}
+        self.run_in_parallel(G, in_mem)
+        # "second" didn't wait for "slow", which was started with "first"
+        with io.open("./tmp/order") as fh:
+            self.assertEqual(fh.read().split(), ["second", "slow"])
+        self.assertIn("second", in_mem["targets"])
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_job_slots(self):
+        self.run_in_parallel(self.make_logged_graph(), jobs=1)
+        self.assertRanOneAtATime()
+        self.assertTrue(build.can_start_another(0, self.settings))
+        self.assertFalse(build.can_start_another(1, self.settings))
+        # -j auto stays between one and a couple of jobs per CPU
+        self.settings["jobs"] = "auto"
+        for _ in range(3):
+            self.settings.pop("cpu_sample", None)
+            build.can_start_another(1, self.settings)
+            self.assertGreaterEqual(self.settings["auto_jobs"], 1)
+            self.assertLessEqual(self.settings["auto_jobs"],
+                                 build.AUTO_MAX_JOBS_PER_CPU * os.cpu_count())
+
+    def test_resource_parsing(self):
+        self.assertEqual(acts.parse_amount("60G"), 60 * 1024 ** 3)
+        self.assertEqual(acts.parse_amount("512 MB"), 512 * 1024 ** 2)
+        self.assertEqual(acts.parse_capacities("cpus=16,gpu-license=1"),
+                         {"cpus": 16.0, "gpu-license": 1.0})
+        for bad in ["-1", "lots", True]:
+            self.assertRaises(ValueError, acts.parse_amount, bad)
+        self.assertFalse(audit.check_target_integrity("bad", {
+            "help": "h", "formula": "f", "resources": {"memory": "a lot"}}))
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_resource_admission(self):
+        G = self.make_logged_graph(resources={"gpu-license": 1})
+        # a pool that the host doesn't have can't be waited for
+        with self.assertRaises(SystemExit):
+            self.run_in_parallel(G)
+        # with one license, only one of them can run at a time
+        self.run_in_parallel(G, resources={"gpu-license": 1.0})
+        self.assertRanOneAtATime()
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_keep_going_and_fail_fast(self):
+        G = nx.DiGraph()
+        G.add_node("bad", output=["./tmp/bad.txt"], formula="exit 1")
+        G.add_node("after bad", output=["./tmp/after.txt"],
+                   formula="touch ./tmp/after.txt")
+        G.add_node("slow", output=["./tmp/slow.txt"],
+                   formula="sleep 1; touch ./tmp/slow.txt")
+        G.add_edge("bad", "after bad")
+        # the branches that don't depend on the failure are still built
+        failed, skipped = self.run_in_parallel(G, keep_going=True)
+        self.assertEqual((failed, skipped), (["bad"], ["after bad"]))
+        self.assertTrue(os.path.exists("./tmp/slow.txt"))
+        os.remove("./tmp/slow.txt")
+        # and the ones that are running are stopped with --fail-fast
+        start = time.time()
+        with self.assertRaises(SystemExit):
+            self.run_in_parallel(G, keep_going=False, fail_fast=True)
+        self.assertLess(time.time() - start, 1)
+        # (along with what their shells started)
+        time.sleep(1.2)
+        self.assertFalse(os.path.exists("./tmp/slow.txt"))
+        # and every target that wasn't done is reported as skipped, even
+        # the ones behind a target that finished after the failure
+        G.add_node("stubborn", output=["./tmp/stubborn.txt"],
+                   formula="trap '' TERM; sleep 0.5; "
+                           "touch ./tmp/stubborn.txt")
+        G.add_node("after stubborn", output=["./tmp/last.txt"],
+                   dependencies=["./tmp/stubborn.txt"],
+                   formula="touch ./tmp/last.txt")
+        G.add_edge("stubborn", "after stubborn")
+        reported = []
+        report_unbuilt = build.report_unbuilt
+        build.report_unbuilt = lambda *args: reported.append(args[:2])
+        try:
+            with self.assertRaises(SystemExit):
+                self.run_in_parallel(G, keep_going=False, fail_fast=True)
+        finally:
+            build.report_unbuilt = report_unbuilt
+        self.assertTrue(os.path.exists("./tmp/stubborn.txt"))
+        self.assertEqual([(failed, sorted(skipped))
+                          for failed, skipped in reported],
+                         [(["bad"], ["after bad", "after stubborn", "slow"])])
+
+    @unittest.skipIf(sys.platform == "win32", "formulas use a POSIX shell")
+    def test_critical_path_first(self):
+        G = nx.DiGraph()
+        for name in ["alone", "deep", "deeper"]:
+            G.add_node(name, output=["./tmp/{}.txt".format(name)],
+                       formula="echo {0} >> ./tmp/order; "
+                               "touch ./tmp/{0}.txt".format(name))
+        G.add_edge("deep", "deeper")
+        durations = {"alone": 3.0, "deep": 1.0, "deeper": 5.0}
+        self.assertEqual(build.get_critical_paths(G, durations),
+                         {"alone": 3.0, "deep": 6.0, "deeper": 5.0})
+        in_mem = {"files": {}, "targets": {}}
+        self.run_in_parallel(G, in_mem, {"files": {}, "targets": {},
+                                         "durations": durations}, jobs=1)
+        with io.open("./tmp/order") as fh:
+            self.assertEqual(fh.read().split(), ["deep", "deeper", "alone"])
+        self.assertEqual(sorted(in_mem["durations"]),
+                         ["alone", "deep", "deeper"])
+        # the durations are kept (and collected) with the targets
+        for backend in ["sqlite", "yaml"]:
+            self.settings["store_backend"] = backend
+            shastore = store.open_store(self.settings,
+                                        path="./tmp/shastore." + backend)
+            shastore.update_durations(durations)
+            self.assertEqual(shastore.get_durations(), durations)
+            store.collect_garbage(shastore, [], ["deep", "deeper"])
+            self.assertEqual(sorted(shastore.get_durations()),
+                             ["deep", "deeper"])
+            shastore.close()
+
+    def test_json_sakefile_macros(self):
+        text = ('#! OUT = o.txt\n'
+                '{"make it": {"help": "makes $OUT", "formula": "touch $OUT",\n'
+                '             "output": ["$OUT"]}}\n')
+        expanded, includes = acts.expand_macros(text, {})
+        self.assertEqual(acts.parse("Sakefile.json", expanded, includes),
+                         {"make it": {"help": "makes o.txt",
+                                      "formula": "touch o.txt",
+                                      "output": ["o.txt"]}})
+
+    def test_sakefile_parsers(self):
+        sakefile = {}
+        for i in range(10000):
+            sakefile["target {}".format(i)] = {
+                "help": "makes output{}".format(i),
+                "dependencies": ["input{}".format(i),
+                                 "output{}".format(i+1)],
+                "formula": "cat input{0} > output{0}".format(i),
+                "output": ["output{}".format(i)]}
+        yaml_text = yaml.dump(sakefile, Dumper=store.SafeDumper)
+        json_text = json.dumps(sakefile)
+        self.assertEqual(acts.parse("Sakefile", yaml_text, {}), sakefile)
+        self.assertEqual(acts.parse("Sakefile.json", json_text, {}), sakefile)
+        # YAML goes through libyaml whenever PyYAML was built with it
+        if yaml.__with_libyaml__:
+            self.assertIs(acts.SafeLoader, yaml.CSafeLoader)
+            self.assertIs(store.SafeLoader, yaml.CSafeLoader)
+            self.assertIs(store.SafeDumper, yaml.CSafeDumper)
+        else:
+            self.assertIs(acts.SafeLoader, yaml.SafeLoader)
+
+    def test_target_inputs(self):
+        G = nx.DiGraph()
+        G.add_node("one", dependencies=["./tmp/file1.txt"])
+        G.add_node("two", dependencies=["./tmp/file1.txt"])
+        G.add_node("three", dependencies=["./tmp/file1.txt"])
+        self.settings["force"] = False
+        new = {"sha": "356a192b7913b04c54574d18c28d46e6395428ab"}
+        old = {"sha": "da4b9237bacccdf19c0760cab7aec4a8359010b0"}
+        # "one" was built after the file changed, "two" wasn't
+        from_store = {"files": {"./tmp/file1.txt": new},
+                      "targets": {"one": {"./tmp/file1.txt": new},
+                                  "two": {"./tmp/file1.txt": old}}}
+        in_mem = {"files": {}}
+        self.assertFalse(build.needs_to_run(G, "one", in_mem, from_store,
+                                            self.settings))
+        self.assertTrue(build.needs_to_run(G, "two", in_mem, from_store,
+                                           self.settings))
+        # "three" falls back to the record of the file, and from
+        # now on has its own fingerprints
+        self.assertFalse(build.needs_to_run(G, "three", in_mem, from_store,
+                                            self.settings))
+        self.assertEqual(in_mem["targets"]["three"]["./tmp/file1.txt"]["sha"],
+                         new["sha"])
+
+    def test_collection_is_linear(self):
+        os.mkdir("./tmp/bench")
+        for i in range(1000):
+            with io.open("./tmp/bench/f{}.txt".format(i), "w") as fh:
+                fh.write("")
+
+        def count_filesystem_work(num_files):
+            # every target shares a dependency with the next one
+            G = nx.DiGraph()
+            for i in range(num_files // 2):
+                G.add_node(i, dependencies=["./tmp/bench/f{}.txt".format(i),
+                                            "./tmp/bench/f{}.txt".format(i+1)],
+                           output=["./tmp/bench/o{}.txt".format(i)])
+            # the stat calls made and the directory entries read
+            work = {"stats": 0, "entries": 0}
+            stat, lstat, scandir = os.stat, os.lstat, os.scandir
+
+            def counted(function):
+                def wrapper(*args, **kwargs):
+                    work["stats"] += 1
+                    return function(*args, **kwargs)
+                return wrapper
+
+            class CountedScandir(object):
+                def __init__(self, *args):
+                    self.it = scandir(*args)
+
+                def __enter__(self):
+                    return self
+
+                def __exit__(self, *exc_info):
+                    self.it.close()
+
+                def __iter__(self):
+                    for entry in self.it:
+                        work["entries"] += 1
+                        yield entry
+
+            os.stat, os.lstat = counted(stat), counted(lstat)
+            os.scandir = CountedScandir
+            try:
+                all_files = build.collect_all_files(G, self.settings)
+                files, dirs = build.classify_paths(all_files)
+            finally:
+                os.stat, os.lstat, os.scandir = stat, lstat, scandir
+            self.assertEqual(len(all_files), num_files + 1)
+            self.assertEqual(len(files), 1000)
+            return work["stats"] + work["entries"]
+
+        small = count_filesystem_work(100000)
+        big = count_filesystem_work(1000000)
+        # the paths are looked up in a listing of their directory (at
+        # most a stat per path, never a listing per path), so ten times
+        # the files take at most ten times the work
+        self.assertLessEqual(small, 100000 + 1)
+        self.assertLessEqual(big, small * 10)
+
+    def test_store_backends(self):
+        record = build.get_file_record("./tmp/file1.txt")
+        # an old YAML store is migrated to SQLite
+        with io.open("./tmp/shastore", "w") as fh:
+            store.dump_yaml({"files": {"./tmp/file1.txt": record}}, fh)
+        self.assertEqual(store.get_store_format("./tmp/shastore"), "yaml")
+        shastore = store.open_store(self.settings, path="./tmp/shastore")
+        self.assertEqual(store.get_store_format("./tmp/shastore"), "sqlite")
+        self.assertEqual(shastore.get("./tmp/file1.txt"), record)
+        self.assertEqual(shastore.get_meta("sake version"),
+                         constants.VERSION)
+        # updates don't touch the other records
+        shastore.update({"./tmp/file2.txt": {"sha": "2"}})
+        self.assertEqual(shastore.get_all(),
+                         {"./tmp/file1.txt": record,
+                          "./tmp/file2.txt": {"sha": "2"}})
+        shastore.close()
+        # and it can go back to YAML
+        self.settings["store_backend"] = "yaml"
+        shastore = store.open_store(self.settings, path="./tmp/shastore")
+        self.assertEqual(store.get_store_format("./tmp/shastore"), "yaml")
+        self.assertEqual(shastore.get("./tmp/file2.txt"), {"sha": "2"})
+        shastore.close()
+
+    def test_store_migrations(self):
+        sha = "356a192b7913b04c54574d18c28d46e6395428ab"
+        # a store from before sake stamped its version in them
+        with io.open("./tmp/shastore", "w") as fh:
+            fh.write("files:\n"
+                     "  ./tmp/file1.txt: {{sha: {}}}\n"
+                     "  ./tmp/file2.txt: {{sha: 2}}\n".format(sha))
+        shastore = store.open_store(self.settings, path="./tmp/shastore")
+        self.assertEqual(store.get_format_version(shastore), 0)
+        G = nx.DiGraph()
+        G.add_node("one", dependencies=["./tmp/file1.txt"])
+        build.migrate_shastore(G, shastore, self.settings)
+        self.assertEqual(store.get_format_version(shastore),
+                         store.STORE_FORMAT)
+        self.assertEqual(shastore.get_all(), {"./tmp/file1.txt": {"sha": sha}})
+        self.assertEqual(shastore.get_target("one")["./tmp/file1.txt"]["sha"],
+                         sha)
+        # but not from the future
+        shastore.set_meta("store format", str(store.STORE_FORMAT + 1))
+        with self.assertRaises(SystemExit):
+            build.migrate_shastore(G, shastore, self.settings)
+        shastore.close()
+
+    @unittest.skipIf(sys.platform == "win32",
+                     "needs symlinks and a POSIX shell")
+    def test_relocated_store(self):
+        sake = [sys.executable, os.path.abspath("sake")]
+        bundle = os.path.abspath("./tmp/bundle.tar.gz")
+        sakefile = ("upper:\n"
+                    "    help: upper\n"
+                    "    dependencies:\n"
+                    "        - in.txt\n"
+                    "        - $ROOT/data.txt\n"
+                    "    formula: cat in.txt data.txt > out.txt\n"
+                    "    output:\n"
+                    "        - out.txt\n")
+
+        def make_checkout(path, link):
+            os.makedirs(path)
+            for name, text in [("Sakefile", sakefile), ("in.txt", "in"),
+                               ("data.txt", "data")]:
+                with io.open(os.path.join(path, name), "w") as fh:
+                    fh.write(text)
+            # the project is reached through a symlink, like a $PWD
+            os.symlink(os.path.abspath(path), link)
+            return ["-D", "ROOT={}".format(os.path.abspath(link))]
+
+        def run_sake(args, cwd):
+            return subprocess.check_output(sake + args, cwd=cwd,
+                                           stderr=subprocess.STDOUT,
+                                           universal_newlines=True)
+
+        first = "./tmp/ci/job1/project"
+        defines = make_checkout(first, "./tmp/link1")
+        self.assertEqual(acts.clean_path(os.path.abspath("./tmp/link1/data.txt"),
+                                         force_start=first), "data.txt")
+        self.assertIn("Running target upper", run_sake(defines, first))
+        run_sake(["store", "export", bundle], first)
+        # a fresh clone somewhere else, with the outputs copied along
+        second = "./tmp/ci/jobs/2/project"
+        defines = make_checkout(second, "./tmp/link2")
+        shutil.copyfile(os.path.join(first, "out.txt"),
+                        os.path.join(second, "out.txt"))
+        run_sake(["store", "import", bundle], second)
+        dump = yaml.safe_load(run_sake(["dump-store"], second))
+        self.assertEqual(sorted(dump["files"]),
+                         ["data.txt", "in.txt", "out.txt"])
+        self.assertNotIn("Running target", run_sake(defines, second))
+
+    def test_import_bad_bundles(self):
+        payload = json.dumps({"files": {}, "targets": {}}).encode("utf-8")
+        for manifest in [{}, {"store format": "2"}, ["store format"]]:
+            if isinstance(manifest, dict):
+                manifest["sha256"] = hashlib.sha256(payload).hexdigest()
+            with tarfile.open("./tmp/bundle.tar.gz", "w:gz") as tar:
+                build.add_to_tarball(tar, build.BUNDLE_MANIFEST,
+                                     json.dumps(manifest).encode("utf-8"))
+                build.add_to_tarball(tar, build.BUNDLE_STORE, payload)
+            self.assertEqual(build.import_store(self.settings,
+                                                "./tmp/bundle.tar.gz"), 1)
+
+    def test_lazy_records(self):
+        shastore = store.open_store(self.settings, path="./tmp/shastore")
+        shastore.update({"./tmp/file{}.txt".format(i): {"sha": str(i)}
+                         for i in range(1000)})
+        records = store.LazyRecords(shastore.get,
+                                    {"./tmp/file1.txt": {"sha": "one"}})
+        self.assertEqual(records["./tmp/file1.txt"], {"sha": "one"})
+        self.assertEqual(records["./tmp/file2.txt"], {"sha": "2"})
+        self.assertNotIn("./tmp/file1000.txt", records)
+        self.assertIsNone(records.get("./tmp/file1000.txt"))
+        # only the records that were asked for were read
+        self.assertEqual(len(records.cache), 3)
+        records["./tmp/file3.txt"] = {"sha": "three"}
+        self.assertEqual(shastore.get("./tmp/file3.txt"), {"sha": "3"})
+        shastore.close()
+
+    def test_collect_garbage(self):
+        os.mkdir("./tmp/outdir")
+        for backend in ["sqlite", "yaml"]:
+            self.settings["store_backend"] = backend
+            shastore = store.open_store(self.settings,
+                                        path="./tmp/shastore." + backend)
+            shastore.update({"./tmp/file1.txt": {"sha": "1"},
+                             "./tmp/outdir/inside.txt": {"sha": "2"},
+                             "./tmp/gone.txt": {"sha": "3"},
+                             "./tmp/recent.txt": {"sha": "4"}},
+                            {"one": {}, "two": {}, "three": {}, "four": {}})
+            self.assertFalse(store.needs_compaction(shastore))
+            # a week later
+            week_ago = time.time() - store.GC_MAX_AGE - 1
+            shastore.set_meta("last gc", str(week_ago))
+            self.assertTrue(store.needs_compaction(shastore))
+            # (another build, with other macros, used some of them lately)
+            shastore.set_last_seen({"./tmp/gone.txt": week_ago,
+                                    "./tmp/recent.txt": time.time()},
+                                   {"two": week_ago, "three": time.time()})
+            live = ["./tmp/file1.txt", "./tmp/outdir"]
+            removed = store.collect_garbage(shastore, live, ["one"],
+                                            store.GC_MAX_AGE)
+            self.assertEqual(removed, (1, 1))
+            self.assertEqual(sorted(shastore.get_paths()),
+                             ["./tmp/file1.txt", "./tmp/outdir/inside.txt",
+                              "./tmp/recent.txt"])
+            self.assertEqual(sorted(shastore.get_target_names()),
+                             ["four", "one", "three"])
+            self.assertFalse(store.needs_compaction(shastore))
+            # `sake gc-store` drops whatever isn't in the Sakefile
+            self.assertEqual(store.collect_garbage(shastore, live, ["one"]),
+                             (1, 2))
+            self.assertEqual(shastore.get_target_names(), ["one"])
+            # builds only rewrite the times that are missing or old
+            G = nx.DiGraph()
+            G.add_node("one", dependencies=["./tmp/file1.txt"])
+            self.assertEqual(build.stamp_last_seen(G, shastore), (1, 1))
+            self.assertEqual(build.stamp_last_seen(G, shastore), (0, 0))
+            shastore.set_last_seen({}, {"one": week_ago})
+            self.assertEqual(build.stamp_last_seen(G, shastore), (0, 1))
+            shastore.close()
+
+    def test_gc_store_replays_journals(self):
+        os.mkdir("./tmp/project")
+        cwd = os.getcwd()
+        os.chdir("./tmp/project")
+        try:
+            # the only records are those of a build that was interrupted
+            journal = store.Journal(store.JOURNAL + ".1")
+            journal.append({"in.txt": {"sha": "1"}, "gone.txt": {"sha": "2"}},
+                           {"one": {"in.txt": {"sha": "1"}}})
+            journal.close()
+            G = nx.DiGraph()
+            G.add_node("one", dependencies=["in.txt"])
+            self.assertEqual(build.gc_store(G, self.settings), 0)
+            self.assertFalse(os.path.exists(store.JOURNAL + ".1"))
+            shastore = store.open_store(self.settings)
+            self.assertEqual(shastore.get_all(), {"in.txt": {"sha": "1"}})
+            self.assertEqual(shastore.get_target_names(), ["one"])
+            self.assertEqual(store.get_format_version(shastore),
+                             store.STORE_FORMAT)
+            shastore.close()
+        finally:
+            os.chdir(cwd)
+
+    def test_journal_replay(self):
+        journal = store.Journal("./tmp/journal.1")
+        journal.append({"./tmp/file1.txt": {"sha": "1"}})
+        journal.append({"./tmp/file1.txt": {"sha": "one"},
+                        "./tmp/file2.txt": {"sha": "2"}})
+        journal.close()
+        # a build that was killed in the middle of writing an entry
+        with io.open("./tmp/journal.1", "a") as fh:
+            fh.write('{"files": {"./tmp/file3.txt": {"sh')
+        shastore = store.open_store(self.settings, path="./tmp/shastore")
+        store.replay_journal(shastore, self.settings, path="./tmp/journal")
+        self.assertEqual(shastore.get_all(),
+                         {"./tmp/file1.txt": {"sha": "one"},
+                          "./tmp/file2.txt": {"sha": "2"}})
+        self.assertFalse(os.path.isfile("./tmp/journal.1"))
+        # and so is one that a killed build left while opening it,
+        # but not one that is being opened right now
+        for name in ["./tmp/journal.2.new", "./tmp/journal.3.new"]:
+            with io.open(name, "w") as fh:
+                fh.write('{"files": {"./tmp/file3.txt": {"sha": "3"}}, '
+                         '"targets": {}}\n')
+        os.utime("./tmp/journal.2.new", (1000000000, 1000000000))
+        store.replay_journal(shastore, self.settings, path="./tmp/journal")
+        self.assertEqual(shastore.get("./tmp/file3.txt"), {"sha": "3"})
+        self.assertFalse(os.path.isfile("./tmp/journal.2.new"))
+        self.assertTrue(os.path.isfile("./tmp/journal.3.new"))
+        shastore.close()
+
+    def test_concurrent_stores(self):
+        # the journal of a running build is left alone
+        journal = store.Journal("./tmp/journal.1")
+        journal.append({"./tmp/file1.txt": {"sha": "1"}})
+        shastore = store.open_store(self.settings, path="./tmp/shastore")
+        store.replay_journal(shastore, self.settings, path="./tmp/journal")
+        self.assertIsNone(shastore.get("./tmp/file1.txt"))
+        self.assertTrue(os.path.isfile("./tmp/journal.1"))
+        journal.discard()
+        shastore.close()
+        # two YAML stores open at once keep each other's updates
+        self.settings["store_backend"] = "yaml"
+        store1 = store.open_store(self.settings, path="./tmp/shastore.yaml")
+        store2 = store.open_store(self.settings, path="./tmp/shastore.yaml")
+        store1.update({"./tmp/file1.txt": {"sha": "1"}})
+        store2.update({"./tmp/file2.txt": {"sha": "2"}})
+        self.assertEqual(store.open_store(self.settings,
+                                          path="./tmp/shastore.yaml").get_all(),
+                         {"./tmp/file1.txt": {"sha": "1"},
+                          "./tmp/file2.txt": {"sha": "2"}})
+
+    @unittest.skipIf(sys.platform == "win32", "needs POSIX file locks")
+    def test_concurrent_builds(self):
+        project = "./tmp/project"
+        os.makedirs(project)
+        names = ["t{}".format(i) for i in range(16)]
+        with io.open(os.path.join(project, "in.txt"), "w") as fh:
+            fh.write("in")
+        with io.open(os.path.join(project, "Sakefile"), "w") as fh:
+            for name in names:
+                fh.write("{0}:\n"
+                         "    help: {0}\n"
+                         "    dependencies:\n"
+                         "        - in.txt\n"
+                         "    formula: touch {0}.txt\n"
+                         "    output:\n"
+                         "        - {0}.txt\n".format(name))
+        sake = [sys.executable, os.path.abspath("sake"), "--store-backend",
+                "yaml"]
+        # every build replays (or skips) the journals of the others
+        builds = [subprocess.Popen(sake + [name], cwd=project,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+                  for name in names]
+        for build_process in builds:
+            output = build_process.communicate()[0]
+            self.assertEqual(build_process.returncode, 0, output)
+        # and none of them lost the records of its target
+        for name in names:
+            output = subprocess.check_output(sake + [name], cwd=project,
+                                             universal_newlines=True)
+            self.assertNotIn("Running target", output)
+
+    def test_action_cache(self):
+        os.makedirs("./tmp/out")
+        with io.open("./tmp/out/part.txt", "w") as fh:
+            fh.write("part")
+        node_dict = {"formula": "make things",
+                     "output": ["./tmp/file1.txt", "./tmp/out"]}
+        inputs = {"./tmp/in.txt": {"sha": "1", "algorithm": "sha1"}}
+        key = cache.get_action_key(node_dict, inputs, self.settings)
+        self.assertNotEqual(key, cache.get_action_key(node_dict,
+                            {"./tmp/in.txt": {"sha": "2",
+                                              "algorithm": "sha1"}},
+                            self.settings))
+        self.settings["defines"] = ["MODE=debug"]
+        self.assertNotEqual(key, cache.get_action_key(node_dict, inputs,
+                                                      self.settings))
+        self.assertFalse(cache.restore_outputs("./tmp/cache", key,
+                                               node_dict["output"]))
+        self.assertTrue(cache.save_outputs("./tmp/cache", key,
+                                           node_dict["output"]))
+        os.remove("./tmp/file1.txt")
+        shutil.rmtree("./tmp/out")
+        self.assertTrue(cache.restore_outputs("./tmp/cache", key,
+                                              node_dict["output"]))
+        with io.open("./tmp/file1.txt") as fh:
+            self.assertEqual(fh.read(), "1")
+        with io.open("./tmp/out/part.txt") as fh:
+            self.assertEqual(fh.read(), "part")
+        # restoring over the same restored outputs leaves nothing behind
+        self.assertTrue(cache.restore_outputs("./tmp/cache", key,
+                                              node_dict["output"]))
+        self.assertEqual(sorted(os.listdir("./tmp/out")), ["part.txt"])
+        self.assertFalse(any(".sake-tmp" in name
+                             for name in os.listdir("./tmp")))
+        # forced rebuilds don't restore anything
+        G = nx.DiGraph()
+        G.add_node("things", **node_dict)
+        self.settings.update({"cache_dir": "./tmp/cache", "force": True})
+        self.assertFalse(build.restore_from_cache(G, "things", key, {},
+                                                  self.settings))
+        # rerunning a formula mustn't write through to the cache
+        cache.break_hardlinks(node_dict["output"])
+        self.assertEqual(os.stat("./tmp/out/part.txt").st_nlink, 1)
+        with io.open("./tmp/file1.txt", "w") as fh:
+            fh.write("2")
+        os.remove("./tmp/file1.txt")
+        self.assertTrue(cache.restore_outputs("./tmp/cache", key,
+                                              node_dict["output"]))
+        with io.open("./tmp/file1.txt") as fh:
+            self.assertEqual(fh.read(), "1")
+
+    def test_background_uploads(self):
+        G = nx.DiGraph()
+        G.add_node("one", output=["./tmp/file1.txt"])
+        self.settings.update({"cache_dir": "./tmp/cache",
+                              "remote_cache": "http://localhost:1"})
+        key = hashlib.sha256(b"an action").hexdigest()
+        release = threading.Event()
+        uploaded = []
+        warnings = []
+
+        def slow_upload(cache_dir, a_key, remote):
+            release.wait(5)
+            uploaded.append(a_key)
+            return False
+
+        upload_outputs = cache.upload_outputs
+        cache.upload_outputs = slow_upload
+        self.settings["warn"] = warnings.append
+        try:
+            # the build goes on while the upload is in flight
+            build.save_to_cache(G, "one", key, self.settings)
+            self.assertEqual(uploaded, [])
+            release.set()
+            build.finish_uploads(self.settings)
+        finally:
+            cache.upload_outputs = upload_outputs
+        self.assertEqual(uploaded, [key])
+        self.assertEqual(len(warnings), 1)
+        self.assertIsNone(self.settings["upload_executor"])
+
+    def test_remote_cache(self):
+        server = cache_server.make_server(os.path.abspath("./tmp/remote"),
+                                          quiet=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            remote = "http://{}:{}".format(*server.server_address[:2])
+            key = hashlib.sha256(b"an action").hexdigest()
+            self.assertFalse(cache.restore_outputs("./tmp/cache2", key,
+                                                   ["./tmp/file1.txt"],
+                                                   remote))
+            cache.save_outputs("./tmp/cache1", key, ["./tmp/file1.txt"])
+            self.assertTrue(cache.upload_outputs("./tmp/cache1", key,
+                                                 remote))
+            os.remove("./tmp/file1.txt")
+            self.assertTrue(cache.restore_outputs("./tmp/cache2", key,
+                                                  ["./tmp/file1.txt"],
+                                                  remote))
+            with io.open("./tmp/file1.txt") as fh:
+                self.assertEqual(fh.read(), "1")
+            # blobs that don't match their digest are refused
+            with io.open("./tmp/bad", "w") as fh:
+                fh.write("not 1")
+            digest = hashlib.sha256(b"1").hexdigest()
+            self.assertFalse(cache.push_remote(remote, "cas", "0" * 64,
+                                               "./tmp/bad"))
+            self.assertTrue(cache.remote_has(remote, "cas", digest))
+            self.assertFalse(cache.remote_has(remote, "cas", "0" * 64))
+            # and results that would put things anywhere but in the
+            # outputs of the target are misses
+            os.makedirs("./tmp/victim")
+            with io.open("./tmp/victim/keep.txt", "w") as fh:
+                fh.write("keep")
+            for i, outputs in enumerate([
+                    [{"path": "./tmp/victim", "files": []}],
+                    [{"path": "./tmp/out", "files": [
+                        {"path": "../victim/keep.txt", "digest": digest,
+                         "mode": 0o644}]}]]):
+                bad_key = hashlib.sha256(str(i).encode()).hexdigest()
+                with io.open("./tmp/bad", "w") as fh:
+                    fh.write(json.dumps({"outputs": outputs}))
+                self.assertTrue(cache.push_remote(remote, "ac", bad_key,
+                                                  "./tmp/bad"))
+                self.assertFalse(cache.restore_outputs("./tmp/cache3",
+                                                       bad_key,
+                                                       ["./tmp/out"],
+                                                       remote))
+            with io.open("./tmp/victim/keep.txt") as fh:
+                self.assertEqual(fh.read(), "keep")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
 
 
 